@@ -46,12 +46,13 @@ import time
 from io import BytesIO
 import requests
 import webbrowser
+import multiprocessing
 import astc_decomp
 import liblzfse
 
 from src import (
     extract_archive, ios_app_mapper, shomium_funcs, save_dialog, report_builder, 
-    image_delegate, pandas_model, utils, ktx_2_png)
+    image_delegate, pandas_model, utils, ktx_2_png, timeline, derived_cache)
 
 if hasattr(Qt, 'AA_EnableHighDpiScaling'):
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
@@ -232,6 +233,8 @@ class GUI(QMainWindow):
             '&Open Temp', lambda: webbrowser.open(temp_output_dir))
         self.file_menu.addAction(
             '&Open Logs', lambda: webbrowser.open(pj(dirname(temp_output_dir), 'logs.txt')))
+        self.file_menu.addAction(
+            '&Clear Image Cache', lambda: derived_cache.default_cache.clear())
 
         self.help_menu = self.menuBar().addMenu("&Help")
         self.help_menu.addAction(
@@ -281,6 +284,12 @@ class ArchiveTab(QWidget):
         self.archive_details.setFixedHeight(40)
         self.archive_details.insertPlainText('Archive:\t{}\nOS:\t{}'.format(fn, self.oem))
 
+        # exports one timeline of every timestamped artifact from the packages opened so far
+        self.timeline_btn = utils.CustomQPushButton()
+        self.timeline_btn.setText('Export Timeline')
+        self.timeline_btn.setToolTip('Merge the timestamps of every opened package into one CSV timeline')
+        self.timeline_btn.clicked.connect(self._init_timeline_thread)
+
         self._maingrid = QGridLayout()
         self._maingrid.setContentsMargins(5, 5, 5, 5)
         self._maingrid.addWidget(self.archive_details,          0, 0, 1, 1, alignment=Qt.AlignLeft)
@@ -288,6 +297,7 @@ class ArchiveTab(QWidget):
         self._maingrid.addWidget(self.log_widget(),             2, 0, 1, 1, alignment=Qt.AlignLeft)
         self._maingrid.addWidget(self.tabs,                     0, 1, 4, 4)
         self._maingrid.addWidget(control_f_emblem,              3, 0, 2, 1)
+        self._maingrid.addWidget(self.timeline_btn,             5, 0, 1, 1, alignment=Qt.AlignLeft)
         self._maingrid.addWidget(self.progress_bar,             5, 1, 1, 4, alignment=Qt.AlignBottom)
         self.setLayout(self._maingrid)
 
@@ -388,6 +398,7 @@ class ArchiveTab(QWidget):
     def _init_archive_parser(self):
         self.progress_bar.show()
         self.report_output_dir = pj(temp_output_dir, 'dump_{}'.format(int(time.time())))
+        self.timeline = timeline.TimelineBuilder(pj(self.report_output_dir, 'timeline'))
 
         self._extract_archive_thread = extract_archive.ExtractArchiveThread(
                                                             self,
@@ -401,6 +412,35 @@ class ArchiveTab(QWidget):
         self._extract_archive_thread.finishedSignal.connect(self._finished_archive_extraction)
         self._extract_archive_thread.start()
 
+    def _init_timeline_thread(self):
+        if not self.timeline.event_count:
+            self.add_log('No timestamped artifacts yet (open a package first)')
+            return
+        self.timeline_btn.setEnabled(False)
+        self.progress_bar.show()
+        output_fp = pj(self.report_output_dir, 'timeline_{}.csv'.format(int(time.time())))
+        self._timeline_thread = shomium_funcs.TimelineThread(self.timeline, output_fp)
+        self._timeline_thread.progressSignal.connect(self._progress_timeline)
+        self._timeline_thread.finishedSignal.connect(self._finished_timeline)
+        self._timeline_thread.start()
+
+    def _progress_timeline(self, objects):
+        val, txt, _ = objects
+        if val:
+            self.progress_bar.setValue(val)
+        if txt:
+            self.add_log(txt)
+
+    def _finished_timeline(self, out):
+        output_fp, count = out
+        self.progress_bar.setValue(0)
+        self.progress_bar.hide()
+        self.timeline_btn.setEnabled(True)
+        if output_fp:
+            self.add_log('Timeline of {} events saved to {}'.format(count, output_fp))
+        else:
+            self.add_log('Timeline failed, see the logs')
+
     def build_package_dict(self, archive_files):
         self.add_log('Building package list...')
         package_dict = dict()
@@ -560,6 +600,10 @@ class PackageTab(QWidget):
                     1, 0, 1, 1)
                 tab_widget.setLayout(_grid)
                 self._tabs.addTab(tab_widget, webview_item)
+                try:
+                    self.maingui.timeline.add_dataframe(df, package, webview_item)
+                except Exception as err:
+                    logging.error('Timeline - {} - {}: {}'.format(package, webview_item, err))
 
     def _finished_df_generation(self, s):
         self.update_pkg_progress_bar(0)
@@ -609,6 +653,8 @@ class DisplayTab(QWidget):
                 col_idx = self.df.columns.values.tolist().index('media')
                 self.tableview.setItemDelegateForColumn(
                     col_idx, image_delegate.ImageDelegate(self.tableview))
+                self.tableview.doubleClicked.connect(self.open_media)
+                self.tableview.setToolTip('Double click an image to open it at full resolution')
             else:
                 self.has_media = False
 
@@ -654,6 +700,12 @@ class DisplayTab(QWidget):
         col_headers.insert(0, "media")
         self.df = self.df[col_headers]
 
+    def open_media(self, index):
+        # the GUI shows previews; the full resolution image is decoded when it is opened
+        if self.df.columns[index.column()] != 'media' or not index.data():
+            return
+        webbrowser.open(ktx_2_png.full_image(index.data()))
+
     @pyqtSlot(str)
     def search_input_changed(self, text):
         search = QRegExp(text, Qt.CaseInsensitive, QRegExp.RegExp)
@@ -706,4 +758,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # the parsers use process pools; a frozen (PyInstaller) executable must handle its worker processes here
+    multiprocessing.freeze_support()
     main()
@@ -21,6 +21,7 @@ SOFTWARE.
 """
 
 import typing
+import codecs
 import struct
 import re
 import os
@@ -28,9 +29,17 @@ import io
 import pathlib
 import dataclasses
 import enum
-from collections import namedtuple
+import bisect
+import heapq
+import array
+import itertools
+import mmap
+import concurrent.futures
+from collections import namedtuple, OrderedDict, deque
 from types import MappingProxyType
 
+import numpy as np
+
 from src import ccl_simplesnappy
 
 __version__ = "0.4"
@@ -70,6 +79,28 @@ def read_le_varint(stream: typing.BinaryIO, *, is_google_32bit=False) -> typing.
         return x[0]
 
 
+def _decode_varint32(data: bytes, pos: int) -> typing.Tuple[int, int]:
+    """Decode a (google 32 bit) varint from data at pos without a stream.
+    Returns a tuple of the (unsigned) value and the offset following the varint."""
+    result = 0
+    for shift in range(0, 35, 7):
+        tmp = data[pos]
+        pos += 1
+        result |= (tmp & 0x7f) << shift
+        if not tmp & 0x80:
+            break
+    return result, pos
+
+
+def _identity(x):
+    return x
+
+
+def _strip_tag(internal_key: bytes) -> bytes:
+    """Returns the user key portion of an internal key found in a table file (i.e. without the seq/type tag)"""
+    return internal_key[0:-8] if len(internal_key) >= 8 else internal_key
+
+
 def read_length_prefixed_blob(stream: typing.BinaryIO):
     length = read_le_varint(stream)
     data = stream.read(length)
@@ -166,6 +197,9 @@ class Block:
         self._restart_array_count, = struct.unpack("<I", self._raw[-4:])
         self._restart_array_offset = len(self._raw) - (self._restart_array_count + 1) * 4
 
+    def __len__(self):
+        return len(self._raw)
+
     def get_restart_offset(self, index) -> int:
         offset = self._restart_array_offset + (index * 4)
         return struct.unpack("<i", self._raw[offset: offset + 4])[0]
@@ -173,95 +207,576 @@ class Block:
     def get_first_entry_offset(self) -> int:
         return self.get_restart_offset(0)
 
-    def __iter__(self) -> typing.Iterable[RawBlockEntry]:
-        offset = self.get_first_entry_offset()
-        with io.BytesIO(self._raw) as buff:
-            buff.seek(offset)
+    def _get_restart_key(self, index) -> bytes:
+        # entries at restart points share nothing with the previous key, so their key can be read directly
+        pos = self.get_restart_offset(index)
+        _, pos = _decode_varint32(self._raw, pos)
+        non_shared_length, pos = _decode_varint32(self._raw, pos)
+        _, pos = _decode_varint32(self._raw, pos)
+        return self._raw[pos:pos + non_shared_length]
+
+    def seek(self, user_key: bytes) -> typing.Iterable[typing.Tuple[bytes, memoryview, int]]:
+        """As iterate_entry_views, but starting at the first entry whose user key is >= user_key (bytewise).
+        The restart array is binary searched so only the entries following the nearest restart point are decoded."""
+        if self._restart_array_count == 0:
+            return
+
+        # find the last restart point whose user key is < user_key
+        lo, hi = 0, self._restart_array_count - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if _strip_tag(self._get_restart_key(mid)) < user_key:
+                lo = mid
+            else:
+                hi = mid - 1
+
+        entries = self.iterate_entry_views(self.get_restart_offset(lo))
+        for entry in entries:
+            if _strip_tag(entry[0]) >= user_key:
+                yield entry
+                yield from entries
+                return
+
+    def iterate_entry_views(self, start_offset: int = None) -> typing.Iterable[typing.Tuple[bytes, memoryview, int]]:
+        """Iterate (key, value, block_offset) for each entry in the block, decoding directly from the raw block.
+        Values are zero-copy memoryview slices of the block; use bytes(value) if they need to outlive it.
+        start_offset must be a restart point if given."""
+        raw = self._raw
+        view = memoryview(raw)
+        pos = self.get_first_entry_offset() if start_offset is None else start_offset
+        limit = self._restart_array_offset
+
+        key = b""
+
+        while pos < limit:
+            start_offset = pos
+            # the three lengths are usually single byte varints, so check for that before decoding properly
+            shared_length = raw[pos]
+            if shared_length < 0x80:
+                pos += 1
+            else:
+                shared_length, pos = _decode_varint32(raw, pos)
+            non_shared_length = raw[pos]
+            if non_shared_length < 0x80:
+                pos += 1
+            else:
+                non_shared_length, pos = _decode_varint32(raw, pos)
+            value_length = raw[pos]
+            if value_length < 0x80:
+                pos += 1
+            else:
+                value_length, pos = _decode_varint32(raw, pos)
 
-            key = b""
+            # sense check
+            if shared_length > len(key):
+                raise ValueError("Shared key length is larger than the previous key")
 
-            while buff.tell() < self._restart_array_offset:
-                start_offset = buff.tell()
-                shared_length = read_le_varint(buff, is_google_32bit=True)
-                non_shared_length = read_le_varint(buff, is_google_32bit=True)
-                value_length = read_le_varint(buff, is_google_32bit=True)
+            key_end = pos + non_shared_length
+            key = key[:shared_length] + raw[pos:key_end] if shared_length else raw[pos:key_end]
+            pos = key_end + value_length
 
-                # sense check
-                if offset >= self._restart_array_offset:
-                    raise ValueError("Reading start of entry past the start of restart array")
-                if shared_length > len(key):
-                    raise ValueError("Shared key length is larger than the previous key")
+            yield key, view[key_end:pos], start_offset
 
-                key = key[:shared_length] + buff.read(non_shared_length)
-                value = buff.read(value_length)
+    def __iter__(self) -> typing.Iterable[RawBlockEntry]:
+        for key, value, start_offset in self.iterate_entry_views():
+            yield RawBlockEntry(key, bytes(value), start_offset)
+
+
+class BlockCache:
+    """A size-bounded LRU cache of decompressed Blocks, keyed by table file and block offset.
+    A single cache can be shared between all of the LdbFiles in a database."""
+    DEFAULT_CAPACITY = 8 * 1024 * 1024  # as leveldb's own default block cache
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+
+    def get(self, key) -> typing.Optional[Block]:
+        block = self._blocks.get(key)
+        if block is None:
+            self.misses += 1
+            return None
+        self._blocks.move_to_end(key)
+        self.hits += 1
+        return block
+
+    def put(self, key, block: Block):
+        if key in self._blocks:
+            return
+        self._blocks[key] = block
+        self.size += len(block)
+        while self.size > self.capacity and self._blocks:
+            _, evicted = self._blocks.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self):
+        self._blocks.clear()
+        self.size = 0
+
+
+def bloom_hash(data: bytes, *, signed_tail=False) -> int:
+    """leveldb's Hash() with the seed used by its bloom filter policy.
+    Older builds of leveldb sign extended the trailing (len % 4) bytes; set signed_tail to reproduce that.
+    See: https://github.com/google/leveldb/blob/master/util/hash.cc"""
+    m = 0xc6a4a793
+    n = len(data)
+    h = (0xbc9f1d34 ^ (n * m)) & 0xffffffff
+    whole = n - (n % 4)
+    for i in range(0, whole, 4):
+        h = (h + int.from_bytes(data[i:i + 4], "little")) & 0xffffffff
+        h = (h * m) & 0xffffffff
+        h ^= h >> 16
+    tail = data[whole:]
+    if tail:
+        for i in range(len(tail) - 1, -1, -1):
+            b = tail[i] - 256 if signed_tail and tail[i] > 0x7f else tail[i]
+            h = (h + (b << (8 * i))) & 0xffffffff
+        h = (h * m) & 0xffffffff
+        h ^= h >> 24
+    return h
+
+
+class BloomFilterBlock:
+    """The filter meta block written by leveldb's built in bloom filter policy. It holds a bloom filter over the
+    user keys for each (2 ** base_lg) byte range of data block offsets.
+    See: https://github.com/google/leveldb/blob/master/doc/table_format.md
+    https://github.com/google/leveldb/blob/master/util/bloom.cc"""
+    NAME = b"filter.leveldb.BuiltinBloomFilter2"
+
+    def __init__(self, raw: bytes):
+        self._raw = raw
+        if len(raw) < 5:
+            raise ValueError("Filter block is too short")
+        self.base_lg = raw[-1]
+        self._offset_array_offset, = struct.unpack("<I", raw[-5:-1])
+        if self._offset_array_offset > len(raw) - 5:
+            raise ValueError("Invalid offset array offset in filter block")
+        self.filter_count = (len(raw) - 5 - self._offset_array_offset) // 4
+
+    def key_may_match(self, block_offset: int, user_key: bytes) -> bool:
+        """False if the data block at block_offset definitely doesn't contain user_key"""
+        index = block_offset >> self.base_lg
+        if index >= self.filter_count:
+            return True  # errors are treated as potential matches, as leveldb does
+        start, limit = struct.unpack_from("<II", self._raw, self._offset_array_offset + index * 4)
+        if start == limit:
+            return False  # empty filters do not match any keys
+        if not start < limit <= self._offset_array_offset:
+            return True
+
+        bloom = self._raw[start:limit]
+        if len(bloom) < 2:
+            return False  # too short to hold a filter and its probe count, as leveldb treats it
+        bits = (len(bloom) - 1) * 8
+        k = bloom[-1]
+        if k > 30:
+            return True  # reserved for potentially new encodings
+
+        return (self._bloom_match(bloom, bits, k, bloom_hash(user_key)) or
+                self._bloom_match(bloom, bits, k, bloom_hash(user_key, signed_tail=True)))
+
+    @staticmethod
+    def _bloom_match(bloom: bytes, bits: int, k: int, h: int) -> bool:
+        delta = ((h >> 17) | (h << 15)) & 0xffffffff
+        for _ in range(k):
+            bit_pos = h % bits
+            if not bloom[bit_pos >> 3] & (1 << (bit_pos & 7)):
+                return False
+            h = (h + delta) & 0xffffffff
+        return True
+
+
+@dataclasses.dataclass
+class BloomFilterStats:
+    """Counts the outcome of bloom filter checks made during point lookups.
+    negatives are data block reads which the filter saved; false_positives are blocks the filter allowed to be read
+    which didn't hold the key."""
+    checks: int = 0
+    negatives: int = 0
+    false_positives: int = 0
+
+
+class FileHandlePool:
+    """An LRU pool of open (read only) file handles, capped at max_open, so that databases with thousands of files
+    don't exhaust file descriptors. Handles evicted from the pool are closed, and reopened when next needed."""
+    DEFAULT_MAX_OPEN = 64
+
+    def __init__(self, max_open: int = DEFAULT_MAX_OPEN):
+        if max_open < 1:
+            raise ValueError("max_open must be at least 1")
+        self.max_open = max_open
+        self._handles = OrderedDict()
+
+    def get(self, path: pathlib.Path) -> typing.BinaryIO:
+        f = self._handles.get(path)
+        if f is not None:
+            self._handles.move_to_end(path)
+            return f
+        while len(self._handles) >= self.max_open:
+            _, evicted = self._handles.popitem(last=False)
+            evicted.close()
+        f = self._handles[path] = path.open("rb")
+        return f
+
+    def release(self, path: pathlib.Path):
+        f = self._handles.pop(path, None)
+        if f is not None:
+            f.close()
 
-                yield RawBlockEntry(key, value, start_offset)
+    def close(self):
+        for f in self._handles.values():
+            f.close()
+        self._handles.clear()
 
 
 class LdbFile:
-    """A leveldb table (.ldb or .sst) file."""
+    """A leveldb table (.ldb or .sst) file.
+    The file is only opened, and its footer, index and filter blocks only read, when it is first accessed."""
     BLOCK_TRAILER_SIZE = 5
     FOOTER_SIZE = 48
     MAGIC = 0xdb4775248b80fb57
 
-    def __init__(self, file: pathlib.Path):
+    def __init__(self, file: pathlib.Path, *, block_cache: BlockCache = None, filter_stats: BloomFilterStats = None,
+                 handle_pool: FileHandlePool = None):
         if not file.exists():
             raise FileNotFoundError(file)
 
         self.path = file
-        self.file_no = int(file.stem, 16)
+        self.file_no = int(file.stem)  # leveldb file numbers are decimal, as in the manifest
+        self._block_cache = block_cache if block_cache is not None else BlockCache()
+        self.filter_stats = filter_stats if filter_stats is not None else BloomFilterStats()
+        self._handle_pool = handle_pool if handle_pool is not None else FileHandlePool(1)
+
+        # set by _load on first access
+        self._meta_index_handle = None
+        self._index_handle = None
+        self._index = None
+        self._index_user_keys = None
+        self._filter = None
+
+    @property
+    def _f(self) -> typing.BinaryIO:
+        return self._handle_pool.get(self.path)
 
-        self._f = file.open("rb")
-        self._f.seek(-LdbFile.FOOTER_SIZE, os.SEEK_END)
+    def _load(self):
+        if self._index is not None:
+            return
 
-        self._meta_index_handle = BlockHandle.from_stream(self._f)
-        self._index_handle = BlockHandle.from_stream(self._f)
-        self._f.seek(-8, os.SEEK_END)
-        magic, = struct.unpack("<Q", self._f.read(8))
+        f = self._f
+        f.seek(-LdbFile.FOOTER_SIZE, os.SEEK_END)
+
+        self._meta_index_handle = BlockHandle.from_stream(f)
+        self._index_handle = BlockHandle.from_stream(f)
+        f.seek(-8, os.SEEK_END)
+        magic, = struct.unpack("<Q", f.read(8))
         if magic != LdbFile.MAGIC:
-            raise ValueError(f"Invalid magic number in {file}")
+            raise ValueError(f"Invalid magic number in {self.path}")
 
-        self._index = self._read_index()
+        index = self._read_index()
+        self._index_user_keys = [_strip_tag(block_key) for block_key, _ in index]
+        self._filter = self._read_filter()
+        self._index = index
 
-    def _read_block(self, handle: BlockHandle):
+    def _read_raw_block(self, handle: BlockHandle) -> typing.Tuple[bytes, bool]:
         # block is the size in the blockhandle plus the trailer
         # the trailer is 5 bytes long.
         # idx  size  meaning
         # 0    1     CompressionType (0 = none, 1 = snappy)
         # 1    4     CRC32
 
-        self._f.seek(handle.offset)
-        raw_block = self._f.read(handle.length)
-        trailer = self._f.read(LdbFile.BLOCK_TRAILER_SIZE)
+        f = self._f
+        f.seek(handle.offset)
+        raw_block = f.read(handle.length)
+        trailer = f.read(LdbFile.BLOCK_TRAILER_SIZE)
 
         if len(raw_block) != handle.length or len(trailer) != LdbFile.BLOCK_TRAILER_SIZE:
             raise ValueError(f"Could not read all of the block at offset {handle.offset} in file {self.path}")
 
         is_compressed = trailer[0] != 0
         if is_compressed:
-            with io.BytesIO(raw_block) as buff:
-                raw_block = ccl_simplesnappy.decompress(buff)
+            raw_block = ccl_simplesnappy.decompress_buffer(raw_block)
+
+        return raw_block, is_compressed
 
+    def _read_block(self, handle: BlockHandle) -> Block:
+        raw_block, is_compressed = self._read_raw_block(handle)
         return Block(raw_block, is_compressed, self, handle.offset)
 
+    def _read_filter(self) -> typing.Optional[BloomFilterBlock]:
+        # the meta index block maps meta block names to their handles; only the bloom filter is understood
+        if self._meta_index_handle.length == 0:
+            return None
+        try:
+            for entry in self._read_block(self._meta_index_handle):
+                if entry.key == BloomFilterBlock.NAME:
+                    raw_filter, _ = self._read_raw_block(BlockHandle.from_bytes(entry.value))
+                    return BloomFilterBlock(raw_filter)
+        except ValueError:
+            pass  # a damaged filter shouldn't stop the table being read, lookups just can't skip blocks
+        return None
+
+    def _read_cached_block(self, handle: BlockHandle) -> Block:
+        # point and range lookups go through the block cache; full iteration doesn't, so it can't flush the cache
+        cache_key = (self.path, handle.offset)
+        block = self._block_cache.get(cache_key)
+        if block is None:
+            block = self._read_block(handle)
+            self._block_cache.put(cache_key, block)
+        return block
+
     def _read_index(self) -> typing.Tuple[typing.Tuple[bytes, BlockHandle], ...]:
         index_block = self._read_block(self._index_handle)
         # key is earliest key, value is BlockHandle to that data block
         return tuple((entry.key, BlockHandle.from_bytes(entry.value))
                      for entry in index_block)
 
+    def _block_records(self, block: Block, entries=None) -> typing.Iterable[Record]:
+        path = self.path
+        offset = block.offset
+        was_compressed = block.was_compressed
+        for key, value, block_offset in (entries if entries is not None else block.iterate_entry_views()):
+            yield Record.ldb_record(
+                key, bytes(value), path, offset if was_compressed else offset + block_offset, was_compressed)
+
     def __iter__(self) -> typing.Iterable[Record]:
         """Iterate Records in this Table file"""
+        self._load()
         for block_key, handle in self._index:
-            block = self._read_block(handle)
-            for entry in block:
-                yield Record.ldb_record(
-                    entry.key, entry.value, self.path,
-                    block.offset if block.was_compressed else block.offset + entry.block_offset,
-                    block.was_compressed)
+            yield from self._block_records(self._read_block(handle))
+
+    def get(self, key: bytes) -> typing.Optional[Record]:
+        """Returns the newest Record for the user key in this Table file (which may be a deletion), or None.
+        Only the single data block which could contain the key is read, and not even that if the table's bloom
+        filter shows the block can't contain the key."""
+        self._load()
+        i = bisect.bisect_left(self._index_user_keys, key)
+        if i >= len(self._index):
+            return None
+
+        handle = self._index[i][1]
+        if self._filter is not None:
+            self.filter_stats.checks += 1
+            if not self._filter.key_may_match(handle.offset, key):
+                self.filter_stats.negatives += 1
+                return None
+
+        for record in self.iter_range(key):
+            if record.user_key == key:
+                return record
+            break
+        if self._filter is not None:
+            self.filter_stats.false_positives += 1
+        return None
+
+    def iter_range(self, start: bytes, end: bytes = None) -> typing.Iterable[Record]:
+        """Iterate Records in this Table file whose user key is >= start and < end (or to the end of the file if
+        end is None), in key order. The index block and then the first block's restart array are binary searched
+        to find the first record."""
+        self._load()
+        i = bisect.bisect_left(self._index_user_keys, start)
+        for n, (block_key, handle) in enumerate(self._index[i:]):
+            block = self._read_cached_block(handle)
+            entries = block.seek(start) if n == 0 else None
+            for record in self._block_records(block, entries):
+                if end is not None and record.user_key >= end:
+                    return
+                yield record
+
+    def iterate_records_in_key_range(
+            self, start, end, *, key_func: typing.Callable[[bytes], typing.Any] = None) -> typing.Iterable[Record]:
+        """Iterate Records in this Table file whose key_func(user_key) falls in [start, end).
+        key_func defaults to the user key itself (the bytewise comparator); databases using another comparator
+        (e.g. IndexedDB's idb_cmp1) can supply a function mapping a user key to a value that sorts in the same
+        order. The keys in the index block are used to skip data blocks which cannot contain a matching key."""
+        if key_func is None:
+            yield from self.iter_range(start, end)
+            return
+        self._load()
+        previous_block_key = None
+        for block_key, handle in self._index:
+            # each index key is >= every key in its block and < every key in the following block
+            if previous_block_key is not None and key_func(_strip_tag(previous_block_key)) >= end:
+                break
+            previous_block_key = block_key
+            if key_func(_strip_tag(block_key)) < start:
+                continue
+            for record in self._block_records(self._read_cached_block(handle)):
+                if start <= key_func(record.user_key) < end:
+                    yield record
 
     def close(self):
-        self._f.close()
+        self._handle_pool.release(self.path)
+
+
+class RecordBatch:
+    """A run of records held as columns rather than as a Record object each.
+
+    The raw key (as Record.key) and value of every record are packed end to end into one bytes arena: record i's key
+    is arena[bounds[2 * i]:bounds[2 * i + 1]] and its value arena[bounds[2 * i + 1]:bounds[2 * i + 2]]; the user key
+    ends at user_key_ends[i]. The remaining fields are NumPy columns: seq, state (KeyState values), file_id (an index
+    into files / file_types), offset and was_compressed. Batches are picklable, and Record objects are only made if
+    the batch is iterated."""
+    def __init__(self, files: typing.Sequence[pathlib.Path], file_types: typing.Sequence[FileType], arena: bytes,
+                 bounds: np.ndarray, user_key_ends: np.ndarray, seq: np.ndarray, state: np.ndarray,
+                 file_id: np.ndarray, offset: np.ndarray, was_compressed: np.ndarray):
+        self.files = tuple(files)
+        self.file_types = tuple(file_types)
+        self.arena = arena
+        self.bounds = bounds
+        self.user_key_ends = user_key_ends
+        self.seq = seq
+        self.state = state
+        self.file_id = file_id
+        self.offset = offset
+        self.was_compressed = was_compressed
+
+    def __len__(self):
+        return len(self.seq)
+
+    @property
+    def key_starts(self) -> np.ndarray:
+        return self.bounds[0:-1:2]
+
+    @property
+    def value_starts(self) -> np.ndarray:
+        return self.bounds[1::2]
+
+    @property
+    def value_ends(self) -> np.ndarray:
+        return self.bounds[2::2]
+
+    def key(self, i: int) -> bytes:
+        return self.arena[self.bounds[2 * i]:self.bounds[2 * i + 1]]
+
+    def user_key(self, i: int) -> bytes:
+        return self.arena[self.bounds[2 * i]:self.user_key_ends[i]]
+
+    def value(self, i: int) -> bytes:
+        return self.arena[self.bounds[2 * i + 1]:self.bounds[2 * i + 2]]
+
+    def _decode_slices(self, starts, ends, encoding, errors) -> typing.List[str]:
+        if codecs.lookup(encoding).name == "iso8859-1":
+            # single byte encodings map each byte to one character, so the arena is decoded once and sliced
+            text = self.arena.decode(encoding, errors)
+            return [text[a:b] for a, b in zip(starts.tolist(), ends.tolist())]
+        arena = self.arena
+        return [arena[a:b].decode(encoding, errors) for a, b in zip(starts.tolist(), ends.tolist())]
+
+    def user_key_strings(self, encoding="iso-8859-1", errors="replace") -> typing.List[str]:
+        return self._decode_slices(self.key_starts, self.user_key_ends, encoding, errors)
+
+    def value_strings(self, encoding="iso-8859-1", errors="replace") -> typing.List[str]:
+        return self._decode_slices(self.value_starts, self.value_ends, encoding, errors)
+
+    def state_names(self) -> np.ndarray:
+        return np.array([state.name for state in KeyState], dtype=object)[self.state]
+
+    def file_paths(self) -> np.ndarray:
+        return np.array([str(file) for file in self.files], dtype=object)[self.file_id]
+
+    def file_type_names(self) -> np.ndarray:
+        return np.array([file_type.name for file_type in self.file_types], dtype=object)[self.file_id]
+
+    def __iter__(self) -> typing.Iterable[Record]:
+        arena = self.arena
+        bounds = self.bounds.tolist()
+        states = list(KeyState)
+        for i, (seq, state, file_id, offset, was_compressed) in enumerate(zip(
+                self.seq.tolist(), self.state.tolist(), self.file_id.tolist(), self.offset.tolist(),
+                self.was_compressed.tolist())):
+            yield Record(arena[bounds[2 * i]:bounds[2 * i + 1]], arena[bounds[2 * i + 1]:bounds[2 * i + 2]], seq,
+                         states[state], self.file_types[file_id], self.files[file_id], offset, was_compressed)
+
+
+class RecordBatchBuilder:
+    """Accumulates records into array.array columns and a bytearray arena, then builds a RecordBatch from them.
+    Table files are read straight from their blocks' entries so no Record objects are created for them."""
+    def __init__(self):
+        self._files = []
+        self._file_types = []
+        self._arena = bytearray()
+        self._bounds = array.array("q", [0])
+        self._user_key_ends = array.array("q")
+        self._seq = array.array("Q")
+        self._state = bytearray()
+        self._file_id = array.array("I")
+        self._offset = array.array("Q")
+        self._was_compressed = bytearray()
+
+    def __len__(self):
+        return len(self._seq)
+
+    def _add_file(self, path: pathlib.Path, file_type: FileType) -> int:
+        self._files.append(path)
+        self._file_types.append(file_type)
+        return len(self._files) - 1
+
+    def _append(self, key: bytes, user_key_length: int, value, seq: int, state: int, file_id: int, offset: int,
+                was_compressed: bool):
+        arena = self._arena
+        key_start = len(arena)
+        arena += key
+        self._user_key_ends.append(key_start + user_key_length)
+        self._bounds.append(len(arena))
+        arena += value
+        self._bounds.append(len(arena))
+        self._seq.append(seq)
+        self._state.append(state)
+        self._file_id.append(file_id)
+        self._offset.append(offset)
+        self._was_compressed.append(was_compressed)
+
+    def add_table(self, table: "LdbFile"):
+        """Appends every record of a table file, straight from its blocks' entries"""
+        file_id = self._add_file(table.path, FileType.Ldb)
+        live, deleted, unknown = KeyState.Live.value, KeyState.Deleted.value, KeyState.Unknown.value
+        table._load()
+        for block_key, handle in table._index:
+            block = table._read_block(handle)
+            offset = block.offset
+            was_compressed = block.was_compressed
+            for key, value, block_offset in block.iterate_entry_views():
+                # as Record.ldb_record and Record.user_key
+                key_length = len(key)
+                seq = int.from_bytes(key[-8:], "little") >> 8
+                state = (deleted if key[-8] == 0 else live) if key_length > 8 else unknown
+                self._append(key, key_length - 8 if key_length >= 8 else key_length, value, seq, state, file_id,
+                             offset if was_compressed else offset + block_offset, was_compressed)
+
+    def add_records(self, path: pathlib.Path, file_type: FileType, records: typing.Iterable[Record]):
+        """Appends Records from any source (e.g. a LogFile), attributed to path"""
+        file_id = self._add_file(path, file_type)
+        for record in records:
+            self._append(record.key, len(record.user_key), record.value, record.seq, record.state.value, file_id,
+                         record.offset, record.was_compressed)
+
+    def build(self) -> RecordBatch:
+        """Returns a RecordBatch of everything appended so far and resets the builder"""
+        batch = RecordBatch(
+            self._files, self._file_types, bytes(self._arena),
+            np.frombuffer(self._bounds, dtype=np.int64).copy(),
+            np.frombuffer(self._user_key_ends, dtype=np.int64).copy(),
+            np.frombuffer(self._seq, dtype=np.uint64).copy(),
+            np.frombuffer(self._state, dtype=np.uint8).copy(),
+            np.frombuffer(self._file_id, dtype=np.uint32).copy(),
+            np.frombuffer(self._offset, dtype=np.uint64).copy(),
+            np.frombuffer(self._was_compressed, dtype=np.bool_).copy())
+        self.__init__()
+        return batch
+
+
+def _read_table_batch(path: pathlib.Path) -> RecordBatch:
+    # process pool entry point; must be importable at module level
+    builder = RecordBatchBuilder()
+    table = LdbFile(path)
+    try:
+        builder.add_table(table)
+    finally:
+        table.close()
+    return builder.build()
 
 
 class LogEntryType(enum.IntEnum):
@@ -272,69 +787,110 @@ class LogEntryType(enum.IntEnum):
     Last = 4
 
 
-class LogFile:
-    """A levelDb log (.log) file"""
+@dataclasses.dataclass(frozen=True)
+class LogBatch:
+    """A batch reassembled from one or more fragments of a log format file.
+    offset is the file offset of the batch's first byte; fragment_starts and fragment_offsets hold the position in
+    data, and the file offset, at which each fragment begins."""
+    offset: int
+    data: bytes
+    fragment_starts: typing.Tuple[int, ...]
+    fragment_offsets: typing.Tuple[int, ...]
+
+    def file_offset(self, batch_offset: int) -> int:
+        """Maps a position in data to its offset in the file, skipping over the fragment headers and block trailers
+        which separate the fragments in the file"""
+        i = bisect.bisect_right(self.fragment_starts, batch_offset) - 1
+        return self.fragment_offsets[i] + batch_offset - self.fragment_starts[i]
+
+
+class LogReader:
+    """
+    Reads the batches from a file in the log format shared by .log and MANIFEST files, over an mmap of the file.
+    Fragments are collected and joined once per batch, and each batch carries its exact file offsets.
+    See: https://github.com/google/leveldb/blob/master/doc/log_format.md
+    """
     LOG_ENTRY_HEADER_SIZE = 7
     LOG_BLOCK_SIZE = 32768
 
-    def __init__(self, file: pathlib.Path):
+    def __init__(self, f: typing.BinaryIO, path: os.PathLike):
+        self._f = f
+        self.path = path
+
+    def __iter__(self) -> typing.Iterable[LogBatch]:
+        size = os.fstat(self._f.fileno()).st_size
+        if size == 0:
+            return  # empty files can't be mapped
+
+        with mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            fragments = []
+            pos = 0
+            while pos + LogReader.LOG_ENTRY_HEADER_SIZE <= size:
+                block_remaining = LogReader.LOG_BLOCK_SIZE - (pos % LogReader.LOG_BLOCK_SIZE)
+                if block_remaining < LogReader.LOG_ENTRY_HEADER_SIZE:
+                    pos += block_remaining  # block trailer
+                    continue
+
+                crc, length, block_type = struct.unpack_from("<IHB", mm, pos)
+                data_offset = pos + LogReader.LOG_ENTRY_HEADER_SIZE
+                pos = data_offset + length
+
+                if block_type == LogEntryType.Full:
+                    if fragments:
+                        raise ValueError(f"Full block whilst still building a block at offset "
+                                         f"{data_offset} in {self.path}")
+                    yield LogBatch(data_offset, mm[data_offset:pos], (0,), (data_offset,))
+                elif block_type == LogEntryType.First:
+                    if fragments:
+                        raise ValueError(f"First block whilst still building a block at offset "
+                                         f"{data_offset} in {self.path}")
+                    fragments.append((data_offset, mm[data_offset:pos]))
+                elif block_type == LogEntryType.Middle:
+                    if not fragments:
+                        raise ValueError(f"Middle block whilst not building a block at offset "
+                                         f"{data_offset} in {self.path}")
+                    fragments.append((data_offset, mm[data_offset:pos]))
+                elif block_type == LogEntryType.Last:
+                    if not fragments:
+                        raise ValueError(f"Last block whilst not building a block at offset "
+                                         f"{data_offset} in {self.path}")
+                    fragments.append((data_offset, mm[data_offset:pos]))
+                    starts = tuple(itertools.accumulate((len(data) for _, data in fragments[:-1]), initial=0))
+                    yield LogBatch(fragments[0][0], b"".join(data for _, data in fragments),
+                                   starts, tuple(offset for offset, _ in fragments))
+                    fragments = []
+                elif block_type == LogEntryType.Zero and length == 0:
+                    # preallocated (zeroed) space; nothing more in this block
+                    pos = data_offset - LogReader.LOG_ENTRY_HEADER_SIZE + block_remaining
+                else:
+                    raise ValueError(f"Invalid log entry type {block_type} at offset "
+                                     f"{data_offset - LogReader.LOG_ENTRY_HEADER_SIZE} in {self.path}")
+
+
+class LogFile:
+    """A levelDb log (.log) file. The file is only opened when it is first read."""
+    LOG_ENTRY_HEADER_SIZE = LogReader.LOG_ENTRY_HEADER_SIZE
+    LOG_BLOCK_SIZE = LogReader.LOG_BLOCK_SIZE
+
+    def __init__(self, file: pathlib.Path, *, handle_pool: FileHandlePool = None):
         if not file.exists():
             raise FileNotFoundError(file)
 
         self.path = file
-        self.file_no = int(file.stem, 16)
-
-        self._f = file.open("rb")
-
-    def _get_raw_blocks(self) -> typing.Iterable[bytes]:
-        self._f.seek(0)
-
-        while chunk := self._f.read(LogFile.LOG_BLOCK_SIZE):
-            yield chunk
-
-    def _get_batches(self) -> typing.Iterable[typing.Tuple[int, bytes]]:
-        in_record = False
-        start_block_offset = 0
-        block = b""
-        for idx, chunk_ in enumerate(self._get_raw_blocks()):
-            with io.BytesIO(chunk_) as buff:
-                while buff.tell() < LogFile.LOG_BLOCK_SIZE - 6:
-                    header = buff.read(7)
-                    if len(header) < 7:
-                        break
-                    crc, length, block_type = struct.unpack("<IHB", header)
-
-                    if block_type == LogEntryType.Full:
-                        if in_record:
-                            raise ValueError(f"Full block whilst still building a block at offset "
-                                             f"{idx * LogFile.LOG_BLOCK_SIZE + buff.tell()} in {self.path}")
-                        in_record = False
-                        yield idx * LogFile.LOG_BLOCK_SIZE + buff.tell(), buff.read(length)
-                    elif block_type == LogEntryType.First:
-                        if in_record:
-                            raise ValueError(f"First block whilst still building a block at offset "
-                                             f"{idx * LogFile.LOG_BLOCK_SIZE + buff.tell()} in {self.path}")
-                        start_block_offset = idx * LogFile.LOG_BLOCK_SIZE + buff.tell()
-                        block = buff.read(length)
-                        in_record = True
-                    elif block_type == LogEntryType.Middle:
-                        if not in_record:
-                            raise ValueError(f"Middle block whilst not building a block at offset "
-                                             f"{idx * LogFile.LOG_BLOCK_SIZE + buff.tell()} in {self.path}")
-                        block += buff.read(length)
-                    elif block_type == LogEntryType.Last:
-                        if not in_record:
-                            raise ValueError(f"Last block whilst not building a block at offset "
-                                             f"{idx * LogFile.LOG_BLOCK_SIZE + buff.tell()} in {self.path}")
-                        block += buff.read(length)
-                        in_record = False
-                        yield start_block_offset * LogFile.LOG_BLOCK_SIZE, block
-                    else:
-                        raise ValueError()  # Cannot happen
+        self.file_no = int(file.stem)  # leveldb file numbers are decimal, as in the manifest
+        self._handle_pool = handle_pool if handle_pool is not None else FileHandlePool(1)
+
+    @property
+    def _f(self) -> typing.BinaryIO:
+        return self._handle_pool.get(self.path)
+
+    def _get_batches(self) -> typing.Iterable[LogBatch]:
+        # the handle is only fetched once iteration starts; the mmap keeps its own reference to the file after that
+        yield from LogReader(self._f, self.path)
 
     def __iter__(self) -> typing.Iterable[Record]:
         """Iterate Records in this Log file"""
-        for batch_offset, batch in self._get_batches():
+        for log_batch in self._get_batches():
             # as per write_batch and write_batch_internal
             # offset       length      description
             # 0            8           (u?)int64 Sequence number
@@ -348,12 +904,12 @@ class LogFile:
             # ...          1-4         VarInt32 length of value
             # ...          ...         Value data
 
-            with io.BytesIO(batch) as buff:  # it's just easier this way
+            with io.BytesIO(log_batch.data) as buff:  # it's just easier this way
                 header = buff.read(12)
                 seq, count = struct.unpack("<QI", header)
 
                 for i in range(count):
-                    start_offset = batch_offset + buff.tell()
+                    start_offset = log_batch.file_offset(buff.tell())
                     state = KeyState(buff.read(1)[0])
                     key_length = read_le_varint(buff, is_google_32bit=True)
                     key = buff.read(key_length)
@@ -366,8 +922,17 @@ class LogFile:
 
                     yield Record.log_record(key, value, seq + i, state, self.path, start_offset)
 
+    def iterate_records_in_key_range(
+            self, start, end, *, key_func: typing.Callable[[bytes], typing.Any] = None) -> typing.Iterable[Record]:
+        """Iterate Records in this Log file whose key_func(user_key) falls in [start, end).
+        Log files are not sorted so every record is checked; see LdbFile.iterate_records_in_key_range"""
+        key_func = key_func or _identity
+        for record in self:
+            if start <= key_func(record.user_key) < end:
+                yield record
+
     def close(self):
-        self._f.close()
+        self._handle_pool.release(self.path)
 
 
 class VersionEditTag(enum.IntEnum):
@@ -475,90 +1040,189 @@ class ManifestFile:
         self.path = path
 
         self.file_to_level = {}
+        self.comparator = None  # the name of the comparator the keys are sorted with
         for edit in self:
+            if edit.comparator is not None:
+                self.comparator = edit.comparator
             if edit.new_files:
                 for nf in edit.new_files:
                     self.file_to_level[nf.file_no] = nf.level
 
         self.file_to_level = MappingProxyType(self.file_to_level)
 
-    def _get_raw_blocks(self) -> typing.Iterable[bytes]:
-        self._f.seek(0)
-
-        while chunk := self._f.read(LogFile.LOG_BLOCK_SIZE):
-            yield chunk
-
-    def _get_batches(self) -> typing.Iterable[typing.Tuple[int, bytes]]:
-        in_record = False
-        start_block_offset = 0
-        block = b""
-        for idx, chunk_ in enumerate(self._get_raw_blocks()):
-            with io.BytesIO(chunk_) as buff:
-                while buff.tell() < LogFile.LOG_BLOCK_SIZE - 6:
-                    header = buff.read(7)
-                    if len(header) < 7:
-                        break
-                    crc, length, block_type = struct.unpack("<IHB", header)
-
-                    if block_type == LogEntryType.Full:
-                        if in_record:
-                            raise ValueError(f"Full block whilst still building a block at offset "
-                                             f"{idx * LogFile.LOG_BLOCK_SIZE + buff.tell()} in {self.path}")
-                        in_record = False
-                        yield idx * LogFile.LOG_BLOCK_SIZE + buff.tell(), buff.read(length)
-                    elif block_type == LogEntryType.First:
-                        if in_record:
-                            raise ValueError(f"First block whilst still building a block at offset "
-                                             f"{idx * LogFile.LOG_BLOCK_SIZE + buff.tell()} in {self.path}")
-                        start_block_offset = idx * LogFile.LOG_BLOCK_SIZE + buff.tell()
-                        block = buff.read(length)
-                        in_record = True
-                    elif block_type == LogEntryType.Middle:
-                        if not in_record:
-                            raise ValueError(f"Middle block whilst not building a block at offset "
-                                             f"{idx * LogFile.LOG_BLOCK_SIZE + buff.tell()} in {self.path}")
-                        block += buff.read(length)
-                    elif block_type == LogEntryType.Last:
-                        if not in_record:
-                            raise ValueError(f"Last block whilst not building a block at offset "
-                                             f"{idx * LogFile.LOG_BLOCK_SIZE + buff.tell()} in {self.path}")
-                        block += buff.read(length)
-                        in_record = False
-                        yield start_block_offset * LogFile.LOG_BLOCK_SIZE, block
-                    else:
-                        raise ValueError()  # Cannot happen
+    def _get_batches(self) -> typing.Iterable[LogBatch]:
+        return LogReader(self._f, self.path)
 
     def __iter__(self):
-        for batch_offset, batch in self._get_batches():
-            yield VersionEdit.from_buffer(batch)
+        for batch in self._get_batches():
+            yield VersionEdit.from_buffer(batch.data)
 
     def close(self):
         self._f.close()
 
 
+class SequenceIndex:
+    """
+    Every version of every key in a database, indexed by sequence number so that the state of the database at any
+    earlier point can be reconstructed without re-parsing its files.
+
+    Versions are held in flat NumPy arrays sorted by key then sequence number (with offsets into one arena holding
+    the values as they were read) rather than as a Record per version; each key's versions are a contiguous run of
+    those arrays.
+    """
+    def __init__(self, records: typing.Iterable[Record],
+                 timestamp_func: typing.Callable[[Record], typing.Any] = None):
+        """records are typically RawLevelDb.iterate_records_raw(). timestamp_func, if given, is called for each
+        record and may return a timestamp for the write (e.g. from a last-modified field in its value); these become
+        the anchors used by seq_for_timestamp."""
+        key_ids = {}
+        version_key_ids = array.array("I")
+        seqs = array.array("Q")
+        states = array.array("B")
+        value_offsets = array.array("Q")
+        arena = bytearray()
+        write_times = []
+
+        for record in records:
+            key_id = key_ids.setdefault(record.user_key, len(key_ids))
+            version_key_ids.append(key_id)
+            seqs.append(record.seq)
+            states.append(record.state.value)
+            value_offsets.append(len(arena))
+            arena += record.value
+            if timestamp_func is not None:
+                timestamp = timestamp_func(record)
+                if timestamp is not None:
+                    write_times.append((timestamp, record.seq))
+        value_offsets.append(len(arena))
+
+        self._keys = sorted(key_ids)
+        key_rank = np.empty(len(key_ids), dtype=np.uint32)
+        key_rank[np.fromiter((key_ids[key] for key in self._keys), dtype=np.uint32, count=len(key_ids))] = \
+            np.arange(len(key_ids), dtype=np.uint32)
+        del key_ids
+
+        # sort by (key, seq); lexsort is stable, so of a version found in more than one file the first read is kept
+        ranks = key_rank[np.frombuffer(version_key_ids, dtype=np.uint32)]
+        seqs = np.frombuffer(seqs, dtype=np.uint64)
+        order = np.lexsort((seqs, ranks))
+        ranks, seqs = ranks[order], seqs[order]
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = (ranks[1:] != ranks[:-1]) | (seqs[1:] != seqs[:-1])
+        order, ranks = order[keep], ranks[keep]
+
+        value_offsets = np.frombuffer(value_offsets, dtype=np.uint64)
+        self._seqs = seqs[keep]
+        self._states = np.frombuffer(states, dtype=np.uint8)[order]
+        self._value_starts = value_offsets[order]
+        self._value_ends = value_offsets[order + 1]
+        self._arena = arena
+        # each key's versions are the run self._key_starts[rank]:self._key_starts[rank + 1]
+        self._key_starts = np.concatenate(([0], np.flatnonzero(ranks[1:] != ranks[:-1]) + 1, [len(order)]))
+
+        write_times.sort()
+        self._write_times = [timestamp for timestamp, _ in write_times]
+        self._write_seqs = list(itertools.accumulate((seq for _, seq in write_times), max))
+
+    def __len__(self):
+        """The number of versions held"""
+        return len(self._seqs)
+
+    @property
+    def keys(self) -> typing.Sequence[bytes]:
+        return self._keys
+
+    @property
+    def max_seq(self) -> int:
+        return int(self._seqs.max()) if len(self._seqs) else 0
+
+    def _value(self, i) -> bytes:
+        return bytes(self._arena[self._value_starts[i]:self._value_ends[i]])
+
+    def _key_range(self, key: bytes) -> typing.Tuple[int, int]:
+        rank = bisect.bisect_left(self._keys, key)
+        if rank == len(self._keys) or self._keys[rank] != key:
+            return 0, 0
+        return int(self._key_starts[rank]), int(self._key_starts[rank + 1])
+
+    def _version_at(self, start: int, end: int, seq: int) -> typing.Optional[bytes]:
+        # the value of the newest version with a sequence number <= seq, or None if that is a deletion
+        i = start + int(np.searchsorted(self._seqs[start:end], seq, side="right")) - 1
+        if i < start or self._states[i] == KeyState.Deleted.value:
+            return None
+        return self._value(i)
+
+    def versions(self, key: bytes) -> typing.List[typing.Tuple[int, KeyState, bytes]]:
+        """Every version of the key as (seq, state, value), oldest first"""
+        start, end = self._key_range(key)
+        return [(int(self._seqs[i]), KeyState(self._states[i]), self._value(i)) for i in range(start, end)]
+
+    def get_at(self, key: bytes, seq: int) -> typing.Optional[bytes]:
+        """The value of the key as it was at sequence number seq, or None if it didn't exist then"""
+        start, end = self._key_range(key)
+        return self._version_at(start, end, seq)
+
+    def state_at(self, seq: int) -> typing.Dict[bytes, bytes]:
+        """The key/values of the database as they were at sequence number seq"""
+        state = {}
+        for rank, key in enumerate(self._keys):
+            value = self._version_at(int(self._key_starts[rank]), int(self._key_starts[rank + 1]), seq)
+            if value is not None:
+                state[key] = value
+        return state
+
+    def seq_for_timestamp(self, timestamp) -> typing.Optional[int]:
+        """The highest sequence number written at or before timestamp, according to the timestamps returned by
+        timestamp_func; None if no known write is that old"""
+        i = bisect.bisect_right(self._write_times, timestamp)
+        return self._write_seqs[i - 1] if i else None
+
+    def state_at_time(self, timestamp) -> typing.Dict[bytes, bytes]:
+        """The key/values of the database as they were at timestamp; see seq_for_timestamp"""
+        seq = self.seq_for_timestamp(timestamp)
+        return self.state_at(seq) if seq is not None else {}
+
+
 class RawLevelDb:
     DATA_FILE_PATTERN = r"[0-9]{6}\.(ldb|log|sst)"
+    BYTEWISE_COMPARATOR = "leveldb.BytewiseComparator"
 
-    def __init__(self, in_dir: os.PathLike):
+    def __init__(self, in_dir: os.PathLike, *, block_cache_size: int = BlockCache.DEFAULT_CAPACITY,
+                 max_open_files: int = FileHandlePool.DEFAULT_MAX_OPEN):
+        """Files are only opened (and the manifest only parsed) when they are first read; at most max_open_files
+        are held open at once."""
 
         self._in_dir = pathlib.Path(in_dir)
         if not self._in_dir.is_dir():
             raise ValueError("in_dir is not a directory")
 
+        # shared between all of the table files so repeated lookups don't decompress blocks again
+        self.block_cache = BlockCache(block_cache_size)
+        self.filter_stats = BloomFilterStats()
+        self.handle_pool = FileHandlePool(max_open_files)
+
         self._files = []
         latest_manifest = (0, None)
         for file in self._in_dir.iterdir():
             if file.is_file() and re.match(RawLevelDb.DATA_FILE_PATTERN, file.name):
                 if file.suffix.lower() == ".log":
-                    self._files.append(LogFile(file))
+                    self._files.append(LogFile(file, handle_pool=self.handle_pool))
                 elif file.suffix.lower() == ".ldb" or file.suffix.lower() == ".sst":
-                    self._files.append(LdbFile(file))
+                    self._files.append(LdbFile(file, block_cache=self.block_cache, filter_stats=self.filter_stats,
+                                               handle_pool=self.handle_pool))
             if file.is_file() and re.match(ManifestFile.MANIFEST_FILENAME_PATTERN, file.name):
                 manifest_no = int(re.match(ManifestFile.MANIFEST_FILENAME_PATTERN, file.name).group(1), 16)
                 if latest_manifest[0] < manifest_no:
                     latest_manifest = (manifest_no, file)
 
-        self.manifest = ManifestFile(latest_manifest[1]) if latest_manifest[1] is not None else None
+        self._manifest_path = latest_manifest[1]
+        self._manifest = None
+
+    @property
+    def manifest(self) -> typing.Optional[ManifestFile]:
+        if self._manifest is None and self._manifest_path is not None:
+            self._manifest = ManifestFile(self._manifest_path)
+        return self._manifest
 
     def __enter__(self):
         return self
@@ -570,12 +1234,179 @@ class RawLevelDb:
     def in_dir_path(self) -> pathlib.Path:
         return self._in_dir
 
+    @property
+    def comparator(self) -> typing.Optional[str]:
+        """The name of the comparator in the manifest (None without a manifest)"""
+        return self.manifest.comparator if self.manifest else None
+
+    def _merge_key_func(self, key_func) -> typing.Callable[[bytes], typing.Any]:
+        # merging files by key must follow the database's comparator; bytes order is only right for the bytewise one
+        if key_func is not None:
+            return key_func
+        if self.comparator not in (None, RawLevelDb.BYTEWISE_COMPARATOR):
+            raise ValueError(f"Database keys are sorted with the {self.comparator!r} comparator; "
+                             f"a key_func which sorts user keys in the same order is required")
+        return _identity
+
     def iterate_records_raw(self, *, reverse=False) -> typing.Iterable[Record]:
         for file_containing_records in sorted(self._files, reverse=reverse, key=lambda x: x.file_no):
             yield from file_containing_records
 
+    def iterate_records_resolved(
+            self, *, key_func: typing.Callable[[bytes], typing.Any] = None) -> typing.Iterable[Record]:
+        """Iterate the current ("live") state of the database in user key order: only the newest version of each
+        key is yielded, and keys whose newest version is a deletion are omitted.
+        Keys are ordered by key_func(user_key), which defaults to the user key itself (the bytewise comparator); a
+        database using another comparator (e.g. IndexedDB's idb_cmp1) needs a key_func which sorts every key in
+        exactly its order (a coarser key, such as one for range scans, is not enough), and ValueError is raised
+        without one.
+        The sorted table files are streamed and k-way merged with the log files' records (sorted in memory, logs
+        are bounded by the write buffer size) by user key then descending sequence number, so memory use doesn't
+        grow with the size of the database. Where the same version of a key is found in more than one file, the
+        log files win, then tables by their level in the manifest, with tables unknown to the manifest last."""
+        key_func = self._merge_key_func(key_func)
+        file_to_level = self.manifest.file_to_level if self.manifest else {}
+        unknown_level = max(file_to_level.values(), default=0) + 1
+
+        def rank(file):
+            if isinstance(file, LogFile):
+                return -1, -file.file_no
+            return file_to_level.get(file.file_no, unknown_level), -file.file_no
+
+        def merge_key(r):
+            return key_func(r.user_key), -r.seq
+
+        streams = []
+        for file in sorted(self._files, key=rank):
+            if isinstance(file, LogFile):
+                streams.append(sorted(file, key=merge_key))
+            else:
+                streams.append(iter(file))
+
+        # heapq.merge breaks ties by stream order, which is the rank order above
+        previous_key = None
+        for record in heapq.merge(*streams, key=merge_key):
+            user_key = record.user_key
+            if user_key == previous_key:
+                continue
+            previous_key = user_key
+            if record.state != KeyState.Deleted:
+                yield record
+
+    def _file_batch(self, file) -> RecordBatch:
+        builder = RecordBatchBuilder()
+        if isinstance(file, LdbFile):
+            builder.add_table(file)
+        else:
+            builder.add_records(file.path, FileType.Log, file)
+        return builder.build()
+
+    def _iterate_file_batches(self, files, workers: int) -> typing.Iterable[RecordBatch]:
+        # one RecordBatch per file, in the order given; tables are read in a process pool when workers > 1
+        table_count = sum(1 for file in files if isinstance(file, LdbFile))
+        if workers <= 1 or table_count < 2:
+            for file in files:
+                yield self._file_batch(file)
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, table_count)) as executor:
+            # keep a bounded window of tables in flight ahead of the one being yielded
+            window = deque()
+            pending = iter(files)
+            window_size = workers * 2
+
+            def fill():
+                while len(window) < window_size:
+                    file = next(pending, None)
+                    if file is None:
+                        return
+                    window.append(executor.submit(_read_table_batch, file.path) if isinstance(file, LdbFile)
+                                  else file)
+
+            fill()
+            while window:
+                item = window.popleft()
+                fill()
+                yield item.result() if isinstance(item, concurrent.futures.Future) else self._file_batch(item)
+
+    def iterate_record_batches(self, *, reverse=False, workers: int = 1) -> typing.Iterable[RecordBatch]:
+        """Iterate every record as iterate_records_raw does, but as one columnar RecordBatch per file, so that no
+        Record objects are created. With workers > 1 (or None for the number of CPUs) the table files are read in
+        a pool of worker processes, as iterate_records_parallel."""
+        files = sorted(self._files, reverse=reverse, key=lambda x: x.file_no)
+        yield from self._iterate_file_batches(files, workers or os.cpu_count() or 1)
+
+    def iterate_records_parallel(self, *, workers: int = None, order="file", reverse=False,
+                                 key_func: typing.Callable[[bytes], typing.Any] = None) -> typing.Iterable[Record]:
+        """Iterate every record, as iterate_records_raw, with the table files decompressed and decoded in a pool of
+        worker processes (log files are read in this process). Each worker returns a whole table as a RecordBatch.
+
+        order="file" yields the same sequence as iterate_records_raw (by file_no, reversed if reverse is set); only
+        a window of a few tables per worker is held in memory at once.
+        order="key" yields every version of every key merged by user key then descending sequence number (the
+        order used by iterate_records_resolved, including its key_func), which requires all of the tables to be
+        read first.
+
+        workers defaults to the number of CPUs; with one worker, or fewer than two tables, no pool is started."""
+        if order not in ("file", "key"):
+            raise ValueError(f"order must be \"file\" or \"key\", not {order!r}")
+        workers = workers or os.cpu_count() or 1
+        files = sorted(self._files, reverse=reverse, key=lambda x: x.file_no)
+        table_count = sum(1 for file in files if isinstance(file, LdbFile))
+
+        if order == "file":
+            if workers <= 1 or table_count < 2:
+                yield from self.iterate_records_raw(reverse=reverse)
+            else:
+                for batch in self._iterate_file_batches(files, workers):
+                    yield from batch
+            return
+
+        key_func = self._merge_key_func(key_func)
+
+        def merge_key(r):
+            return key_func(r.user_key), -r.seq
+
+        streams = [sorted(file, key=merge_key) for file in files if isinstance(file, LogFile)]
+        tables = [file for file in files if isinstance(file, LdbFile)]
+        if workers <= 1 or table_count < 2:
+            streams.extend(iter(table) for table in tables)
+            yield from heapq.merge(*streams, key=merge_key)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, table_count)) as executor:
+                streams.extend(executor.map(_read_table_batch, [table.path for table in tables]))
+                yield from heapq.merge(*streams, key=merge_key)
+
+    def build_sequence_index(self, timestamp_func: typing.Callable[[Record], typing.Any] = None) -> SequenceIndex:
+        """Reads every record once into a SequenceIndex, for reconstructing the database at earlier points"""
+        return SequenceIndex(self.iterate_records_raw(), timestamp_func)
+
+    def iterate_records_in_key_range(
+            self, start, end, *, key_func: typing.Callable[[bytes], typing.Any] = None,
+            reverse=False) -> typing.Iterable[Record]:
+        """Iterate Records whose key_func(user_key) falls in [start, end), in the same file order as
+        iterate_records_raw. Table files use their index blocks to skip data blocks outside of the range."""
+        for file_containing_records in sorted(self._files, reverse=reverse, key=lambda x: x.file_no):
+            yield from file_containing_records.iterate_records_in_key_range(start, end, key_func=key_func)
+
+    def get(self, key: bytes) -> typing.Optional[Record]:
+        """Returns the newest Record for the user key across all of the files (which may be a deletion), or None.
+        Table files are checked with LdbFile.get so their bloom filters let most tables be skipped unread."""
+        newest = None
+        for file in self._files:
+            if isinstance(file, LdbFile):
+                record = file.get(key)
+                if record is not None and (newest is None or record.seq > newest.seq):
+                    newest = record
+            else:
+                for record in file.iterate_records_in_key_range(key, key + b"\x00"):
+                    if newest is None or record.seq > newest.seq:
+                        newest = record
+        return newest
+
     def close(self):
         for file in self._files:
             file.close()
-        if self.manifest:
-            self.manifest.close()
+        self.handle_pool.close()
+        if self._manifest:
+            self._manifest.close()
@@ -21,10 +21,20 @@ SOFTWARE.
 """
 
 import sys
-import struct
-import io
 import typing
-import enum
+
+# an installed snappy binding (cramjam, or python-snappy which wraps it) is used in preference to the
+# pure Python implementation below where one is available
+try:
+    import cramjam
+except ImportError:
+    cramjam = None
+try:
+    import snappy
+    if not hasattr(snappy, "uncompress"):  # an unrelated package named 'snappy'
+        snappy = None
+except ImportError:
+    snappy = None
 
 __version__ = "0.1"
 __description__ = "Pure Python reimplementation of Google's Snappy decompression"
@@ -33,164 +43,148 @@ __contact__ = "Alex Caithness"
 
 DEBUG = False
 
+if cramjam is not None:
+    BACKEND = "cramjam"
+elif snappy is not None:
+    BACKEND = "python-snappy"
+else:
+    BACKEND = "python"
+
 
 def log(msg):
     if DEBUG:
         print(msg)
 
 
-class ElementType(enum.IntEnum):
-    """Run type in the compressed snappy data (literal data or offset to backreferenced data_"""
-    Literal = 0
-    CopyOneByte = 1
-    CopyTwoByte = 2
-    CopyFourByte = 3
-
-
-def _read_le_varint(stream: typing.BinaryIO) -> typing.Optional[typing.Tuple[int, bytes]]:
-    """Read varint from a stream.
-    If the read is successful: returns a tuple of the (unsigned) value and the raw bytes making up that varint,
-    otherwise returns None"""
-    # this only outputs unsigned
-    i = 0
-    result = 0
-    underlying_bytes = []
-    while i < 10:  # 64 bit max possible?
-        raw = stream.read(1)
-        if len(raw) < 1:
-            return None
-        tmp, = raw
-        underlying_bytes.append(tmp)
-        result |= ((tmp & 0x7f) << (i * 7))
-        if (tmp & 0x80) == 0:
+def _decompress_python(buffer: bytes) -> bytes:
+    """Pure Python decompression of a snappy compressed buffer into a preallocated output buffer"""
+    data = bytes(buffer)
+    end = len(data)
+    uncompressed_length = 0
+    pos = 0
+    shift = 0
+    while True:
+        if pos >= end:
+            raise ValueError("Couldn't read uncompressed length")
+        tmp = data[pos]
+        pos += 1
+        uncompressed_length |= (tmp & 0x7f) << shift
+        if not tmp & 0x80:
             break
-        i += 1
-    return result, bytes(underlying_bytes)
-
-
-def read_le_varint(stream: typing.BinaryIO) -> typing.Optional[int]:
-    """Convenience version of _read_le_varint that only returns the value or None"""
-    x = _read_le_varint(stream)
-    if x is None:
-        return None
-    else:
-        return x[0]
+        shift += 7
+    if DEBUG:
+        log(f"Uncompressed length: {uncompressed_length}")
 
+    out = bytearray(uncompressed_length)
+    out_pos = 0
 
-def read_uint16(stream: typing.BinaryIO) -> int:
-    """Reads a Uint16 from stream"""
-    return struct.unpack("<H", stream.read(2))[0]
+    while pos < end:
+        type_byte = data[pos]
+        pos += 1
+        tag = type_byte & 0x03
 
+        if tag == 0:  # literal
+            length = type_byte >> 2
+            if length < 60:  # embedded in tag
+                length += 1
+            else:  # 60-63: length is in the following 1-4 bytes
+                extra = length - 59
+                length = int.from_bytes(data[pos:pos + extra], "little") + 1
+                pos += extra
+            if pos + length > end:
+                raise ValueError("Couldn't read enough literal data")
+            if out_pos + length > uncompressed_length:
+                raise ValueError("Wrong data length in uncompressed data")
+            out[out_pos:out_pos + length] = data[pos:pos + length]
+            pos += length
+            out_pos += length
+            continue
+
+        offset_size = 4 if tag == 3 else tag
+        if pos + offset_size > end:
+            raise ValueError("Couldn't read copy offset")
+        if tag == 1:  # copy with a 1 byte offset
+            length = ((type_byte & 0x1C) >> 2) + 4
+            offset = ((type_byte & 0xE0) << 3) | data[pos]
+            pos += 1
+        elif tag == 2:  # copy with a 2 byte offset
+            length = (type_byte >> 2) + 1
+            offset = data[pos] | (data[pos + 1] << 8)
+            pos += 2
+        else:  # copy with a 4 byte offset
+            length = (type_byte >> 2) + 1
+            offset = int.from_bytes(data[pos:pos + 4], "little")
+            pos += 4
+
+        if offset == 0:
+            raise ValueError("Offset cannot be 0")
+        actual_offset = out_pos - offset
+        if actual_offset < 0:
+            raise ValueError("Backreference before the start of the data")
+        if out_pos + length > uncompressed_length:
+            raise ValueError("Wrong data length in uncompressed data")
+
+        if offset >= length:
+            out[out_pos:out_pos + length] = out[actual_offset:actual_offset + length]
+        else:
+            # the backreference overlaps the data being written, so it repeats the last `offset` bytes
+            pattern = out[actual_offset:out_pos]
+            repeats, remainder = divmod(length, offset)
+            out[out_pos:out_pos + length] = pattern * repeats + pattern[:remainder]
+        out_pos += length
 
-def read_uint24(stream: typing.BinaryIO) -> int:
-    """Reads a Uint24 from stream"""
-    return struct.unpack("<I", stream.read(3) + b"\x00")[0]
+    if uncompressed_length != out_pos:
+        raise ValueError("Wrong data length in uncompressed data")
+        # TODO: allow a partial / potentially bad result via a flag in the function call?
 
+    return bytes(out)
 
-def read_uint32(stream: typing.BinaryIO) -> int:
-    """Reads a Uint32 from stream"""
-    return struct.unpack("<I", stream.read(4))[0]
 
+def _decompress_binding(buffer: bytes) -> bytes:
+    """Decompression using whichever snappy binding is installed"""
+    try:
+        if cramjam is not None:
+            return bytes(cramjam.snappy.decompress_raw(buffer))
+        return snappy.uncompress(buffer)
+    except Exception as e:
+        raise ValueError(f"Could not decompress snappy data: {e}") from e
 
-def read_byte(stream: typing.BinaryIO) -> typing.Optional[int]:
-    """Reads a single byte from stream (or returns None if EOD is met)"""
-    x = stream.read(1)
-    if x:
-        return x[0]
 
-    return None
+def decompress_buffer(buffer: bytes) -> bytes:
+    """Decompresses a buffer of snappy compressed data"""
+    if BACKEND != "python":
+        return _decompress_binding(buffer)
+    return _decompress_python(buffer)
 
 
 def decompress(data: typing.BinaryIO) -> bytes:
     """Decompresses the snappy compressed data stream"""
-    uncompressed_length = read_le_varint(data)
-    log(f"Uncompressed length: {uncompressed_length}")
-
-    out = io.BytesIO()
-
-    while True:
-        start_offset = data.tell()
-        log(f"Reading tag at offset {start_offset}")
-        type_byte = read_byte(data)
-        if type_byte is None:
-            break
-
-        log(f"Type Byte is {type_byte:02x}")
-
-        tag = type_byte & 0x03
-
-        log(f"Element Type is: {ElementType(tag)}")
-
-        if tag == ElementType.Literal:
-            if ((type_byte & 0xFC) >> 2) < 60:  # embedded in tag
-                length = 1 + ((type_byte & 0xFC) >> 2)
-                log(f"Literal length is embedded in type byte and is {length}")
-            elif ((type_byte & 0xFC) >> 2) == 60:  # 8 bit
-                length = 1 + read_byte(data)
-                log(f"Literal length is 8bit and is {length}")
-            elif ((type_byte & 0xFC) >> 2) == 61:  # 16 bit
-                length = 1 + read_uint16(data)
-                log(f"Literal length is 16bit and is {length}")
-            elif ((type_byte & 0xFC) >> 2) == 62:  # 16 bit
-                length = 1 + read_uint24(data)
-                log(f"Literal length is 24bit and is {length}")
-            elif ((type_byte & 0xFC) >> 2) == 63:  # 16 bit
-                length = 1 + read_uint32(data)
-                log(f"Literal length is 32bit and is {length}")
-            else:
-                raise ValueError()  # cannot ever happen
-
-            literal_data = data.read(length)
-            if len(literal_data) < length:
-                raise ValueError("Couldn't read enough literal data")
-
-            out.write(literal_data)
-
-        else:
-            if tag == ElementType.CopyOneByte:
-                length = ((type_byte & 0x1C) >> 2) + 4
-                offset = ((type_byte & 0xE0) << 3) | read_byte(data)
-            elif tag == ElementType.CopyTwoByte:
-                length = 1 + ((type_byte & 0xFC) >> 2)
-                offset = read_uint16(data)
-            elif tag == ElementType.CopyFourByte:
-                length = 1 + ((type_byte & 0xFC) >> 2)
-                offset = read_uint32(data)
-            else:
-                raise ValueError()  # cannot ever happen
-
-            if offset == 0:
-                raise ValueError("Offset cannot be 0")
-
-            actual_offset = out.tell() - offset
-            log(f"Current Outstream Length: {out.tell()}")
-            log(f"Backreference length: {length}")
-            log(f"Backreference relative offset: {offset}")
-            log(f"Backreference absolute offset: {actual_offset}")
-
-            # have to read incrementally because you might have to read data that you've just written
-            # this is probably a really slow way of doing this.
-            for i in range(length):
-                out.write(out.getbuffer()[actual_offset + i: actual_offset + i + 1].tobytes())
-
-    result = out.getvalue()
-    if uncompressed_length != len(result):
-        raise ValueError("Wrong data length in uncompressed data")
-        # TODO: allow a partial / potentially bad result via a flag in the function call?
-
-    return result
+    return decompress_buffer(data.read())
 
 
 def main(path):
     import pathlib
     import hashlib
-    f = pathlib.Path(path).open("rb")
-    decompressed = decompress(f)
+    import timeit
+    raw = pathlib.Path(path).read_bytes()
+    decompressed = _decompress_python(raw)
     print(decompressed)
     sha1 = hashlib.sha1()
     sha1.update(decompressed)
     print(sha1.hexdigest())
 
+    # compare the backends against each other on this input
+    backends = {"python": _decompress_python}
+    if BACKEND != "python":
+        backends[BACKEND] = _decompress_binding
+    for name, func in backends.items():
+        if func(raw) != decompressed:
+            print(f"{name}: output differs!")
+            continue
+        runs = 20
+        elapsed = timeit.timeit(lambda: func(raw), number=runs) / runs
+        print(f"{name}: {len(decompressed) / elapsed / 1024 / 1024:.1f} MiB/s")
+
 
 if __name__ == "__main__":
     main(sys.argv[1])
@@ -24,162 +24,208 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
-__version__ = 0.02
+__version__ = 0.03
 __description__ = 'Control-F - crumbs - Apple Binary Cookie Parser'
 __contact__ = 'mike.bangham@controlf.co.uk'
 
+import os
 import sys
-from os.path import dirname, abspath, isfile
+import logging
+import pathlib
+import concurrent.futures
+from os.path import dirname, abspath, isdir, isfile
 from struct import unpack
-from collections import namedtuple
-from datetime import datetime
 import argparse
 import time
-import csv
 
-# Apple cocoa timestamp epoch
-cocoa_delta = 978307200
-
-
-def generate_dataframe(cookie_dict):
-    import pandas as pd
-    df = pd.DataFrame()
-    columns = ['Last Access (ts)', 'Last Access (dt)', 'Name', 'Value', 'Path', 'URL', 'Expires', 'Flag']
-    rows = []
-    pages = cookie_dict['header']['page_count']
-    for page in range(pages):
-        for cookie in cookie_dict['header']['pages'][page]['cookies']:
-            cd = cookie_dict['header']['pages'][page]['cookies'][cookie]['data']
-            rows.append([int(cd['Last Access (ts)']), cd['Last Access (dt)'], cd['Name'], cd['Value'],
-                         cd['Path'], cd['URL'], cd['Expires'], cd['Flag']])
-    if rows:
-        df = pd.DataFrame(rows, columns=columns)
-    return df
-
-
-def generate_csv(cookie_dict):
+import numpy as np
+import pandas as pd
+
+from src import timestamps
+
+COLUMNS = ['Last Access (ts)', 'Last Access (UTC)', 'Name', 'Value', 'Path', 'URL', 'Expires (UTC)', 'Flag']
+
+# Known flags
+FLAGS = {0: '', 1: 'Secure', 2: 'HTTP', 3: 'Secure/HTTP'}
+
+# The fixed 56 byte header at the start of every cookie (little endian). bytes[4:8] and [12:16] are obscure and the
+# 8 bytes at [32:40] are the cookie header footer. Both timestamps are Cocoa timestamps (doubles).
+COOKIE_HEADER = np.dtype([('size', '<i4'), ('unknown_1', '<i4'), ('flags', '<i4'), ('unknown_2', '<i4'),
+                          ('url_ofs', '<i4'), ('name_ofs', '<i4'), ('path_ofs', '<i4'), ('val_ofs', '<i4'),
+                          ('footer', '<u8'), ('expires', '<f8'), ('last_access', '<f8')])
+PAGE_HEADER = 256  # b'00000100'
+# the columns which identify one cookie when the same cookie is found in several files
+DEDUPE_COLUMNS = ['URL', 'Name', 'Path', 'Value', 'Last Access (ts)', 'Expires (UTC)']
+
+
+def _cookie_offsets(data):
+    # the absolute offset of every cookie in the file, from the page table and each page's cookie offsets
+    if len(data) < 8:
+        return np.empty(0, dtype=np.int64)
+    magic, page_count = unpack('>4s i', data[0:8])
+    if magic != b'cook' or page_count <= 0 or 8 + 4 * page_count > len(data):
+        return np.empty(0, dtype=np.int64)
+    page_sizes = np.frombuffer(data, dtype='>i4', count=page_count, offset=8).astype(np.int64)
+    page_starts = 8 + 4 * page_count + np.concatenate(([0], np.cumsum(page_sizes)[:-1]))
+
+    offsets = list()
+    for page_start, page_size in zip(page_starts.tolist(), page_sizes.tolist()):
+        if page_start + 8 > len(data) or unpack('>i', data[page_start:page_start + 4])[0] != PAGE_HEADER:
+            continue
+        cookie_count = unpack('<i', data[page_start + 4:page_start + 8])[0]
+        if cookie_count <= 0 or page_start + 8 + 4 * cookie_count > len(data):
+            continue
+        cookie_offsets = np.frombuffer(data, dtype='<i4', count=cookie_count, offset=page_start + 8)
+        offsets.append(page_start + cookie_offsets.astype(np.int64))
+    if not offsets:
+        return np.empty(0, dtype=np.int64)
+    offsets = np.concatenate(offsets)
+    return offsets[(offsets >= 0) & (offsets + COOKIE_HEADER.itemsize <= len(data))]
+
+
+def _strings(data, nuls, starts):
+    # all components end with \x00; the end of each is found by a binary search of the file's \x00 positions
+    ends = nuls[np.minimum(np.searchsorted(nuls, starts), len(nuls) - 1)] if len(nuls) else starts
+    ends = np.where(ends >= starts, ends, len(data))
+    return [data[start:end].decode('utf-8', 'replace') for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def read_cookies(data):
+    '''
+    Parses a whole binarycookies file (bytes) at once. The cookie headers are read in one pass as a NumPy record
+    array and the strings are sliced out at their \x00 ends. Returns {column: array} for COLUMNS.
+    '''
+    offsets = _cookie_offsets(data)
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    headers = buffer[offsets[:, None] + np.arange(COOKIE_HEADER.itemsize)].view(COOKIE_HEADER).ravel()
+    nuls = np.flatnonzero(buffer == 0)
+
+    columns = dict()
+    for ofs, component in {'url_ofs': 'URL', 'name_ofs': 'Name', 'path_ofs': 'Path', 'val_ofs': 'Value'}.items():
+        starts = offsets + headers[ofs]
+        columns[component] = _strings(data, nuls, np.clip(starts, 0, len(data)))
+
+    # timestamps are truncated to whole seconds and converted as UTC (not local time), like the other artefacts
+    last_access = np.trunc(headers['last_access'])
+    with np.errstate(invalid='ignore'):
+        in_range = np.isfinite(last_access) & (np.abs(last_access) < 2 ** 62)
+    columns['Last Access (ts)'] = np.where(in_range, last_access, 0).astype(np.int64)
+    columns['Last Access (UTC)'] = timestamps.to_datetime64(last_access, 'cocoa', zero_as_nat=False)
+    columns['Expires (UTC)'] = timestamps.to_datetime64(np.trunc(headers['expires']), 'cocoa', zero_as_nat=False)
+    columns['Flag'] = [FLAGS.get(flag, '') for flag in headers['flags'].tolist()]
+    return columns
+
+
+def generate_dataframe(columns):
+    if not len(columns['URL']):
+        return pd.DataFrame()
+    return pd.DataFrame(columns, columns=COLUMNS)
+
+
+def write_csv(df):
     fn = 'binary_cookies_{}.csv'.format(int(time.time()))
-    with open(fn, 'w', encoding='UTF8', newline='') as outfile:
-        cols = ['Last Access (ts)', 'Last Access (dt)', 'Name', 'Value', 'Path', 'URL', 'Expires', 'Flag']
-        w = csv.DictWriter(outfile, cols)
-        w.writeheader()
-        pages = cookie_dict['header']['page_count']
-        for page in range(pages):
-            for cookie in cookie_dict['header']['pages'][page]['cookies']:
-                cd = cookie_dict['header']['pages'][page]['cookies'][cookie]['data']
-                cd = {k: cd[k] for k in cols}  # omits any keys not required for final output
-                w.writerow(cd)
+    df = df.copy()
+    for column in ['Last Access (UTC)', 'Expires (UTC)']:
+        df[column] = timestamps.format_datetimes(df[column], na_rep='-')
+    df.to_csv(fn, index=False, encoding='UTF8')
     return fn
 
 
-def unpacker(struct_arg, data, fields=None):
-    # Accepts a struct argument, the packed binary data and optional fields.
-    if fields:
-        # returns a dictionary where the field is the key and the unpacked data is value.
-        attr1 = namedtuple('struct', fields)
-        return attr1._asdict(attr1._make(unpack(struct_arg, data)))
-    else:
-        # or just return value of single argument
-        return unpack(struct_arg, data)[0]
+def generate_csv(columns):
+    return write_csv(pd.DataFrame(columns, columns=COLUMNS))
+
+
+def find_cookie_files(in_dir):
+    # every binarycookies file beneath in_dir - app, app group and extension containers each have their own
+    return sorted(str(fp) for fp in pathlib.Path(in_dir).rglob('*.binarycookies') if fp.is_file())
+
+
+def _read_cookie_file(cookie_fp):
+    # the process pool's unit of work: one file, read and parsed as a whole
+    with open(cookie_fp, 'rb') as f:
+        return read_cookies(f.read())
+
+
+def _cookie_file_columns(cookie_fps, workers):
+    # (file, columns) for each file that parses, in the order given; a file which fails is logged and skipped
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(cookie_fps) < 2:
+        for cookie_fp in cookie_fps:
+            try:
+                yield cookie_fp, _read_cookie_file(cookie_fp)
+            except Exception as err:
+                logging.error('{} - {}: {}'.format(cookie_fp, type(err).__name__, err))
+        return
+
+    results = dict()
+    pending = list(range(len(cookie_fps)))
+    while pending:
+        # a worker which dies breaks the pool, failing every file still in it; those files are retried in a pool of
+        # one worker, where the first file to fail with the pool broken is the one which broke it
+        broken = list()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            futures = [(i, executor.submit(_read_cookie_file, cookie_fps[i])) for i in pending]
+            for i, future in futures:
+                try:
+                    results[i] = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    broken.append(i)
+                except Exception as err:
+                    logging.error('{} - {}: {}'.format(cookie_fps[i], type(err).__name__, err))
+        if broken and workers == 1:
+            logging.error('{} - The parser crashed reading this file'.format(cookie_fps[broken.pop(0)]))
+        pending, workers = broken, 1
+
+    for i in sorted(results):
+        yield cookie_fps[i], results[i]
+
+
+def aggregate_cookies(cookie_fps, workers=None, source_root=None):
+    '''
+    Parses many binarycookies files in worker processes and merges them into one DataFrame with a Source column
+    (each file's path, relative to source_root if given). A cookie found in several files (the same URL, name,
+    path, value and timestamps) is kept once, with every file it was found in listed in Source.
+    '''
+    frames = list()
+    for cookie_fp, columns in _cookie_file_columns(list(cookie_fps), workers):
+        if len(columns['URL']):
+            df = pd.DataFrame(columns, columns=COLUMNS)
+            df['Source'] = os.path.relpath(cookie_fp, source_root) if source_root else cookie_fp
+            frames.append(df)
+    if not frames:
+        return pd.DataFrame()
+
+    df = pd.concat(frames, ignore_index=True)
+    group = df.groupby(DEDUPE_COLUMNS, sort=False, dropna=False).ngroup().to_numpy()
+    first = ~pd.Series(group).duplicated().to_numpy()
+    repeated = np.isin(group, group[~first])
+    if repeated.any():
+        # only the cookies found more than once have their sources joined
+        sources = df['Source'][repeated].groupby(group[repeated]).agg(lambda s: '; '.join(dict.fromkeys(s)))
+        df.loc[repeated & first, 'Source'] = sources.reindex(group[repeated & first]).to_numpy()
+    return df[first].reset_index(drop=True)
+
+
+def aggregate_directory(in_dir, workers=None):
+    return aggregate_cookies(find_cookie_files(in_dir), workers=workers, source_root=in_dir)
 
 
 class CookieParser:
     def __init__(self, input_file, output):
-        self.binary_file = open(input_file, "rb")
+        self.input_file = input_file
         self.output_format = output
-        self.cookie_dict = dict()
 
     def process(self):
-        # Extract 1 x 4 byte char[] 'magic' and 1 x 4 byte int
-        self.cookie_dict['header'] = unpacker('>4s i', self.binary_file.read(8), ['magic', 'page_count'])
-        if self.cookie_dict['header']['magic'] == b'cook':
-            if self.cookie_dict['header']['page_count'] > 0:
-                # Each page will have its own dictionary
-                self.cookie_dict['header']['pages'] = dict()
-                for page in range(self.cookie_dict['header']['page_count']):
-                    self.cookie_dict['header']['pages'][page] = page_dict = {}
-                    page_dict['page_size'] = unpacker('>i', self.binary_file.read(4))
-
-            # move to first page offset
-            for page in range(self.cookie_dict['header']['page_count']):
-                # read each page into bytes object
-                page_data = self.binary_file.read(self.cookie_dict['header']['pages'][page]['page_size'])
-                # now we can process the page
-                self.process_page(self.cookie_dict['header']['pages'][page], page_data)
+        # the file is read once and parsed as a whole
+        with open(self.input_file, 'rb') as f:
+            data = f.read()
+        columns = read_cookies(data)
 
         if self.output_format == 'csv':
-            output = generate_csv(self.cookie_dict)
+            output = generate_csv(columns)
         else:
-            output = generate_dataframe(self.cookie_dict)
-
-        cookie_count = 0
-        for page in self.cookie_dict['header']['pages']:
-            cookie_count += self.cookie_dict['header']['pages'][page]['cookie_count']
-
-        return cookie_count, output
-
-    def process_page(self, page_dict, page_data):
-        page_dict['page_header'] = unpacker('>i', page_data[0:4])
-        if page_dict['page_header'] == 256:  # b'00000100'
-            page_dict['cookie_count'] = unpacker('<i', page_data[4:8])
-            if page_dict['cookie_count'] > 0:
-                page_dict['cookies'] = dict()
-                s = 8
-                for cookie in range(page_dict['cookie_count']):
-                    # create a dictionary for each cookie
-                    page_dict['cookies'][cookie] = cookie_dict = dict()
-                    # get the start offset for each cookie in the page (4 bytes Little Endian)
-                    cookie_dict['offset'] = unpacker('<i', page_data[s:s+4])
-                    # read the cookie data from the offset
-                    cookie_data = page_data[cookie_dict['offset']:]
-                    cookie_dict['data'] = self.process_cookie(cookie_data)
-                    s += 4
-
-    @staticmethod
-    def process_cookie(cookie_data):
-        data_dict = dict()
-        data_dict['size'] = unpacker('<i', cookie_data[0:4])
-        # bytes[4:8] are obscure
-        data_dict['Flag'] = ''
-        # Known flags
-        flags = {0: '', 1: 'Secure', 2: 'HTTP', 3: 'Secure/HTTP'}
-        if unpacker('<i', cookie_data[8:12]) in flags.keys():
-            data_dict['Flag'] = flags[unpacker('<i', cookie_data[8:12])]
-        # bytes[12:16] are obscure
-        # merge output from unpacker with out dictionary
-        data_dict = dict(**data_dict, **(unpacker('<4i',
-                                                  cookie_data[16:32],
-                                                  ['url_ofs', 'name_ofs', 'path_ofs', 'val_ofs'])))
-        # miss the following 8 bytes [32:40] - this is the cookie header footer
-        data_dict['expires_epoch'] = int(unpacker('<d', cookie_data[40:48]))
-        data_dict['Last Access (ts)'] = int(unpacker('<d', cookie_data[48:56]))
-
-        # Make the timestamps readable
-        try:
-            data_dict['Expires'] = datetime.fromtimestamp(data_dict['expires_epoch'] +
-                                                          cocoa_delta).strftime('%Y-%m-%d %H:%M:%S')
-        except OSError:
-            data_dict['Expires'] = '-'
-        try:
-            data_dict['Last Access (dt)'] = datetime.fromtimestamp(data_dict['Last Access (ts)'] +
-                                                              cocoa_delta).strftime('%Y-%m-%d %H:%M:%S')
-        except OSError:
-            data_dict['Last Access (dt)'] = '-'
-
-        # all components end with \x00 so we can use this to delimit the component pieces
-        for ofs, component in {'url_ofs': 'URL', 'name_ofs': 'Name', 'path_ofs': 'Path', 'val_ofs': 'Value'}.items():
-            s = data_dict[ofs]
-            data_dict[component] = ''
-            while True:
-                # check if \x00
-                unpacked_byte = unpacker('<b', cookie_data[s:s+1])
-                if unpacked_byte != 0:
-                    # append decoded byte to dict
-                    data_dict[component] += cookie_data[s:s+1].decode()
-                    s += 1
-                else:
-                    break
-        return data_dict
+            output = generate_dataframe(columns)
+        return len(columns['URL']), output
 
 
 if __name__ == '__main__':
@@ -212,14 +258,15 @@ if __name__ == '__main__':
 
     print("Append the '--help' command to see usage in detail")
     parser = argparse.ArgumentParser(description=__description__)
-    parser.add_argument('-i', required=True, help='The binary cookie file e.g. Cookies.binarycookies')
+    parser.add_argument('-i', required=True, help='The binary cookie file e.g. Cookies.binarycookies, or a '
+                                                  'directory to parse every binarycookies file beneath')
     parser.add_argument('-o', required=True, help="Output format: accepts 'df' or 'csv'")
+    parser.add_argument('-w', required=False, type=int, default=None,
+                        help='Worker processes for a directory (default: one per CPU)')
     args = parser.parse_args()
 
-    if len(args.i) and isfile(abspath(args.i)):
-        cookie_file = args.i
-    else:
-        print('[!!] Error: Please provide a file for argument -i')
+    if not (len(args.i) and (isfile(abspath(args.i)) or isdir(abspath(args.i)))):
+        print('[!!] Error: Please provide a file or directory for argument -i')
         sys.exit()
 
     if len(args.o) and args.o in ['df', 'csv']:
@@ -228,9 +275,14 @@ if __name__ == '__main__':
         print("[!!] Error: argument -o only accepts 'df' or 'csv'")
         sys.exit()
 
-    cp = CookieParser(cookie_file, output_format)
-    parsed_count, content = cp.process()
+    if isdir(abspath(args.i)):
+        content = aggregate_directory(abspath(args.i), workers=args.w)
+        parsed_count = len(content.index)
+        if output_format == 'csv' and not content.empty:
+            content = write_csv(content)
+    else:
+        cp = CookieParser(args.i, output_format)
+        parsed_count, content = cp.process()
     print('\nFinished! Parsed {} cookies'.format(parsed_count))
     print('Out:\n{}'.format(content))
     print('\n\n')
-
@@ -0,0 +1,274 @@
+'''
+MIT License
+
+derived_cache
+
+Copyright (c) 2022 Control-F Ltd
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+__version__ = 0.01
+__description__ = 'Control-F - derived_cache - On-disk cache of converted images and thumbnails'
+__contact__ = 'mike.bangham@controlf.co.uk'
+
+import os
+import sys
+import time
+import shutil
+import logging
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import contextlib
+from os.path import join as pj
+from os.path import abspath, expanduser, isfile
+
+# Files derived from artefacts (PNGs converted from KTX and cache images, report thumbnails) are kept here, outside
+# the temp directory, so they survive across sessions and archives. An entry is keyed by the SHA-256 of its source
+# file's content plus the transform and its parameters (format, size), so the same image extracted from another
+# archive, or again from the same one, is a hit. The hash of each source is recorded in index.db against its path,
+# size and mtime, so a file is only read to hash it the first time it is seen, or after it changes. index.db also
+# records each entry's size and when it was last used, and keeps a running total of the entries' sizes; once the
+# total is over max_bytes the least recently used entries are removed, in one batch, down to EVICT_TO of the cap.
+CACHE_DIR = abspath(pj(os.getenv('APPDATA') or expanduser('~'), 'CF_SHOMIUM', 'cache'))
+MAX_CACHE_BYTES = 1024 ** 3
+EVICT_TO = 0.9
+HASH_CHUNK = 1024 * 1024
+INDEX_DB = 'index.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE TABLE IF NOT EXISTS sources
+    (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, hash TEXT NOT NULL, added REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS sources_added ON sources (added);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta (name, value) SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM entries;
+'''
+
+
+def content_hash(fp):
+    '''The SHA-256 of a file's content'''
+    sha256 = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class DerivedCache:
+    '''
+    A size-capped, least recently used cache of derived files. Failures to read or write the cache are logged and
+    treated as misses, so a conversion never fails because of the cache. Safe to share between processes (the
+    conversion pools): entries are written to a temporary file and moved into place, and the index is SQLite.
+    '''
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._index_ready = False
+
+    def _connect(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        conn = sqlite3.connect(pj(self.cache_dir, INDEX_DB), timeout=30)
+        if not self._index_ready:
+            # once per process: WAL lets the pool's processes read the index while another writes to it
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                conn.executescript(SCHEMA)
+            self._index_ready = True
+        return conn
+
+    @contextlib.contextmanager
+    def _index(self):
+        # a transaction on the index, closed afterwards (each process, and each call, has its own connection)
+        conn = self._connect()
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _entry_path(self, key):
+        return pj(self.cache_dir, key[:2], key)
+
+    def source_hash(self, source_fp):
+        '''The SHA-256 of source_fp's content, read from the index while its path, size and mtime are unchanged'''
+        path = abspath(source_fp)
+        stat = os.stat(path)
+        with self._index() as conn:
+            row = conn.execute('SELECT hash FROM sources WHERE path = ? AND size = ? AND mtime_ns = ?',
+                               (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+        digest = content_hash(path)
+        with self._index() as conn:
+            conn.execute('INSERT OR REPLACE INTO sources (path, size, mtime_ns, hash, added) VALUES (?, ?, ?, ?, ?)',
+                         (path, stat.st_size, stat.st_mtime_ns, digest, time.time()))
+        return digest
+
+    def key(self, source_fp, transform, **params):
+        '''The cache key of a transform (e.g. 'png', 'thumbnail') of source_fp with params (e.g. size=128)'''
+        parts = [self.source_hash(source_fp), transform] + ['{}={}'.format(k, params[k]) for k in sorted(params)]
+        return hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _forget(conn, key):
+        conn.execute("UPDATE meta SET value = value - COALESCE((SELECT size FROM entries WHERE key = ?), 0) "
+                     "WHERE name = 'total_bytes'", (key,))
+        conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def get(self, key):
+        '''The path to the cached entry, marked as used, or None'''
+        path = self._entry_path(key)
+        try:
+            with self._index() as conn:
+                if isfile(path):
+                    updated = conn.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+                    if updated.rowcount:
+                        return path
+                self._forget(conn, key)
+        except (OSError, sqlite3.Error) as err:
+            logging.error('Cache - {}'.format(err))
+        return None
+
+    def put(self, key, fp):
+        '''Copies fp into the cache under key. Returns the cached path, or None'''
+        def write(f):
+            with open(fp, 'rb') as source:
+                shutil.copyfileobj(source, f)
+        return self._put(key, write)
+
+    def put_bytes(self, key, data):
+        return self._put(key, lambda f: f.write(data))
+
+    def _put(self, key, write):
+        path = self._entry_path(key)
+        tmp_fp = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_fp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_fp, path)
+            tmp_fp = None
+            size = os.path.getsize(path)
+            with self._index() as conn:
+                # the running total is updated in the same transaction as the entry it counts
+                self._forget(conn, key)
+                conn.execute('INSERT INTO entries (key, size, last_access) VALUES (?, ?, ?)', (key, size, time.time()))
+                conn.execute("UPDATE meta SET value = value + ? WHERE name = 'total_bytes'", (size,))
+                total = conn.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0]
+                if total > self.max_bytes:
+                    self._evict(conn, total)
+            return path
+        except (OSError, sqlite3.Error) as err:
+            logging.error('Cache - {}'.format(err))
+            return None
+        finally:
+            if tmp_fp and isfile(tmp_fp):
+                os.remove(tmp_fp)
+
+    def _evict(self, conn, total):
+        # removes the least recently used entries down to EVICT_TO of the cap, so the next puts don't evict again
+        target = self.max_bytes * EVICT_TO
+        evicted = list()
+        freed = 0
+        for key, size in conn.execute('SELECT key, size FROM entries ORDER BY last_access'):
+            if total - freed <= target:
+                break
+            try:
+                os.remove(self._entry_path(key))
+            except FileNotFoundError:
+                pass
+            evicted.append((key,))
+            freed += size
+        conn.executemany('DELETE FROM entries WHERE key = ?', evicted)
+        conn.execute("UPDATE meta SET value = value - ? WHERE name = 'total_bytes'", (freed,))
+        # drops the hashes recorded before the oldest remaining entry was last used; a source seen again is rehashed
+        conn.execute('DELETE FROM sources WHERE added < (SELECT MIN(last_access) FROM entries)')
+
+    def fetch(self, source_fp, out_fp, transform, **params):
+        '''Copies the cached transform of source_fp to out_fp. True on a hit'''
+        if not isfile(source_fp):
+            return False
+        try:
+            path = self.get(self.key(source_fp, transform, **params))
+            if path:
+                shutil.copyfile(path, out_fp)
+                return True
+        except (OSError, sqlite3.Error) as err:
+            logging.error('Cache - {}'.format(err))
+        return False
+
+    def store(self, source_fp, out_fp, transform, **params):
+        '''Caches out_fp as the transform of source_fp'''
+        try:
+            self.put(self.key(source_fp, transform, **params), out_fp)
+        except (OSError, sqlite3.Error) as err:
+            logging.error('Cache - {}'.format(err))
+
+    def fetch_bytes(self, source_fp, transform, **params):
+        if not isfile(source_fp):
+            return None
+        try:
+            path = self.get(self.key(source_fp, transform, **params))
+            if path:
+                with open(path, 'rb') as f:
+                    return f.read()
+        except (OSError, sqlite3.Error) as err:
+            logging.error('Cache - {}'.format(err))
+        return None
+
+    def store_bytes(self, source_fp, data, transform, **params):
+        try:
+            self.put_bytes(self.key(source_fp, transform, **params), data)
+        except (OSError, sqlite3.Error) as err:
+            logging.error('Cache - {}'.format(err))
+
+    def stats(self):
+        if not isfile(pj(self.cache_dir, INDEX_DB)):
+            return 0, 0
+        with self._index() as conn:
+            return (conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0],
+                    conn.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0])
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self._index_ready = False
+
+
+default_cache = DerivedCache()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__description__)
+    parser.add_argument('-d', required=False, default=CACHE_DIR, help='The cache directory')
+    parser.add_argument('--clear', action='store_true', help='Remove every cached file')
+    args = parser.parse_args()
+
+    derived_cache = DerivedCache(abspath(args.d))
+    if args.clear:
+        derived_cache.clear()
+        print('Cleared {}'.format(derived_cache.cache_dir))
+        sys.exit()
+    entries, total = derived_cache.stats()
+    print('{} : {} entries, {:.1f} MB of {:.1f} MB'.format(derived_cache.cache_dir, entries, total / 1024 ** 2,
+                                                          derived_cache.max_bytes / 1024 ** 2))
@@ -0,0 +1,259 @@
+'''
+MIT License
+
+indexeddb
+
+Copyright (c) 2022 Control-F Ltd
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+__version__ = 0.01
+__description__ = 'Control-F - indexeddb - Chromium IndexedDB Reader'
+__contact__ = 'mike.bangham@controlf.co.uk'
+
+import sys
+import enum
+import struct
+import pathlib
+import argparse
+from os.path import abspath, isdir
+from collections import namedtuple
+
+from src import ccl_leveldb
+
+# Chromium IndexedDB keys all begin with a KeyPrefix of (database id, object store id, index id). The tables use
+# the 'idb_cmp1' comparator which orders keys by this prefix numerically, so the prefix is decoded to a tuple for
+# range scans. See: content/browser/indexed_db/indexed_db_leveldb_coding.cc (Chromium)
+OBJECT_STORE_DATA_INDEX_ID = 1
+EXISTS_ENTRY_INDEX_ID = 2
+BLOB_ENTRY_INDEX_ID = 3
+
+# global metadata (prefix 0, 0, 0)
+DATABASE_NAME_TYPE_BYTE = 201
+# database metadata (prefix database id, 0, 0)
+OBJECT_STORE_META_DATA_TYPE_BYTE = 50
+OBJECT_STORE_NAME_META_TYPE = 0
+
+DatabaseInfo = namedtuple('DatabaseInfo', ['db_id', 'origin', 'name'])
+ObjectStoreInfo = namedtuple('ObjectStoreInfo', ['db_id', 'object_store_id', 'name'])
+IdbRecord = namedtuple('IdbRecord', ['db_id', 'object_store_id', 'key', 'version', 'value', 'record'])
+
+
+class IdbKeyType(enum.IntEnum):
+    Null = 0
+    String = 1
+    Date = 2
+    Number = 3
+    Array = 4
+    MinKey = 5
+    Binary = 6
+
+
+def read_varint(data, offset):
+    # returns the decoded (unsigned) varint and the offset following it
+    result = 0
+    shift = 0
+    while True:
+        b = data[offset]
+        offset += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, offset
+        shift += 7
+
+
+def decode_int(data):
+    # Chromium's EncodeInt: a little endian integer using as few bytes as it needs (not a varint)
+    return int.from_bytes(data, 'little')
+
+
+def read_string_with_length(data, offset):
+    # varint length in UTF-16 code units, followed by big endian UTF-16 data
+    length, offset = read_varint(data, offset)
+    end = offset + length * 2
+    return data[offset:end].decode('utf-16-be', 'replace'), end
+
+
+def decode_key_prefix(user_key):
+    # Returns ((database id, object store id, index id), offset of the remainder of the key)
+    first = user_key[0]
+    db_id_len = (first >> 5) + 1
+    os_id_len = ((first >> 2) & 0x07) + 1
+    index_id_len = (first & 0x03) + 1
+    offset = 1
+    prefix = []
+    for length in (db_id_len, os_id_len, index_id_len):
+        if offset + length > len(user_key):
+            raise ValueError('Key too short for its KeyPrefix')
+        prefix.append(int.from_bytes(user_key[offset:offset + length], 'little'))
+        offset += length
+    return tuple(prefix), offset
+
+
+def prefix_sort_key(user_key):
+    # key_func for ccl_leveldb range scans; keys that don't decode sort before all valid prefixes
+    try:
+        return decode_key_prefix(user_key)[0]
+    except (ValueError, IndexError):
+        return ()
+
+
+def decode_idb_key(data, offset=0):
+    # Returns the decoded IndexedDB key and the offset following it
+    key_type = IdbKeyType(data[offset])
+    offset += 1
+    if key_type == IdbKeyType.Null or key_type == IdbKeyType.MinKey:
+        return None, offset
+    elif key_type == IdbKeyType.String:
+        return read_string_with_length(data, offset)
+    elif key_type == IdbKeyType.Date or key_type == IdbKeyType.Number:
+        return struct.unpack('<d', data[offset:offset + 8])[0], offset + 8
+    elif key_type == IdbKeyType.Binary:
+        length, offset = read_varint(data, offset)
+        return bytes(data[offset:offset + length]), offset + length
+    else:  # Array
+        length, offset = read_varint(data, offset)
+        items = list()
+        for _ in range(length):
+            item, offset = decode_idb_key(data, offset)
+            items.append(item)
+        return items, offset
+
+
+class IndexedDb:
+    '''
+    Reads a Chromium '*.indexeddb.leveldb' directory. Database and object store names are decoded from the
+    metadata keys when opened; object store records are only read when a store is scanned, one store at a time.
+    '''
+    def __init__(self, leveldb_dir, blob_dir=None):
+        self.leveldb_dir = pathlib.Path(leveldb_dir)
+        self.blob_dir = pathlib.Path(blob_dir) if blob_dir else self._find_blob_dir()
+        self._raw = ccl_leveldb.RawLevelDb(self.leveldb_dir)
+        self.databases = dict()
+        self.object_stores = dict()
+        self._read_metadata()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _find_blob_dir(self):
+        # https_example.com_0.indexeddb.leveldb -> https_example.com_0.indexeddb.blob
+        blob_dir = self.leveldb_dir.with_name(self.leveldb_dir.name.replace('.leveldb', '.blob'))
+        if blob_dir != self.leveldb_dir and blob_dir.is_dir():
+            return blob_dir
+        return None
+
+    def _latest_live(self, start, end):
+        # metadata is small, so the newest live version of each key can be held in memory
+        latest = dict()
+        for record in self._raw.iterate_records_in_key_range(start, end, key_func=prefix_sort_key):
+            user_key = record.user_key
+            if user_key not in latest or latest[user_key].seq < record.seq:
+                latest[user_key] = record
+        return {k: r for k, r in latest.items() if r.state != ccl_leveldb.KeyState.Deleted}
+
+    def _read_metadata(self):
+        # global metadata: database names
+        for user_key, record in self._latest_live((0, 0, 0), (0, 0, 1)).items():
+            try:
+                _, offset = decode_key_prefix(user_key)
+                if user_key[offset] != DATABASE_NAME_TYPE_BYTE:
+                    continue
+                origin, offset = read_string_with_length(user_key, offset + 1)
+                name, offset = read_string_with_length(user_key, offset)
+            except (ValueError, IndexError):
+                continue
+            if not record.value:
+                continue
+            db_id = decode_int(record.value)
+            self.databases[db_id] = DatabaseInfo(db_id, origin, name)
+
+        # database metadata: object store names
+        for db_id in self.databases:
+            for user_key, record in self._latest_live((db_id, 0, 0), (db_id, 0, 1)).items():
+                try:
+                    _, offset = decode_key_prefix(user_key)
+                    if user_key[offset] != OBJECT_STORE_META_DATA_TYPE_BYTE:
+                        continue
+                    object_store_id, offset = read_varint(user_key, offset + 1)
+                    if user_key[offset] != OBJECT_STORE_NAME_META_TYPE:
+                        continue
+                except (ValueError, IndexError):
+                    continue
+                name = record.value.decode('utf-16-be', 'replace')
+                self.object_stores[(db_id, object_store_id)] = ObjectStoreInfo(db_id, object_store_id, name)
+
+    def iterate_object_store(self, db_id, object_store_id, *, live_only=False):
+        '''
+        Yields an IdbRecord for each record in the object store. Only the data blocks of the table files that can
+        hold the store's keys are decompressed. Every version of a record is yielded unless live_only is set.
+        '''
+        start = (db_id, object_store_id, OBJECT_STORE_DATA_INDEX_ID)
+        end = (db_id, object_store_id, OBJECT_STORE_DATA_INDEX_ID + 1)
+        if live_only:
+            records = self._latest_live(start, end).values()
+        else:
+            records = self._raw.iterate_records_in_key_range(start, end, key_func=prefix_sort_key)
+
+        for record in records:
+            user_key = record.user_key
+            try:
+                _, offset = decode_key_prefix(user_key)
+                key, _ = decode_idb_key(user_key, offset)
+            except (ValueError, IndexError, struct.error):
+                key = user_key
+            if record.state == ccl_leveldb.KeyState.Deleted or not record.value:
+                version, value = None, b''
+            else:
+                # the value is a varint version followed by the serialised script value
+                version, offset = read_varint(record.value, 0)
+                value = record.value[offset:]
+            yield IdbRecord(db_id, object_store_id, key, version, value, record)
+
+    def get_blob_path(self, db_id, blob_number):
+        # blobs are stored as <blob dir>/<db id hex>/<second byte of blob number hex>/<blob number hex>
+        if self.blob_dir is None:
+            return None
+        path = self.blob_dir / '{:x}'.format(db_id) / '{:02x}'.format((blob_number & 0xff00) >> 8) / \
+            '{:x}'.format(blob_number)
+        return path if path.is_file() else None
+
+    def close(self):
+        self._raw.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__description__)
+    parser.add_argument('-i', required=True, help='An IndexedDB leveldb directory e.g. '
+                                                  'https_example.com_0.indexeddb.leveldb')
+    args = parser.parse_args()
+
+    if not (len(args.i) and isdir(abspath(args.i))):
+        print('[!!] Error: Please provide a directory for argument -i')
+        sys.exit()
+
+    with IndexedDb(args.i) as idb:
+        for (db_id, os_id), store in sorted(idb.object_stores.items()):
+            db = idb.databases[db_id]
+            count = sum(1 for _ in idb.iterate_object_store(db_id, os_id, live_only=True))
+            print('{} | {} | {} : {} records'.format(db.origin, db.name, store.name, count))
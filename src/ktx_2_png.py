@@ -21,6 +21,14 @@
     python3 ios_ktx2png.py SAMPLE.KTX
     Output will be in the same folder, called SAMPLE.KTX.png
     See main 
+    Previews
+    --------
+    convert_to_preview decodes only as much of the texture as a thumbnail
+    needs: the smallest mip level at least max_size pixels across when the
+    file has mip levels, otherwise every Nth ASTC block in each direction
+    (ASTC blocks decode independently, so a grid of sampled blocks is itself
+    a valid texture). The full decode is left until the image is opened;
+    see full_image.
 """
 
 import astc_decomp 
@@ -29,11 +37,20 @@ import os
 import struct
 import sys
 import logging
+import concurrent.futures
 
+import numpy as np
 from PIL import Image
 
+from src import derived_cache
+
 version = 1.0
 
+ASTC_BLOCK = 4  # ASTC 4x4: every block is 16 bytes and decodes to 4x4 pixels
+ASTC_BLOCK_BYTES = 16
+PREVIEW_SIZE = 512  # the largest thumbnail the GUI or the HTML report shows
+PREVIEW_SUFFIX = '.preview.png'
+
 
 class KTXReader:
     def __init__(self):
@@ -162,6 +179,79 @@ class KTXReader:
             return True
         return False
 
+    def _level_size(self, level):
+        width = max(1, self.pixelWidth >> level)
+        height = max(1, self.pixelHeight >> level)
+        return width, height
+
+    @staticmethod
+    def _astc_size(width, height):
+        return -(-width // ASTC_BLOCK) * -(-height // ASTC_BLOCK) * ASTC_BLOCK_BYTES
+
+    def _endian_char(self):
+        return '<' if self.endianness == bytes.fromhex('01020304') else '>'
+
+    def get_mip_level_data(self, f, level):
+        '''The ASTC texture data of one mip level, as (width, height, data)'''
+        width, height = self._level_size(level)
+        if self.glInternalFormat != 0x93B0:
+            raise ValueError('Unsupported Format')
+        if level and not self.is_aapl_file:
+            f.seek(0x40)
+            k_v_data = f.read(self.bytesOfKeyValueData)
+            if k_v_data.find(b'Compression_APPLE') < 0:
+                # every level is its imageSize then its data (ASTC sizes are multiples of 16, so never padded)
+                f.seek(0x40 + self.bytesOfKeyValueData)
+                for _ in range(level):
+                    f.seek(struct.unpack(self._endian_char() + 'I', f.read(4))[0], os.SEEK_CUR)
+                image_size = struct.unpack(self._endian_char() + 'I', f.read(4))[0]
+                return width, height, f.read(image_size)
+        data = self.get_uncompressed_texture_data(f)
+        # a decompressed texture holds its levels back to back
+        start = sum(self._astc_size(*self._level_size(i)) for i in range(level))
+        end = start + self._astc_size(width, height)
+        if len(data) < end:
+            raise ValueError('Texture data is too short for mip level {}'.format(level))
+        return width, height, data[start:end]
+
+    def get_preview(self, f, max_size=PREVIEW_SIZE):
+        '''
+        A PIL Image of the texture no more than max_size pixels across, decoding as little as it can: a lower mip
+        level when there is one at least max_size across, otherwise a sparse grid of ASTC blocks. None if the file
+        is not a supported KTX file.
+        '''
+        if not self.validate_header(f):
+            return None
+        level = 0
+        while level + 1 < self.numberOfMipmapLevels and max(self._level_size(level + 1)) >= max_size:
+            level += 1
+        width, height, data = self.get_mip_level_data(f, level)
+
+        step = max(1, max(width, height) // max_size)
+        if step > 1:
+            blocks_x, blocks_y = -(-width // ASTC_BLOCK), -(-height // ASTC_BLOCK)
+            blocks = np.frombuffer(data, dtype=np.uint8, count=blocks_x * blocks_y * ASTC_BLOCK_BYTES)
+            blocks = blocks.reshape(blocks_y, blocks_x, ASTC_BLOCK_BYTES)[::step, ::step]
+            sampled_y, sampled_x = blocks.shape[:2]
+            preview = Image.frombytes('RGBA', (sampled_x * ASTC_BLOCK, sampled_y * ASTC_BLOCK),
+                                      np.ascontiguousarray(blocks).tobytes(), 'astc', (4, 4, False))
+        else:
+            preview = Image.frombytes('RGBA', (width, height), data, 'astc', (4, 4, False))
+
+        # keep the texture's own aspect ratio (the sampled grid can be a partial block out)
+        scale = min(1.0, max_size / max(width, height))
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if preview.size != size:
+            preview = preview.resize(size, Image.BILINEAR)
+        return preview
+
+    def convert_to_preview(self, f, save_to_path, max_size=PREVIEW_SIZE):
+        preview = self.get_preview(f, max_size=max_size)
+        if preview is None:
+            return False
+        preview.save(save_to_path, "PNG")
+        return True
+
     def save_uncompressed_texture(self, f, save_to_path):
         if self.validate_header(f):
             data = self.get_uncompressed_texture_data(f)
@@ -169,4 +259,102 @@ class KTXReader:
             f.write(data)
             f.close()
             return True
-        return False
\ No newline at end of file
+        return False
+
+
+def convert_ktx_file(ktx_fp, png_fp, max_size=None):
+    # converts one KTX file to a PNG (a preview if max_size is given); runs in a worker process.
+    # Returns None, or the error as a string. Conversions are kept in the derived file cache
+    size = max_size or 'full'
+    try:
+        if derived_cache.default_cache.fetch(ktx_fp, png_fp, 'ktx_png', size=size):
+            return None
+        with open(ktx_fp, 'rb') as f:
+            if max_size:
+                converted = KTXReader().convert_to_preview(f, png_fp, max_size=max_size)
+            else:
+                converted = KTXReader().convert_to_png(f, png_fp)
+        if converted:
+            derived_cache.default_cache.store(ktx_fp, png_fp, 'ktx_png', size=size)
+            return None
+        return 'Not a supported KTX file'
+    except Exception as err:
+        return '{}: {}'.format(type(err).__name__, err)
+
+
+def preview_path(ktx_fp):
+    return '{}{}'.format(ktx_fp, PREVIEW_SUFFIX)
+
+
+def is_preview(fp):
+    return isinstance(fp, str) and fp.endswith(PREVIEW_SUFFIX)
+
+
+def full_images(fps, workers=None):
+    '''
+    The full resolution image for each media file in fps: a preview from preview_path is decoded in full beside its
+    KTX file, unless it already has been or the derived file cache holds it; those left to decode run in a process
+    pool. Any other file, or a preview which can't be decoded, is returned as it is.
+    '''
+    full = dict()
+    jobs = dict()
+    for fp in fps:
+        if not is_preview(fp) or fp in full or fp in jobs:
+            continue
+        ktx_fp = fp[:-len(PREVIEW_SUFFIX)]
+        png_fp = '{}.png'.format(ktx_fp)
+        if os.path.isfile(png_fp) or derived_cache.default_cache.fetch(ktx_fp, png_fp, 'ktx_png', size='full'):
+            full[fp] = png_fp
+        else:
+            jobs[fp] = (ktx_fp, png_fp)
+
+    for ktx_fp, png_fp, error in convert_ktx_files(list(jobs.values()), workers=workers):
+        if error:
+            logging.error('{} - {}'.format(os.path.basename(ktx_fp), error))
+        else:
+            full[preview_path(ktx_fp)] = png_fp
+    return [full.get(fp, fp) if is_preview(fp) else fp for fp in fps]
+
+
+def full_image(fp):
+    return full_images([fp])[0]
+
+
+def convert_ktx_files(jobs, workers=None, max_size=None):
+    '''
+    Converts many KTX files to PNG in a process pool. jobs is a list of (KTX file, PNG file); with max_size each
+    PNG is a preview no more than max_size pixels across (see KTXReader.get_preview). Yields
+    (KTX file, PNG file, error) as each conversion finishes (so not in the order given); error is None on success.
+    A file which fails only fails itself. If a file crashes the decoder (taking its worker process with it) the pool
+    is broken, so the unfinished files are retried in a pool of one worker, where the file running when the pool
+    breaks is the one which broke it.
+    '''
+    workers = workers or os.cpu_count() or 1
+    pending = list(jobs)
+    if workers <= 1 or len(pending) < 2:
+        for ktx_fp, png_fp in pending:
+            yield ktx_fp, png_fp, convert_ktx_file(ktx_fp, png_fp, max_size)
+        return
+
+    while pending:
+        broken = list()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            futures = {executor.submit(convert_ktx_file, ktx_fp, png_fp, max_size): i
+                       for i, (ktx_fp, png_fp) in enumerate(pending)}
+            for future in concurrent.futures.as_completed(futures):
+                ktx_fp, png_fp = pending[futures[future]]
+                try:
+                    error = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    broken.append(futures[future])
+                    continue
+                except Exception as err:
+                    error = '{}: {}'.format(type(err).__name__, err)
+                yield ktx_fp, png_fp, error
+
+        broken = [pending[i] for i in sorted(broken)]
+        if broken and workers == 1:
+            # one worker runs the files in order, so the first unfinished file crashed it
+            ktx_fp, png_fp = broken.pop(0)
+            yield ktx_fp, png_fp, 'The decoder crashed converting this file'
+        pending, workers = broken, 1
\ No newline at end of file
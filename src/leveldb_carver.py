@@ -0,0 +1,537 @@
+'''
+MIT License
+
+leveldb_carver
+
+Copyright (c) 2022 Control-F Ltd
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+__version__ = 0.01
+__description__ = 'Control-F - leveldb_carver - LevelDB record carver'
+__contact__ = 'mike.bangham@controlf.co.uk'
+
+import io
+import os
+import sys
+import enum
+import mmap
+import bisect
+import struct
+import logging
+import pathlib
+import argparse
+import itertools
+import dataclasses
+from collections import Counter
+from os.path import abspath, isdir
+
+import numpy as np
+
+from src import ccl_leveldb, ccl_simplesnappy
+
+try:
+    import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+# Unlike ccl_leveldb.LogFile and LdbFile, which stop at the first inconsistency, the carver sweeps a memory mapped
+# file for anything with the structure of a log fragment or a table block, checks its CRC and decodes whatever
+# records it holds, carrying on past corruption. Candidate positions are found with NumPy over the whole map, so
+# only positions which could be a header or block trailer are looked at in Python.
+# See: https://github.com/google/leveldb/blob/master/doc/log_format.md
+#      https://github.com/google/leveldb/blob/master/doc/table_format.md
+LOG_BLOCK_SIZE = ccl_leveldb.LogReader.LOG_BLOCK_SIZE
+LOG_HEADER_SIZE = ccl_leveldb.LogReader.LOG_ENTRY_HEADER_SIZE
+BLOCK_TRAILER_SIZE = ccl_leveldb.LdbFile.BLOCK_TRAILER_SIZE
+FOOTER_SIZE = ccl_leveldb.LdbFile.FOOTER_SIZE
+CRC_MASK_DELTA = 0xa282ead8
+# a table block ends at the first trailer whose CRC matches, looked for at most this far from the block's start
+MAX_BLOCK_SEARCH = 4 * 1024 * 1024
+# when a table has lost sync the search from each possible block start is kept shorter
+RESYNC_BLOCK_SEARCH = 64 * 1024
+MAX_RESYNC_ATTEMPTS = 4096
+CARVE_SUFFIXES = ('.log', '.ldb', '.sst')
+
+
+def _make_crc_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82f63b78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+_CRC_TABLE = _make_crc_table()
+
+
+def _crc32c_python(data, crc=0):
+    crc ^= 0xffffffff
+    table = _CRC_TABLE
+    for b in data:
+        crc = table[(crc ^ b) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+
+# crc32c (in requirements.txt) is used if it's installed; the table driven version gives the same result, but is
+# around 20 times slower, which makes carving a damaged table (where each possible block start is checked) slow
+crc32c = _crc32c.crc32c if _crc32c is not None else _crc32c_python
+_slow_crc_warned = False
+
+
+def _warn_slow_crc():
+    # logged once, the first time a file is carved without the crc32c package
+    global _slow_crc_warned
+    if _crc32c is None and not _slow_crc_warned:
+        logging.warning('The crc32c package is not installed; carving uses a much slower pure Python CRC. '
+                        'Install it with: pip install crc32c')
+        _slow_crc_warned = True
+
+
+def unmask_crc(masked):
+    # leveldb stores CRCs "masked" so that CRCs of data containing CRCs are less likely to collide
+    rot = (masked - CRC_MASK_DELTA) & 0xffffffff
+    return ((rot >> 17) | (rot << 15)) & 0xffffffff
+
+
+class CarveConfidence(enum.IntEnum):
+    # Low: decoded from a fragment or block whose CRC doesn't match
+    # Medium: CRC matches but the batch or block is incomplete or only partly decodes
+    # High: CRC matches and the batch or block decodes completely
+    Low = 0
+    Medium = 1
+    High = 2
+
+
+@dataclasses.dataclass(frozen=True)
+class CarvedRecord:
+    '''
+    A record recovered by the carver. record.offset is the record's file offset as in ccl_leveldb; source_offset is
+    the file offset of the log fragment header or table block it was recovered from.
+    '''
+    record: ccl_leveldb.Record
+    confidence: CarveConfidence
+    source_offset: int
+
+
+def _u32_at(arr, positions):
+    # little endian uint32 at each of positions (which must be at least 4 bytes from the end of arr)
+    positions = np.asarray(positions, dtype=np.int64)
+    return (arr[positions].astype(np.int64) | (arr[positions + 1].astype(np.int64) << 8) |
+            (arr[positions + 2].astype(np.int64) << 16) | (arr[positions + 3].astype(np.int64) << 24))
+
+
+def _log_header_candidates(arr, lo, hi):
+    # positions in [lo, hi) holding a structurally valid fragment header: a fragment type and a length which fits
+    # in the rest of the 32K block and the file
+    size = len(arr)
+    hi = min(hi, size - LOG_HEADER_SIZE + 1)
+    if hi <= lo:
+        return np.empty(0, dtype=np.int64)
+    p = np.arange(lo, hi, dtype=np.int64)
+    in_block = p % LOG_BLOCK_SIZE
+    p = p[in_block <= LOG_BLOCK_SIZE - LOG_HEADER_SIZE]
+    block_type = arr[p + 6]
+    length = arr[p + 4].astype(np.int64) | (arr[p + 5].astype(np.int64) << 8)
+    end = p + LOG_HEADER_SIZE + length
+    ok = ((block_type >= ccl_leveldb.LogEntryType.Full) & (block_type <= ccl_leveldb.LogEntryType.Last) &
+          ((p % LOG_BLOCK_SIZE) + LOG_HEADER_SIZE + length <= LOG_BLOCK_SIZE) & (end <= size))
+    return p[ok]
+
+
+def _decode_log_batch(path, fragments, complete):
+    # fragments: (header offset, data offset, data, crc ok, type); yields CarvedRecords for the batch's entries
+    data = b''.join(fragment[2] for fragment in fragments)
+    starts = tuple(itertools.accumulate((len(fragment[2]) for fragment in fragments[:-1]), initial=0))
+    batch = ccl_leveldb.LogBatch(fragments[0][1], data, starts, tuple(fragment[1] for fragment in fragments))
+    if len(data) < 12:
+        return
+
+    def entry_confidence(entry_start, entry_end):
+        # only the fragments the entry's bytes came from matter
+        first = bisect.bisect_right(starts, entry_start) - 1
+        last = bisect.bisect_left(starts, entry_end) - 1
+        if not all(fragment[3] for fragment in fragments[first:last + 1]):
+            return CarveConfidence.Low
+        return base_confidence
+
+    seq, count = struct.unpack_from('<QI', data, 0)
+    pos = 12
+    entries = []
+    try:
+        for i in range(count):
+            entry_start = pos
+            state = data[pos]
+            if state not in (ccl_leveldb.KeyState.Deleted.value, ccl_leveldb.KeyState.Live.value):
+                break
+            key_length, pos = ccl_leveldb._decode_varint32(data, pos + 1)
+            key = data[pos:pos + key_length]
+            pos += key_length
+            if state == ccl_leveldb.KeyState.Live.value:
+                value_length, pos = ccl_leveldb._decode_varint32(data, pos)
+                value = data[pos:pos + value_length]
+                pos += value_length
+            else:
+                value = b''
+            if pos > len(data):
+                break
+            entries.append((entry_start, pos, key, value, seq + i, ccl_leveldb.KeyState(state)))
+    except IndexError:
+        pass
+
+    decoded_all = len(entries) == count and pos == len(data)
+    base_confidence = CarveConfidence.High if complete and decoded_all else CarveConfidence.Medium
+    for entry_start, entry_end, key, value, entry_seq, state in entries:
+        record = ccl_leveldb.Record.log_record(key, value, entry_seq, state, path, batch.file_offset(entry_start))
+        yield CarvedRecord(record, entry_confidence(entry_start, entry_end), fragments[0][0])
+
+
+def carve_log(path):
+    '''
+    Yields a CarvedRecord for each record that can be recovered from a .log file. Fragments are checked against
+    their CRCs; where a header doesn't check out the rest of its 32K block is searched for the next fragment that
+    does, so a damaged fragment or a torn write loses at most the batches that pass through it.
+    '''
+    path = pathlib.Path(path)
+    _warn_slow_crc()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from _carve_log_map(path, mm)
+
+
+def _carve_log_map(path, mm):
+    arr = np.frombuffer(mm, dtype=np.uint8)
+    size = len(mm)
+    fragments = []
+    pos = 0
+
+    def flush(complete):
+        nonlocal fragments
+        batch, fragments = fragments, []
+        # a batch which has lost its first fragment has lost its sequence number and count too
+        if batch and batch[0][4] in (ccl_leveldb.LogEntryType.Full, ccl_leveldb.LogEntryType.First):
+            return list(_decode_log_batch(path, batch, complete))
+        return []
+
+    def add(fragment):
+        block_type = fragment[4]
+        if block_type in (ccl_leveldb.LogEntryType.Full, ccl_leveldb.LogEntryType.First):
+            yield from flush(False)
+        fragments.append(fragment)
+        if block_type in (ccl_leveldb.LogEntryType.Full, ccl_leveldb.LogEntryType.Last):
+            yield from flush(True)
+
+    while pos + LOG_HEADER_SIZE <= size:
+        block_remaining = LOG_BLOCK_SIZE - (pos % LOG_BLOCK_SIZE)
+        if block_remaining < LOG_HEADER_SIZE:
+            pos += block_remaining  # block trailer
+            continue
+
+        masked, length, block_type = struct.unpack_from('<IHB', mm, pos)
+        data_offset = pos + LOG_HEADER_SIZE
+        end = data_offset + length
+        if block_type == ccl_leveldb.LogEntryType.Zero and length == 0 and masked == 0:
+            pos += block_remaining  # zeroed space; nothing more in this block
+            continue
+
+        valid = (ccl_leveldb.LogEntryType.Full <= block_type <= ccl_leveldb.LogEntryType.Last and
+                 length <= block_remaining - LOG_HEADER_SIZE and end <= size)
+        crc_ok = valid and crc32c(mm[pos + 6:end]) == unmask_crc(masked)
+        if valid and crc_ok:
+            yield from add((pos, data_offset, mm[data_offset:end], True, block_type))
+            pos = end
+            continue
+
+        if valid:
+            # a header in the expected place with a bad CRC: keep its data for what can be decoded from it, but
+            # don't trust its length - look for the next good header from just after it
+            yield from add((pos, data_offset, mm[data_offset:end], False, block_type))
+        else:
+            yield from flush(False)
+
+        block_end = pos + block_remaining
+        next_pos = block_end
+        for candidate in _log_header_candidates(arr, pos + 1, block_end).tolist():
+            c_masked, c_length, _ = struct.unpack_from('<IHB', mm, candidate)
+            c_end = candidate + LOG_HEADER_SIZE + c_length
+            if crc32c(mm[candidate + 6:c_end]) == unmask_crc(c_masked):
+                next_pos = candidate
+                break
+        expected = end if block_end - end >= LOG_HEADER_SIZE else block_end
+        if next_pos != expected or not valid:
+            # the fragment chain is broken
+            yield from flush(False)
+        pos = next_pos
+
+    yield from flush(False)
+
+
+def _snappy_preamble(mm, start):
+    # the uncompressed length varint at the start of a snappy block, or None
+    try:
+        length, _ = ccl_leveldb._decode_varint32(mm, start)
+    except IndexError:
+        return None
+    return length
+
+
+def _block_end_candidates(arr, start, lo, hi, preamble):
+    # positions in [lo, hi) which could hold the trailer of a block beginning at start
+    positions = np.arange(lo, hi, dtype=np.int64)
+    block_type = arr[positions]
+
+    # uncompressed: [entries][restart offsets, the first always 0][restart count] then the trailer
+    plain = positions[(block_type == 0) & (positions - start >= 8)]
+    if len(plain):
+        restart_count = _u32_at(arr, plain - 4)
+        ok = (restart_count >= 1) & ((restart_count + 1) * 4 <= plain - start)
+        plain = plain[ok]
+        restart_count = restart_count[ok]
+        plain = plain[_u32_at(arr, plain - 4 - restart_count * 4) == 0]
+
+    # snappy: the compressed form can't be much longer than the uncompressed length it starts with
+    if preamble is None:
+        return plain
+    compressed = positions[block_type == 1]
+    compressed = compressed[compressed - start <= 32 + preamble + preamble // 6]
+    return np.sort(np.concatenate((plain, compressed)))
+
+
+def _find_block_end(mm, arr, start, limit, search):
+    '''
+    Returns (trailer offset, crc ok) for a table block beginning at start, or None. The trailer is the first position
+    holding a compression type whose CRC (over the block and that type byte) matches. Uncompressed blocks must also
+    end with a plausible restart array, which is checked for a whole window of positions at once before any CRC is
+    calculated. Windows start small and double, as most blocks are a few KiB.
+    '''
+    search_end = min(limit - BLOCK_TRAILER_SIZE, start + search)
+    preamble = _snappy_preamble(mm, start)
+    crc = 0
+    crc_end = start
+    lo = start + 1
+    window = 8192
+    while lo <= search_end:
+        hi = min(search_end + 1, lo + window)
+        for trailer in _block_end_candidates(arr, start, lo, hi, preamble).tolist():
+            # the running CRC carries on past trailers that don't match, as the block may carry on past them
+            crc = crc32c(mm[crc_end:trailer + 1], crc)
+            crc_end = trailer + 1
+            stored, = struct.unpack_from('<I', mm, trailer + 1)
+            if crc == unmask_crc(stored):
+                return trailer, True
+        lo = hi
+        window *= 2
+    return None
+
+
+def _decode_table_block(raw, compressed, offset):
+    # returns (list of (key, value, block offset), decoded completely) or None if this isn't a data block
+    if compressed:
+        raw = ccl_simplesnappy.decompress_buffer(raw)
+    if len(raw) < 8:
+        return None
+    block = ccl_leveldb.Block(raw, compressed, None, offset)
+    restart_offset = block._restart_array_offset
+    if restart_offset < 0 or block.get_restart_offset(0) != 0:
+        return None
+
+    entries = []
+    complete = True
+    try:
+        for key, value, block_offset in block.iterate_entry_views():
+            if len(key) < 8:
+                # table keys always end with an 8 byte sequence number and type
+                complete = False
+                break
+            entries.append((key, bytes(value), block_offset))
+    except (ValueError, IndexError):
+        complete = False
+
+    # index and meta index blocks map keys to BlockHandles of blocks before them
+    def is_handle(value):
+        try:
+            handle_offset, pos = ccl_leveldb._decode_varint32(value, 0)
+            _, pos = ccl_leveldb._decode_varint32(value, pos)
+        except IndexError:
+            return False
+        return pos == len(value) and handle_offset < offset
+
+    if entries and all(is_handle(value) for _, value, _ in entries):
+        return None
+    return entries, complete
+
+
+def carve_table(path):
+    '''
+    Yields a CarvedRecord for each record that can be recovered from a table (.ldb/.sst) file. Blocks are found by
+    walking the file from its start: where the footer and index survive their handles give each block's extent,
+    otherwise (e.g. a table left part written) a block ends at the first trailer whose CRC matches. When no block
+    can be found where the previous one ended, the next position which starts a block with a valid CRC is searched
+    for, and the damaged block between is decoded as far as it can be.
+    '''
+    path = pathlib.Path(path)
+    _warn_slow_crc()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from _carve_table_map(path, mm)
+
+
+def _read_handle_block(mm, handle):
+    raw = mm[handle.offset:handle.offset + handle.length]
+    compressed = mm[handle.offset + handle.length] == 1
+    return ccl_leveldb.Block(ccl_simplesnappy.decompress_buffer(raw) if compressed else raw, compressed, None,
+                             handle.offset)
+
+
+def _table_handles(mm):
+    # {block offset: (length, is data block)} from the footer, meta index and index, or {} if they can't be read
+    size = len(mm)
+    if size < FOOTER_SIZE or struct.unpack_from('<Q', mm, size - 8)[0] != ccl_leveldb.LdbFile.MAGIC:
+        return {}
+    try:
+        footer = io.BytesIO(mm[size - FOOTER_SIZE:size - 8])
+        meta_index_handle = ccl_leveldb.BlockHandle.from_stream(footer)
+        index_handle = ccl_leveldb.BlockHandle.from_stream(footer)
+        handles = {index_handle.offset: (index_handle.length, False)}
+        for entry in _read_handle_block(mm, index_handle):
+            handle = ccl_leveldb.BlockHandle.from_bytes(entry.value)
+            handles[handle.offset] = (handle.length, True)
+        if meta_index_handle.length:
+            handles[meta_index_handle.offset] = (meta_index_handle.length, False)
+            for entry in _read_handle_block(mm, meta_index_handle):
+                handle = ccl_leveldb.BlockHandle.from_bytes(entry.value)
+                handles[handle.offset] = (handle.length, False)
+    except (ValueError, IndexError, TypeError, struct.error):
+        return {}
+    if any(offset + length + BLOCK_TRAILER_SIZE > size for offset, (length, _) in handles.items()):
+        return {}
+    return handles
+
+
+def _carve_table_map(path, mm):
+    arr = np.frombuffer(mm, dtype=np.uint8)
+    handles = _table_handles(mm)
+    limit = len(mm) - FOOTER_SIZE if handles else len(mm)
+
+    start = 0
+    while start + BLOCK_TRAILER_SIZE < limit:
+        is_data = True
+        if start in handles:
+            length, is_data = handles[start]
+            trailer = start + length
+            stored, = struct.unpack_from('<I', mm, trailer + 1)
+            crc_ok = crc32c(mm[start:trailer + 1]) == unmask_crc(stored)
+            next_start = trailer + BLOCK_TRAILER_SIZE
+        else:
+            found = _find_block_end(mm, arr, start, limit, MAX_BLOCK_SEARCH)
+            if found is not None:
+                trailer, crc_ok = found
+                next_start = trailer + BLOCK_TRAILER_SIZE
+            else:
+                # the block here is damaged: it ends just before the next good block, if there is one
+                next_start = _resync_table(mm, arr, start, limit, handles)
+                trailer = (next_start if next_start is not None else limit) - BLOCK_TRAILER_SIZE
+                crc_ok = False
+
+        if is_data and trailer > start:
+            yield from _table_block_records(path, mm, start, trailer, crc_ok)
+        if next_start is None:
+            return
+        start = next_start
+
+
+def _table_block_records(path, mm, start, trailer, crc_ok):
+    compressed = mm[trailer] == 1
+    try:
+        decoded = _decode_table_block(mm[start:trailer], compressed, start)
+    except (ValueError, IndexError, struct.error):
+        decoded = None
+    if decoded is None:
+        return
+
+    entries, complete = decoded
+    if not crc_ok:
+        confidence = CarveConfidence.Low
+    else:
+        confidence = CarveConfidence.High if complete else CarveConfidence.Medium
+    for key, value, block_offset in entries:
+        record = ccl_leveldb.Record.ldb_record(
+            key, value, path, start if compressed else start + block_offset, compressed)
+        yield CarvedRecord(record, confidence, start)
+
+
+def _resync_table(mm, arr, start, limit, handles):
+    # the offset of the first block after start which is listed in the index or whose CRC matches, or None.
+    # Possible block starts follow a byte which could be a compression type, and begin either with an entry which
+    # shares nothing with a previous key (uncompressed) or with a snappy length then a literal
+    known = [offset for offset in handles if offset > start]
+    if known:
+        return min(known)
+    lo = start + BLOCK_TRAILER_SIZE + 1
+    hi = limit - BLOCK_TRAILER_SIZE
+    if hi <= lo:
+        return None
+    positions = np.arange(lo, hi, dtype=np.int64)
+    ok = (arr[positions - BLOCK_TRAILER_SIZE] <= 1) & ((arr[positions] == 0) | (arr[positions + 1] & 0x03 == 0) |
+                                                        (arr[positions + 2] & 0x03 == 0))
+    for candidate in positions[ok][:MAX_RESYNC_ATTEMPTS].tolist():
+        if _find_block_end(mm, arr, candidate, limit, RESYNC_BLOCK_SEARCH) is not None:
+            return candidate
+    return None
+
+
+def carve_file(path):
+    '''Dispatches to carve_log or carve_table by the file's suffix'''
+    path = pathlib.Path(path)
+    if path.suffix.lower() == '.log':
+        return carve_log(path)
+    return carve_table(path)
+
+
+def carve_leveldb(in_dir):
+    '''
+    Yields CarvedRecords from every .log, .ldb and .sst file in a LevelDB directory, whatever its name and whether
+    or not the manifest still lists it, in file name order.
+    '''
+    for path in sorted(pathlib.Path(in_dir).iterdir()):
+        if path.is_file() and path.suffix.lower() in CARVE_SUFFIXES:
+            yield from carve_file(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__description__)
+    parser.add_argument('-i', required=True, help='A LevelDB directory e.g. "Local Storage/leveldb"')
+    args = parser.parse_args()
+
+    if not (len(args.i) and isdir(abspath(args.i))):
+        print('[!!] Error: Please provide a directory for argument -i')
+        sys.exit()
+
+    totals = Counter()
+    for carved in carve_leveldb(args.i):
+        totals[(carved.record.origin_file.name, carved.confidence.name)] += 1
+    for (file_name, confidence), count in sorted(totals.items()):
+        print('{} | {} : {} records'.format(file_name, confidence, count))
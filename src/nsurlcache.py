@@ -0,0 +1,189 @@
+'''
+MIT License
+
+nsurlcache
+
+Copyright (c) 2022 Control-F Ltd
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+__version__ = 0.01
+__description__ = 'Control-F - nsurlcache - iOS Cache.db (NSURLCache) Parser'
+__contact__ = 'mike.bangham@controlf.co.uk'
+
+import os
+import sys
+import sqlite3
+import plistlib
+import argparse
+from collections import namedtuple
+from os.path import join as pj
+from os.path import abspath, dirname, isdir, isfile
+
+from src import sqlite_reader
+
+# NSURLSession's cache: one row per response in cfurl_cache_response (the request URL and when it was stored),
+# the archived request/response in cfurl_cache_blob_data and the body in cfurl_cache_receiver_data. Larger bodies
+# are kept as files in fsCachedData/ beside Cache.db, in which case receiver_data holds the file's UUID name.
+REQUIRED_TABLES = ('cfurl_cache_response', 'cfurl_cache_receiver_data')
+FS_CACHED_DATA_DIR = 'fsCachedData'
+CHUNK_SIZE = 64 * 1024
+
+CacheEntry = namedtuple('CacheEntry', ['entry_id', 'url', 'timestamp', 'storage_policy', 'data_on_fs', 'size',
+                                       'rowid', 'fs_uuid', 'response_object'])
+
+ENTRY_QUERY = """
+SELECT
+cfurl_cache_response.entry_ID,
+cfurl_cache_response.request_key,
+cfurl_cache_response.time_stamp,
+cfurl_cache_response.storage_policy,
+cfurl_cache_receiver_data.isDataOnFS,
+length(cfurl_cache_receiver_data.receiver_data),
+cfurl_cache_receiver_data.rowid,
+CASE WHEN cfurl_cache_receiver_data.isDataOnFS = 1
+    THEN CAST(cfurl_cache_receiver_data.receiver_data AS TEXT) END,
+{}
+FROM cfurl_cache_response
+LEFT JOIN cfurl_cache_receiver_data ON cfurl_cache_response.entry_ID = cfurl_cache_receiver_data.entry_ID
+{}
+ORDER BY cfurl_cache_response.entry_ID
+"""
+
+
+def _find_headers(obj):
+    # the archived NSHTTPURLResponse holds the response headers as a dictionary somewhere in its structure
+    if isinstance(obj, dict):
+        if any(isinstance(key, str) and key.lower() == 'content-type' for key in obj):
+            return obj
+        obj = list(obj.values())
+    if isinstance(obj, list):
+        for item in obj:
+            headers = _find_headers(item)
+            if headers:
+                return headers
+    return None
+
+
+def response_headers(response_object):
+    '''The HTTP response headers from a cfurl_cache_blob_data.response_object plist, or {}'''
+    if not response_object:
+        return dict()
+    try:
+        return _find_headers(plistlib.loads(response_object)) or dict()
+    except (plistlib.InvalidFileException, ValueError, TypeError, KeyError):
+        return dict()
+
+
+class CacheDb:
+    '''
+    Reads an NSURLCache Cache.db. Entries are listed without their bodies; bodies held in the database are streamed
+    to disk in chunks with incremental BLOB I/O, and those held in fsCachedData/ are linked to in place.
+    '''
+    def __init__(self, db_path, fs_cached_dir=None):
+        self.db_path = db_path
+        self.fs_cached_dir = fs_cached_dir or pj(dirname(abspath(db_path)), FS_CACHED_DATA_DIR)
+        self.database = sqlite_reader.Database(db_path)
+        missing = [table for table in REQUIRED_TABLES if not self.database.has_table(table)]
+        if missing:
+            self.database.close()
+            raise ValueError('{} is not an NSURLCache database (missing {})'.format(db_path, ', '.join(missing)))
+        self._has_blob_data = self.database.has_table('cfurl_cache_blob_data')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def iterate_entries(self):
+        if self._has_blob_data:
+            query = ENTRY_QUERY.format('cfurl_cache_blob_data.response_object',
+                                       'LEFT JOIN cfurl_cache_blob_data '
+                                       'ON cfurl_cache_response.entry_ID = cfurl_cache_blob_data.entry_ID')
+        else:
+            query = ENTRY_QUERY.format('NULL', '')
+        for row in self.database.conn.execute(query):
+            yield CacheEntry(*row)
+
+    def fs_cached_path(self, entry):
+        # the fsCachedData file for an entry whose body is on the file system, if it was extracted
+        if not entry.data_on_fs or not entry.fs_uuid:
+            return None
+        path = pj(self.fs_cached_dir, entry.fs_uuid.strip('\x00').strip())
+        return path if isfile(path) else None
+
+    def _read_chunks(self, rowid, size):
+        conn = self.database.conn
+        if hasattr(conn, 'blobopen'):
+            with conn.blobopen('cfurl_cache_receiver_data', 'receiver_data', rowid, readonly=True) as blob:
+                while True:
+                    chunk = blob.read(CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+        else:
+            # no incremental BLOB I/O before Python 3.11; substr reads the BLOB a chunk at a time instead
+            for start in range(1, size + 1, CHUNK_SIZE):
+                yield conn.execute('SELECT substr(receiver_data, ?, ?) FROM cfurl_cache_receiver_data '
+                                   'WHERE rowid = ?', (start, CHUNK_SIZE, rowid)).fetchone()[0]
+
+    def body_path(self, entry, out_dir):
+        '''
+        A path to the entry's body: its fsCachedData file, or a file in out_dir which the BLOB is streamed to.
+        None if the entry has no body.
+        '''
+        if entry.data_on_fs:
+            return self.fs_cached_path(entry)
+        if not entry.size or entry.rowid is None:
+            return None
+        os.makedirs(out_dir, exist_ok=True)
+        out_fp = pj(out_dir, 'cache_entry_{}'.format(entry.entry_id))
+        try:
+            with open(out_fp, 'wb') as f:
+                for chunk in self._read_chunks(entry.rowid, entry.size):
+                    f.write(chunk)
+        except sqlite3.Error:
+            return None
+        return out_fp
+
+    def close(self):
+        self.database.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__description__)
+    parser.add_argument('-i', required=True, help='An NSURLCache Cache.db')
+    parser.add_argument('-o', required=False, help='A directory to write the cached bodies to')
+    args = parser.parse_args()
+
+    if not (len(args.i) and isfile(abspath(args.i))):
+        print('[!!] Error: Please provide a Cache.db for argument -i')
+        sys.exit()
+    if args.o and not isdir(abspath(args.o)):
+        print('[!!] Error: Please provide a directory for argument -o')
+        sys.exit()
+
+    with CacheDb(abspath(args.i)) as cache:
+        for cache_entry in cache.iterate_entries():
+            body = cache.body_path(cache_entry, abspath(args.o)) if args.o else None
+            content_type = response_headers(cache_entry.response_object).get('Content-Type', '')
+            print('{} | {} | {} | {} bytes | {}'.format(cache_entry.timestamp, cache_entry.url, content_type,
+                                                        cache_entry.size, body or ''))
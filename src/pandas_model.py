@@ -30,7 +30,10 @@ class ModelDataFrame(QAbstractTableModel):
         if not index.isValid():
             return QVariant()
 
-        return QVariant(str(self._df[index.row(), index.column()]))
+        value = self._df[index.row(), index.column()]
+        if pd.api.types.is_scalar(value) and pd.isna(value):
+            return QVariant('')  # missing values (NaT in converted timestamp columns, NaN, None) are shown blank
+        return QVariant(str(value))
 
     def setData(self, index, value, role):
         # vertical and horizontal data
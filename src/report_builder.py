@@ -43,7 +43,7 @@ import pandas as pd
 from io import BytesIO
 from subprocess import Popen
 
-from src import utils
+from src import utils, ktx_2_png
 
 
 class XLSXReportThread(QThread):
@@ -60,6 +60,8 @@ class XLSXReportThread(QThread):
 
     def run(self):
         if self.has_media:
+            # the workbook links the full resolution images rather than the previews shown in the GUI
+            self.df = self.df.assign(media=ktx_2_png.full_images(self.df['media'].values.tolist()))
             self.progressSignal.emit(50)
             self.statusSignal.emit('Copying files to report location...')
             utils.copy_files(self.df['media'].values.tolist(), self.temp_dir, self.report_files)
@@ -31,16 +31,15 @@ import os
 from os.path import join as pj
 from os.path import isfile, abspath, dirname, basename, relpath
 import numpy as np
-import sqlite3
 import re
 import pathlib
 import pandas as pd
-from io import BytesIO
 from struct import unpack
 import shutil
 import logging
 
-from src import ccl_leveldb, crumbs, smidge, utils, ktx_2_png
+from src import ccl_leveldb, crumbs, smidge, utils, ktx_2_png, indexeddb, sqlite_reader, sql_artifacts, nsurlcache, \
+    timestamps
 
 
 def find_meta_block(f):
@@ -77,22 +76,33 @@ class IOSThread(QThread):
                                     'func': self.cookies,
                                     'args': None},
                                 'Safari History': {
-                                    'func': self.safari_history,
-                                    'args': None},
+                                    'func': self.sql_artifact,
+                                    'args': 'Safari History'},
                                 'Safari Browser Tabs': {
                                     'func': self.safari_tabs,
                                     'args': None},
+                                'Safari Bookmarks': {
+                                    'func': self.sql_artifact,
+                                    'args': 'Safari Bookmarks'},
+                                'Safari Favicons': {
+                                    'func': self.sql_artifact,
+                                    'args': 'Safari Favicons'},
                                 'Network Records-Blobs': {
                                     'func': self.blobs_and_records,
                                     'args': 'NetworkCache'},
                                 'Storage Records-Blobs': {
                                     'func': self.blobs_and_records,
                                     'args': 'CacheStorage'},
+                                'URL Cache': {
+                                    'func': self.url_cache,
+                                    'args': None},
                                 'App Cache': {
                                     'func': self.app_cache,
                                     'args': None},
                                     }
         self.used_files = list()
+        self.sql_results = None  # {artifact name: DataFrame} from sql_artifacts, run on first use
+        self.webkit_cache_results = None  # {cache type: records} from webkit_caches, run on first use
 
     def run(self):
         for webview_item, df_generator in self.generator_dict.items():
@@ -109,97 +119,52 @@ class IOSThread(QThread):
             self.progressSignal.emit([100, '{} - {} ({} rows)'.format(self.package, webview_item, len(df.index)), None])
         self.finishedSignal.emit([])
 
+    def sql_artifact(self, name):
+        # every SQL artifact for the package is matched and queried together, concurrently, the first time one of
+        # them is asked for
+        if self.sql_results is None:
+            abs_fps = list()
+            count = 0
+            for relative_fp in self.package_files:
+                abs_fp = abspath(str(self.output_dir) + str(relative_fp))
+                if isfile(abs_fp) and any(sub_path in abs_fp for sub_path in self.package_guids):
+                    abs_fps.append(abs_fp)
+                count += 1
+                self.progressSignal.emit([int(count / self.package_files_count * 100), None, None])
+            self.sql_results = sql_artifacts.run_artifacts(sql_artifacts.IOS_SQL_ARTIFACTS, abs_fps)
+        return self.sql_results.get(name, pd.DataFrame())
+
     def cookies(self):
+        '''
+        Every binarycookies file in the package's containers (app, app groups and extensions), parsed in worker
+        processes and merged into one DataFrame with the file(s) each cookie was found in
+        '''
+        cookie_fps = list()
         count = 0
         for relative_fp in self.package_files:
             abs_fp = abspath(str(self.output_dir) + str(relative_fp))
-            if isfile(abs_fp) and 'Cookies.binarycookies' in abs_fp and any(sub_path in abs_fp for
+            if isfile(abs_fp) and abs_fp.endswith('.binarycookies') and any(sub_path in abs_fp for
                                                                             sub_path in self.package_guids):
-                _, df = crumbs.CookieParser(abs_fp, 'df').process()
-                return df
-            count += 1
-            self.progressSignal.emit([int(count / self.package_files_count * 100), None, None])
-        return pd.DataFrame()
-
-    def safari_bookmarks(self):
-        count = 0
-        for relative_fp in self.package_files:
-            abs_fp = abspath(str(self.output_dir) + str(relative_fp))
-            if isfile(abs_fp) and 'Library' in abs_fp and abs_fp.endswith('Bookmarks.db') and \
-                    any(sub_path in abs_fp for sub_path in self.package_guids):
-
-                query = ("""SELECT
-                        title,
-                        url,
-                        hidden
-                        FROM bookmarks""")
-                df = utils.build_dataframe(abs_fp, None, query=query)
-                return df
-            count += 1
-            self.progressSignal.emit([int(count / self.package_files_count * 100), None, None])
-        return pd.DataFrame()
-
-    def safari_favicons(self):
-        count = 0
-        for relative_fp in self.package_files:
-            abs_fp = abspath(str(self.output_dir) + str(relative_fp))
-            if isfile(abs_fp) and 'Library' in abs_fp and abs_fp.endswith('Favicons.db') and \
-                    any(sub_path in abs_fp for sub_path in self.package_guids):
-
-                query = ("""SELECT 
-                        datetime('2001-01-01', "timestamp" || ' seconds') as Created,
-                        page_url.url AS 'URL',
-                        icon_info.url AS 'Icon URL,
-                        icon_info.width AS 'Width',
-                        icon_info.height AS 'Height'
-                        FROM icon_info
-                        LEFT JOIN page_url ON icon_info.uuid = page_url.uuid""")
-                df = utils.build_dataframe(abspath, None, query=query)
-                df = df.fillna('')
-                return df
+                cookie_fps.append(abs_fp)
             count += 1
             self.progressSignal.emit([int(count / self.package_files_count * 100), None, None])
+        if cookie_fps:
+            return crumbs.aggregate_cookies(cookie_fps, source_root=str(self.output_dir))
         return pd.DataFrame()
 
     def safari_tabs(self):
         '''
         Safari tab sessions sometimes have a KTX media file for the session page
         '''
-        query = (
-            """
-            SELECT
-            datetime('2001-01-01', last_viewed_time || ' seconds') AS 'Last Viewed',
-            title AS 'Title', 
-            url AS 'URL', 
-            CASE opened_from_link 
-                WHEN 1 THEN "Yes"
-                WHEN 0 THEN "No"
-                ELSE opened_from_link
-                END AS 'Opened Via Link',
-            CASE private_browsing 
-                WHEN 1 THEN "Yes"
-                WHEN 0 THEN "No"
-                ELSE private_browsing
-                END AS 'Private Browsing',
-            uuid AS 'UUID',
-            user_visible_url AS 'URL Visible to User' 
-            FROM tabs
-            """)
-
-        df = pd.DataFrame()
+        # the tabs from BrowserState.db
+        df = self.sql_artifact('Safari Browser Tabs')
         ktx_media_paths = dict()  # stores the UUID of the ktx file as a key and the value is the path
         count = 0
         for relative_fp in self.package_files:
             abs_fp = abspath(str(self.output_dir) + str(relative_fp))
-            if isfile(abs_fp) and 'Library' in abs_fp and abs_fp.endswith('BrowserState.db') and \
-                    any(sub_path in abs_fp for sub_path in self.package_guids):
-                # make a dataframe using the query above on BrowserState.db
-                df = utils.build_dataframe(abs_fp, None, query=query)
-                df = df.fillna('')
-
-            # these are the complimentary KTX files. we must reference them now and then 
+            # these are the complimentary KTX files. we must reference them now and then
             # convert and add to the df later
-            elif isfile(abs_fp) and 'Library' in abs_fp and abs_fp.endswith('.ktx') and \
+            if isfile(abs_fp) and 'Library' in abs_fp and abs_fp.endswith('.ktx') and \
                     any(sub_path in abs_fp for sub_path in self.package_guids):
                 ktx_media_paths[basename(abs_fp).split('.kt')[0]] = abs_fp
 
@@ -209,27 +174,24 @@ class IOSThread(QThread):
         # now we convert the KTX files to a readable file and add to our dataframe.
         if ktx_media_paths and not df.empty:
             ktx_count = len(ktx_media_paths.keys())
-            ktx = ktx_2_png.KTXReader()  # init the ktx converter
             ktx_png_paths = dict()  # new dictionary for our png files
+            # we convert the KTX to a PNG preview so it can be viewed; the conversions run in a process pool.
+            # The full resolution PNG is decoded when the image is opened (see ktx_2_png.full_image)
+            jobs = [(ktx_fp, ktx_2_png.preview_path(abspath(ktx_fp))) for ktx_fp in ktx_media_paths.values()]
+            uuids = {ktx_fp: uuid for uuid, ktx_fp in ktx_media_paths.items()}
 
             count = 0
-            for uuid, ktx_fp in ktx_media_paths.items():
-                # we will be converting the KTX to PNG so it can be viewed
-                ktx_png_fp = abspath(pj(dirname(ktx_fp), '{}.png'.format(basename(ktx_fp))))
-
-                try:
-                    ktx_f_bytes = BytesIO(open(ktx_fp, 'rb').read())
-                    ktx.convert_to_png(ktx_f_bytes, ktx_png_fp)
-                    self.used_files.append(ktx_fp)  # make sure we dont process this again in other_sources
-                except Exception as err:
-                    logging.error('{} - {}'.format(basename(ktx_fp), err))
+            for ktx_fp, ktx_png_fp, error in ktx_2_png.convert_ktx_files(jobs, max_size=ktx_2_png.PREVIEW_SIZE):
+                if error:
+                    logging.error('{} - {}'.format(basename(ktx_fp), error))
                     # copy a blank so it displays in the GUI
-                    shutil.copy(utils.resource_path('blank_jpeg.png'), ktx_png_fp)  
-
-                ktx_png_paths[uuid] = ktx_png_fp  # for our dataframe
+                    shutil.copy(utils.resource_path('blank_jpeg.png'), ktx_png_fp)
+                else:
+                    self.used_files.append(ktx_fp)  # make sure we dont process this again in other_sources
+                ktx_png_paths[uuids[ktx_fp]] = ktx_png_fp  # for our dataframe
 
-                self.progressSignal.emit([int(count / ktx_count * 100),  None, None])
                 count += 1
+                self.progressSignal.emit([int(count / ktx_count * 100), None, None])
 
             # add a media column to our dataframe and map the ktx_png_paths to their UUID in the df
             df['media'] = df['UUID'].map(ktx_png_paths)
@@ -237,55 +199,27 @@ class IOSThread(QThread):
 
         return df  # will be empty if nothing is found
 
-
-    def safari_history(self):
-        count = 0
-        for relative_fp in self.package_files:
-            abs_fp = abspath(str(self.output_dir) + str(relative_fp))
-            if isfile(abs_fp) and 'Library' in abs_fp and abs_fp.endswith('History.db') and \
-                    any(sub_path in abs_fp for sub_path in self.package_guids):
-
-                query = (
-                    """SELECT datetime('2001-01-01', history_visits.visit_time || ' seconds') AS 'Created Time',
-                    history_items.url AS 'URL',
-                    history_items.visit_count AS 'Visit Count',
-                    history_visits.title 'Title',
-                    CASE history_visits.origin
-                        WHEN 1 THEN "iCloud Sync"
-                        WHEN 0 THEN "This Device"
-                        ELSE history_visits.origin
-                        END AS "Source",
-                    CASE history_visits.load_successful
-                        WHEN 1 THEN "Yes"
-                        WHEN 0 THEN "No"
-                        ELSE history_visits.load_successful
-                        END AS "Request Successful",
-                    history_visits.id,
-                    CAST(history_visits.redirect_source AS INT) AS 'Redirected From',
-                    CAST(history_visits.redirect_destination AS INT) AS 'Redirected To'
-                    FROM history_items
-                    LEFT JOIN history_visits ON history_items.id = history_visits.history_item
-                    """)
-                df = utils.build_dataframe(abs_fp, None, query=query)
-                df = df.fillna('')
-                return df
-
-            count += 1
-            self.progressSignal.emit([int(count / self.package_files_count * 100), None, None])
-        return pd.DataFrame()
-
-    def blobs_and_records(self, cache_type):
-        records = list()
+    def webkit_caches(self):
+        '''
+        Both WebKit caches (NetworkCache and CacheStorage) are gathered in one pass of the package files, the first
+        time either is asked for. BLOBs are identified as they are found; record files are parsed together in a
+        process pool. A file whose path matches both cache types is reported under both.
+        Returns {cache type: [record/blob dict, ...]} in package file order.
+        '''
+        if self.webkit_cache_results is not None:
+            return self.webkit_cache_results
+        cache_types = ('NetworkCache', 'CacheStorage')
+        results = {cache_type: list() for cache_type in cache_types}
+        record_jobs = list()
         origin_files = dict()
         count = 0
         for relative_fp in self.package_files:
             abs_fp = abspath(str(self.output_dir) + str(relative_fp))
-            if isfile(abs_fp) and cache_type in abs_fp and \
-                    ('Records' in abs_fp or 'Blobs' in abs_fp) and \
+            matched = [c for c in cache_types if c in abs_fp]
+            if matched and isfile(abs_fp) and ('Records' in abs_fp or 'Blobs' in abs_fp) and \
                     any(sub_path in abs_fp for sub_path in self.package_guids):
                 if basename(abs_fp) == 'origin':
                     origin_files[basename(dirname(abs_fp))] = parse_origin(abs_fp)
-                    print(origin_files)
                 else:
                     # Else lets try and parse it as a file
                     with open(abs_fp, 'rb') as f:
@@ -302,29 +236,37 @@ class IOSThread(QThread):
                                 blob['Mime Type'] = mime_type[0]
                                 blob['File Type'] = mime_type[1]
                                 blob['File Name'] = basename(abs_fp)
-                                blob['Asset'] = 'BLOB'.format(cache_type)
-                                records.append(blob)
+                                blob['Asset'] = 'BLOB'
+                                for cache_type in matched:
+                                    results[cache_type].append(dict(blob))
                         else:
-                            # First parse the file as a record.
-                            rp = smidge.RecordParser(abs_fp, 'file', 'dict', dirname(abs_fp))
-                            try:
-                                parsed_count, _dict, errors = rp.process()
-                                if _dict:
-                                    _dict[0]['Asset'] = 'Record'.format(cache_type)
-                                    records.append(_dict[0])
-                            except Exception as e:
-                                logging.error(e)
-                                continue
+                            # parsed as a record below; its place in the results is held by its path
+                            record_jobs.append((abs_fp, dirname(abs_fp)))
+                            for cache_type in matched:
+                                results[cache_type].append(abs_fp)
             count += 1
             self.progressSignal.emit([int(count / self.package_files_count * 100), None, None])
 
-        if records:
-            for r in records:
-                try:
-                    del r['content']  # Only in records, not blob dicts
-                except KeyError:
-                    pass
+        parsed = dict()
+        count = 0
+        for abs_fp, records, errors in smidge.parse_record_files(record_jobs):
+            for error in errors['errors']:
+                logging.error(error)
+            if records:
+                records[0]['Asset'] = 'Record'
+                parsed[abs_fp] = records[0]
+            count += 1
+            self.progressSignal.emit([int(count / len(record_jobs) * 100), None, None])
 
+        self.webkit_cache_results = {
+            cache_type: [dict(parsed[item]) if isinstance(item, str) else item for item in items
+                         if not isinstance(item, str) or item in parsed]
+            for cache_type, items in results.items()}
+        return self.webkit_cache_results
+
+    def blobs_and_records(self, cache_type):
+        records = self.webkit_caches()[cache_type]
+        if records:
             df = pd.DataFrame(records)
             reordered_cols = ['media', 'File Name', 'File Type', 'Mime Type', 'Asset']
             # Extend the reordered column with the rest (removing those already ordered above)
@@ -335,6 +277,56 @@ class IOSThread(QThread):
 
         return pd.DataFrame()
 
+    def url_cache(self):
+        '''
+        NSURLCache Cache.db files; each cached response with its URL and body. Bodies stored in the database are
+        streamed out beside it, those in fsCachedData are used in place.
+        '''
+        records = list()
+        count = 0
+        for relative_fp in self.package_files:
+            abs_fp = abspath(str(self.output_dir) + str(relative_fp))
+            if isfile(abs_fp) and basename(abs_fp) == 'Cache.db' and \
+                    any(sub_path in abs_fp for sub_path in self.package_guids) and sqlite_reader.is_sqlite(abs_fp):
+                try:
+                    cache = nsurlcache.CacheDb(abs_fp)
+                except Exception as err:
+                    logging.error('{} - {}'.format(abs_fp, err))
+                else:
+                    with cache:
+                        bodies_dir = pj(dirname(abs_fp), 'Cache.db_bodies')
+                        for entry in cache.iterate_entries():
+                            record = dict()
+                            body_fp = cache.body_path(entry, bodies_dir)
+                            if body_fp:
+                                self.used_files.append(body_fp)  # make sure we dont process this again in app_cache
+                                with open(body_fp, 'rb') as f:
+                                    header = f.read(100)
+                                mime_type = utils.get_file_mimetype(header) if header else None
+                                if mime_type:
+                                    record['media'] = body_fp
+                                    record['Mime Type'] = mime_type[0]
+                                    record['File Type'] = mime_type[1]
+                            headers = nsurlcache.response_headers(entry.response_object)
+                            record['Timestamp'] = entry.timestamp
+                            record['URL'] = entry.url
+                            record['Content-Type'] = headers.get('Content-Type', '')
+                            record['Size'] = entry.size
+                            record['Stored In'] = 'fsCachedData' if entry.data_on_fs else 'Cache.db'
+                            record['File Name'] = basename(body_fp) if body_fp else ''
+                            record['Source'] = relpath(abs_fp, str(self.output_dir))
+                            records.append(record)
+            count += 1
+            self.progressSignal.emit([int(count / self.package_files_count * 100), None, None])
+
+        if records:
+            df = pd.DataFrame(records)
+            df.replace(np.nan, '', regex=True, inplace=True)
+            # time_stamp is the UTC date and time as text
+            df['Timestamp'] = pd.to_datetime(df['Timestamp'], errors='coerce')
+            return df
+        return pd.DataFrame()
+
     def app_cache(self):
         records = list()
         count = 0
@@ -382,35 +374,41 @@ class AndroidThread(QThread):
                     'HTTP Cache': self.http_cache,
                     'Cookies': self.cookies,
                     'LocalStorage': self.leveldb,
+                    'IndexedDB': self.indexeddb,
                     'App Cache': self.app_cache
                     }
 
         self.used_files = list()
+        # read-only connections shared by every artifact for this package; opened and closed in run()'s thread
+        self.databases = sqlite_reader.DatabaseCache()
 
     def run(self):
-        for webview_item, df_generator in self.generator_dict.items():
-            self.progressSignal.emit([0, 'Processing {}...'.format(webview_item), None])
-            report_name = 'Shomium - {} - {}'.format(self.package, webview_item)
-            df = df_generator()
-            self.progressSignal.emit([100,
-                                      'Finished processing {}...'.format(webview_item),
-                                      [df, self.package_files, report_name, self.output_dir,
-                                       self.package, webview_item]])
-            self.progressSignal.emit([100, '{} - {} ({} rows)'.format(self.package, webview_item, len(df.index)), None])
+        try:
+            for webview_item, df_generator in self.generator_dict.items():
+                self.progressSignal.emit([0, 'Processing {}...'.format(webview_item), None])
+                report_name = 'Shomium - {} - {}'.format(self.package, webview_item)
+                df = df_generator()
+                self.progressSignal.emit([100,
+                                          'Finished processing {}...'.format(webview_item),
+                                          [df, self.package_files, report_name, self.output_dir,
+                                           self.package, webview_item]])
+                self.progressSignal.emit([100, '{} - {} ({} rows)'.format(self.package, webview_item,
+                                                                          len(df.index)), None])
+        finally:
+            self.databases.close()
         self.finishedSignal.emit([])
 
     def cookies(self):
         count = 0
         for relative_fp in self.package_files:
             abs_fp = abspath(pj(self.output_dir, 'data', 'data', relative_fp))
-            if isfile(abs_fp) and 'cookies' in basename(abs_fp).lower():
-                with open(abs_fp, 'rb') as sql:
-                    if b'SQLite format 3' not in sql.read(16):
-                        pass
-                    else:
-                        cnx = sqlite3.connect(abs_fp)
-                        df = pd.read_sql_query("SELECT * FROM cookies", cnx)
-                        return df
+            if isfile(abs_fp) and 'cookies' in basename(abs_fp).lower() and sqlite_reader.is_sqlite(abs_fp):
+                database = self.databases.get(abs_fp)
+                if database.has_table('cookies'):
+                    # Chromium stores these in WebKit microseconds; 0 is unset (e.g. a session cookie's expiry)
+                    return timestamps.convert_columns(database.read_table('cookies'), {
+                        'creation_utc': 'webkit', 'expires_utc': 'webkit', 'last_access_utc': 'webkit',
+                        'last_update_utc': 'webkit'})
             count += 1
             self.progressSignal.emit([int(count/self.package_files_count*100), None, None])
         return pd.DataFrame()
@@ -497,30 +495,67 @@ class AndroidThread(QThread):
             if isfile(abs_fp) and pj('Local Storage', 'leveldb') in abs_fp and abs_fp.endswith('.log'):
                 # ----------------------------------------------------------------------------
                 # modified code from ccl script 'dump_leveldb.py'
-                leveldb_records = ccl_leveldb.RawLevelDb(pathlib.Path(dirname(abs_fp)))
-                cols = ["key-hex", "key-text", "value-hex", "value-text", "origin_file",
-                        "file_type", "offset", "seq", "state", "was_compressed"]
-                rows = list()
-                for record in leveldb_records.iterate_records_raw():
-                    rows.append([
-                        record.user_key.hex(" ", 1),
-                        record.user_key.decode("iso-8859-1", "replace"),
-                        record.value.hex(" ", 1),
-                        record.value.decode("iso-8859-1", "replace"),
-                        str(record.origin_file),
-                        record.file_type.name,
-                        record.offset,
-                        record.seq,
-                        record.state.name,
-                        record.was_compressed
-                    ])
-                if rows:
-                    df = pd.DataFrame(rows, columns=cols)
-                    df.drop(['key-hex', 'value-hex'], axis=1, inplace=True)
-                    return df
+                # records are read as one columnar batch per file, so no per-record objects are created
+                with ccl_leveldb.RawLevelDb(pathlib.Path(dirname(abs_fp))) as leveldb_records:
+                    frames = list()
+                    for batch in leveldb_records.iterate_record_batches():
+                        if len(batch):
+                            frames.append(pd.DataFrame({
+                                "key-text": batch.user_key_strings("iso-8859-1"),
+                                "value-text": batch.value_strings("iso-8859-1"),
+                                "origin_file": batch.file_paths(),
+                                "file_type": batch.file_type_names(),
+                                "offset": batch.offset,
+                                "seq": batch.seq,
+                                "state": batch.state_names(),
+                                "was_compressed": batch.was_compressed
+                            }))
+                if frames:
+                    return pd.concat(frames, ignore_index=True)
+
+            count += 1
+            self.progressSignal.emit([int(count/self.package_files_count*100), None, None])
+        return pd.DataFrame()
+
+    def indexeddb(self):
+        cols = ["origin", "database", "object_store", "key", "value-text", "origin_file",
+                "file_type", "offset", "seq", "state", "was_compressed"]
+        rows = list()
+        idb_dirs = set()
+        count = 0
+        for relative_fp in self.package_files:
+            abs_fp = abspath(pj(self.output_dir, 'data', 'data', relative_fp))
+            idb_dir = dirname(abs_fp)
+            if isfile(abs_fp) and idb_dir.endswith('.indexeddb.leveldb') and idb_dir not in idb_dirs:
+                idb_dirs.add(idb_dir)
+                try:
+                    with indexeddb.IndexedDb(pathlib.Path(idb_dir)) as idb:
+                        # each object store is scanned on its own so only its blocks are decompressed
+                        for (db_id, object_store_id), store in sorted(idb.object_stores.items()):
+                            database = idb.databases[db_id]
+                            for idb_record in idb.iterate_object_store(db_id, object_store_id):
+                                record = idb_record.record
+                                rows.append([
+                                    database.origin,
+                                    database.name,
+                                    store.name,
+                                    str(idb_record.key),
+                                    idb_record.value.decode("iso-8859-1", "replace"),
+                                    str(record.origin_file),
+                                    record.file_type.name,
+                                    record.offset,
+                                    record.seq,
+                                    record.state.name,
+                                    record.was_compressed
+                                ])
+                except Exception as e:
+                    logging.error('{} - {}'.format(idb_dir, e))
 
             count += 1
             self.progressSignal.emit([int(count/self.package_files_count*100), None, None])
+
+        if rows:
+            return pd.DataFrame(rows, columns=cols)
         return pd.DataFrame()
 
     def app_cache(self):
@@ -553,3 +588,29 @@ class AndroidThread(QThread):
             return pd.DataFrame(app_cache)
 
         return pd.DataFrame()
+
+
+class TimelineThread(QThread):
+    '''
+    Merges the events collected in a timeline.TimelineBuilder (every package's timestamped artifacts) and writes
+    the merged timeline to a CSV file
+    '''
+    finishedSignal = pyqtSignal(list)
+    progressSignal = pyqtSignal(list)
+
+    def __init__(self, *args):
+        QThread.__init__(self, parent=None)
+        self.timeline_builder, self.output_fp = args
+
+    def run(self):
+        self.progressSignal.emit([0, 'Merging {} timeline events...'.format(self.timeline_builder.event_count), None])
+        try:
+            merged = self.timeline_builder.build()
+            self.progressSignal.emit([50, 'Writing timeline ({} to {})...'.format(merged.start, merged.end), None])
+            count = merged.to_csv(self.output_fp)
+        except Exception as err:
+            logging.error('Timeline - {}'.format(err))
+            self.finishedSignal.emit([None, 0])
+            return
+        self.progressSignal.emit([100, None, None])
+        self.finishedSignal.emit([self.output_fp, count])
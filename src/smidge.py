@@ -24,50 +24,210 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
-__version__ = 0.01
+__version__ = 0.02
 __description__ = 'Control-F - smidge - Apple Binary Record Parser'
 __contact__ = 'mike.bangham@controlf.co.uk'
 
 import sys
 import os
+import struct
+import concurrent.futures
 from os.path import abspath, isfile, isdir, basename
 from os.path import join as pj
-from struct import unpack
-from collections import namedtuple
+from collections import deque
 import argparse
+import tempfile
+import json
 import time
 import csv
 
 # Apple cocoa timestamp epoch
 cocoa_delta = 978307200
+# record content is copied to disk in chunks of this size, and records are framed in chunks of RECORD_CHUNK
+CONTENT_CHUNK = 1024 * 1024
+RECORD_CHUNK = 1000
 
-
-def generate_dataframe(records_dict):
-    import pandas as pd
-    df = pd.DataFrame(records_dict)
-    return df
+# A record's metadata (everything before its content) is read in one read of HEADER_READ bytes - more if it doesn't
+# fit - and decoded from that buffer. Each component is a 4 byte little endian unsigned length, a signed char that
+# is always \x01 and then the payload.
+RECORD_MAGIC = b'\x0E\x00\x00\x00'
+METADATA_END = b'\xc8\x00\x00\x00'  # xc8 is consistent in most cases with the end of the metadata
+HEADER_READ = 64 * 1024
+U32 = struct.Struct('<I')
 
 
-def generate_csv(records_dict):
+def generate_dataframe(records):
+    # records is any iterable of record dicts; they're framed a chunk at a time
+    import pandas as pd
+    frames = list()
+    chunk = list()
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == RECORD_CHUNK:
+            frames.append(pd.DataFrame(chunk))
+            chunk = list()
+    if chunk:
+        frames.append(pd.DataFrame(chunk))
+    if not frames:
+        return pd.DataFrame()
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+
+def generate_csv(records):
+    # records is any iterable of record dicts. Records have different header keys, so they're spilled to a
+    # temporary file as they arrive and the CSV is written once every column is known.
     fn = 'binary_records_{}.csv'.format(int(time.time()))
-
-    with open(fn, 'w', newline='') as csv_out:
-        dict_writer = csv.DictWriter(csv_out, records_dict[0].keys())
-        dict_writer.writeheader()
-        dict_writer.writerows(records_dict)
-
+    columns = dict()
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as spill:
+        for record in records:
+            columns.update(dict.fromkeys(record))
+            spill.write(json.dumps(record) + '\n')
+        if not columns:
+            return None
+        spill.seek(0)
+        with open(fn, 'w', newline='') as csv_out:
+            dict_writer = csv.DictWriter(csv_out, list(columns))
+            dict_writer.writeheader()
+            for line in spill:
+                dict_writer.writerow(json.loads(line))
     return fn
 
 
-def unpacker(struct_arg, data, fields=None):
-    # Accepts a struct argument, the packed binary data and optional fields.
-    if fields:
-        # returns a dictionary where the field is the key and the unpacked data is value.
-        attr1 = namedtuple('struct', fields)
-        return attr1._asdict(attr1._make(unpack(struct_arg, data)))
-    else:
-        # or just return value of single argument
-        return unpack(struct_arg, data)[0]
+class _TruncatedHeader(Exception):
+    # the metadata runs past the end of the buffer; more of the file is needed
+    pass
+
+
+class _HeaderReader:
+    # walks a record's metadata in a memoryview of one buffer
+    def __init__(self, buffer, complete):
+        self.view = memoryview(buffer)
+        self.complete = complete  # the buffer holds the whole file
+        self.pos = 0
+
+    def need(self, size):
+        if self.pos + size > len(self.view):
+            if self.complete:
+                raise ValueError('record metadata is truncated')
+            raise _TruncatedHeader()
+
+    def skip(self, size):
+        self.need(size)
+        self.pos += size
+
+    def raw(self, size):
+        self.need(size)
+        self.pos += size
+        return bytes(self.view[self.pos - size:self.pos])
+
+    def payload(self, length):
+        self.skip(1)  # signed char \x01
+        self.need(length)
+        self.pos += length
+        return str(self.view[self.pos - length:self.pos], 'utf-8')
+
+    def component(self):
+        self.need(U32.size)
+        length = U32.unpack_from(self.view, self.pos)[0]
+        self.pos += U32.size
+        return self.payload(length)
+
+
+def decode_record_metadata(buffer, path, complete=True):
+    '''
+    Decodes a record's metadata from the start of the file (buffer). Returns (record, content offset, errors), or
+    None if the buffer isn't a record. Raises _TruncatedHeader if complete is False and more of the file is needed.
+    '''
+    if bytes(buffer[0:4]) != RECORD_MAGIC:
+        return None
+    reader = _HeaderReader(buffer, complete)
+    reader.skip(4)
+    error_list = list()
+    record = dict()
+    record['path'] = path
+    # We have to allow for some arbitrary data along the way however
+    for r in ['File Name', 'File Type', 'URL']:
+        record[r] = reader.component()
+    reader.skip(130)  # 130 bytes of arbitrary data
+    record['URL_2'] = reader.component()
+    record['Mime Type'] = reader.component()
+    reader.skip(12)  # 12 bytes of arbitrary data
+    for r in ['Status', 'Protocol']:
+        record[r] = reader.component()
+    reader.skip(8)  # 8 bytes of arbitrary data
+
+    # Until we reach the record content we have key value pairs. Each key and value is recorded in the
+    # same way as before so we need to pair them up.
+    while True:
+        length = reader.raw(4)
+        if length == METADATA_END:
+            break
+        try:
+            key = reader.payload(U32.unpack(length)[0])
+            value = reader.component()
+            record[key] = value
+        except (ValueError, UnicodeDecodeError) as e:
+            error_list.append(e)
+            break
+
+    reader.skip(49)  # A 4 byte signed int, a signed char byte + 56 bytes of arbitrary data up to the content
+    return record, reader.pos, error_list
+
+
+def _parse_record_file(fp, output_dir):
+    # the process pool's unit of work: one record file, parsed with its content written to output_dir
+    parser = RecordParser(fp, 'file', 'dict', output_dir)
+    return list(parser.iter_records()), parser.errors
+
+
+def parse_record_files(jobs, workers=None):
+    '''
+    Parses many record files in a process pool. jobs is an iterable of (record file, output dir); yields
+    (record file, records, errors) for each, in the order given. A bounded window of files is in flight at once.
+    '''
+    jobs = list(jobs)
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(jobs) < 2:
+        for fp, output_dir in jobs:
+            yield (fp,) + _parse_record_file(fp, output_dir)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        window = deque()
+        pending = iter(jobs)
+        window_size = workers * 2
+
+        def fill():
+            while len(window) < window_size:
+                job = next(pending, None)
+                if job is None:
+                    return
+                window.append((job[0], executor.submit(_parse_record_file, *job)))
+
+        fill()
+        while window:
+            fp, future = window.popleft()
+            fill()
+            try:
+                yield (fp,) + future.result()
+            except Exception as err:
+                yield fp, list(), dict(non_records=list(), errors=['Could not parse: {} {}'.format(basename(fp),
+                                                                                                   err)])
+
+
+class _CountingIterator:
+    # passes records through, counting them, so the output functions can consume the stream directly
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self._iterator)
+        self.count += 1
+        return item
 
 
 class RecordParser:
@@ -84,95 +244,81 @@ class RecordParser:
         else:
             self.errors['errors'].append('Could not parse: {} {}'.format(basename(f), err))
 
-    def process(self):
+    def input_files(self):
         if self.input_type == 'file':
-            bf = open(self._input, 'rb')
-            record = self.generate_record(bf, self._input)
+            return [self._input]
+        return [pj(self._input, file) for file in sorted(os.listdir(self._input))]
+
+    def iter_records(self):
+        '''
+        Parses the input a record at a time, yielding each record's metadata. The content of each record is
+        written to output_dir as it is read (see 'media') and isn't kept; each file is closed before the next.
+        '''
+        for fp in self.input_files():
+            try:
+                with open(fp, 'rb') as bf:
+                    record = self.generate_record(bf, fp)
+            except Exception as err:
+                self.log_errors(err, fp)
+                continue
             if record[0]:
-                self.records.append(record[1])
+                yield record[1]
             else:
-                self.log_errors(record[1], self._input)
+                self.log_errors(record[1], fp)
+
+    def process(self):
+        if self.output_format == 'dict':
+            self.records = list(self.iter_records())
+            parsed_count, output = len(self.records), self.records
         else:
-            for file in os.listdir(self._input):
-                bf = open(pj(self._input, file), 'rb')
-                record = self.generate_record(bf, pj(self._input, file))
-                if record[0]:
-                    self.records.append(record[1])
-                else:
-                    self.log_errors(record[1], pj(self._input, file))
-
-        if self.records:
-            if self.output_format == 'dict':
-                return len(self.records), self.records, self.errors
-            elif self.output_format == 'csv':
-                return len(self.records), generate_csv(self.records), self.errors
+            records = _CountingIterator(self.iter_records())
+            if self.output_format == 'csv':
+                output = generate_csv(records)
             else:  # df
-                return len(self.records), generate_dataframe(self.records), self.errors
+                output = generate_dataframe(records)
+            parsed_count = records.count
 
+        if parsed_count:
+            return parsed_count, output, self.errors
         return 0, None, self.errors
 
-    def read_payload(self, length, bf):
-        bf.read(1)  # signed char \x01
-        return bf.read(length).decode()
-
     def generate_record(self, bf, f):
-        error_list = list()
-        record = dict()
-        # Extract 1 x 4 byte char[] 'magic'
-        magic = unpacker('>4s', bf.read(4))
-        if magic == b'\x0E\x00\x00\x00':
-            record['path'] = f
-            # Each component in the record is structured with a 4 byte little endian unsigned integer,
-            # a signed signed integer that is always \x01 and then the record payload. Knowing this, we
-            # can loop through this structure.
-            # We have to allow for some arbitrary data along the way however
-
-            for r in ['File Name', 'File Type', 'URL']:
-                record[r] = self.read_payload(unpacker('<I', bf.read(4)), bf)
-
-            bf.read(130)  # 130 bytes of arbitrary data
-            record['URL_2'] = self.read_payload(unpacker('<I', bf.read(4)), bf)
-            record['Mime Type'] = self.read_payload(unpacker('<I', bf.read(4)), bf)
-            bf.read(12)  # 12 bytes of arbitrary data
-
-            for r in ['Status', 'Protocol']:
-                record[r] = self.read_payload(unpacker('<I', bf.read(4)), bf)
-
-            bf.read(8)  # 8 bytes of arbitrary data
-
-            # Until we reach the record content we have key value pairs. Each key and value is recorded in the
-            # same way as before so we need to pair them up.
-            while True:
-                length = bf.read(4)
-                if length != b'\xc8\x00\x00\x00':  # xc8 is consistent in most cases with the end of the metadata
-                    try:
-                        key = self.read_payload(unpacker('<I', length), bf)
-                        value = self.read_payload(unpacker('<I', bf.read(4)), bf)
-                        record[key] = value
-                    except Exception as e:
-                        error_list.append(e)
-                        break
-                else:
+        # the metadata is read in one buffer (grown if it doesn't fit) and decoded from it
+        buffer = bf.read(HEADER_READ)
+        while True:
+            try:
+                decoded = decode_record_metadata(buffer, f, complete=len(buffer) < HEADER_READ)
+                break
+            except _TruncatedHeader:
+                more = bf.read(len(buffer))
+                buffer += more
+                if len(more) == 0:
+                    decoded = decode_record_metadata(buffer, f, complete=True)
                     break
+        if decoded is None:
+            return False, 'not_a_record'
+        record, content_offset, error_list = decoded
+
+        # One of the key value pairs parsed earlier contained the content length. The content is copied
+        # straight to its file a chunk at a time rather than held in the record
+        remaining = int(record['Content-Length'])
+        bf.seek(content_offset)
+        fn = pj(self.output_dir, '{}.{}'.format(basename(f), record['Mime Type'].split('/')[1]))
+        with open(fn, 'wb') as out_f:
+            while remaining > 0:
+                chunk = bf.read(min(CONTENT_CHUNK, remaining))
+                if not chunk:
+                    break
+                out_f.write(chunk)
+                remaining -= len(chunk)
+        record['media'] = fn
 
-            bf.read(49)  # A 4 byte signed int, a signed char byte + 56 bytes of arbitrary data up to the content
-            # One of the key value pairs parsed earlier contained the content length
-            record['content'] = bf.read(int(record['Content-Length']))
-
-            fn = pj(self.output_dir, '{}.{}'.format(basename(f), record['Mime Type'].split('/')[1]))
-            with open(fn, 'wb') as f:
-                f.write(record['content'])
-            record['media'] = fn
-
-            self.count += 1
-
-            if error_list:
-                return False, error_list
+        self.count += 1
 
-            return True, record
+        if error_list:
+            return False, error_list
 
-        else:
-            return False, 'not_a_record'
+        return True, record
 
 
 if __name__ == '__main__':
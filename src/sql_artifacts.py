@@ -0,0 +1,191 @@
+'''
+MIT License
+
+sql_artifacts
+
+Copyright (c) 2022 Control-F Ltd
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+__version__ = 0.01
+__description__ = 'Control-F - sql_artifacts - SQLite artifact registry'
+__contact__ = 'mike.bangham@controlf.co.uk'
+
+import logging
+import sqlite3
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from pandas.api.types import is_datetime64_any_dtype
+
+from src import sqlite_reader, timestamps
+
+# An artifact is a query against one kind of database: `matches` picks the database out of a package's files by
+# its path, `tables` must all exist for the query to be run and `post_process` tidies the resulting DataFrame.
+SqlArtifact = namedtuple('SqlArtifact', ['name', 'matches', 'tables', 'query', 'post_process'])
+
+
+def fill_blanks(df):
+    # datetime columns keep NaT, so they stay datetime64
+    return df.fillna({column: '' for column in df.columns if not is_datetime64_any_dtype(df[column])})
+
+
+def convert_times(columns):
+    # a post_process converting {column: timestamp format} with the timestamps module, then filling blanks
+    return lambda df: fill_blanks(timestamps.convert_columns(df, columns))
+
+
+def _library_db(file_name):
+    return lambda abs_fp: 'Library' in abs_fp and abs_fp.endswith(file_name)
+
+
+IOS_SQL_ARTIFACTS = (
+    SqlArtifact(
+        'Safari History',
+        _library_db('History.db'),
+        ('history_items', 'history_visits'),
+        """SELECT history_visits.visit_time AS 'Created Time',
+        history_items.url AS 'URL',
+        history_items.visit_count AS 'Visit Count',
+        history_visits.title 'Title',
+        CASE history_visits.origin
+            WHEN 1 THEN "iCloud Sync"
+            WHEN 0 THEN "This Device"
+            ELSE history_visits.origin
+            END AS "Source",
+        CASE history_visits.load_successful
+            WHEN 1 THEN "Yes"
+            WHEN 0 THEN "No"
+            ELSE history_visits.load_successful
+            END AS "Request Successful",
+        history_visits.id,
+        CAST(history_visits.redirect_source AS INT) AS 'Redirected From',
+        CAST(history_visits.redirect_destination AS INT) AS 'Redirected To'
+        FROM history_items
+        LEFT JOIN history_visits ON history_items.id = history_visits.history_item
+        """,
+        convert_times({'Created Time': 'cocoa'})),
+    SqlArtifact(
+        'Safari Browser Tabs',
+        _library_db('BrowserState.db'),
+        ('tabs',),
+        """
+        SELECT
+        last_viewed_time AS 'Last Viewed',
+        title AS 'Title',
+        url AS 'URL',
+        CASE opened_from_link
+            WHEN 1 THEN "Yes"
+            WHEN 0 THEN "No"
+            ELSE opened_from_link
+            END AS 'Opened Via Link',
+        CASE private_browsing
+            WHEN 1 THEN "Yes"
+            WHEN 0 THEN "No"
+            ELSE private_browsing
+            END AS 'Private Browsing',
+        uuid AS 'UUID',
+        user_visible_url AS 'URL Visible to User'
+        FROM tabs
+        """,
+        convert_times({'Last Viewed': 'cocoa'})),
+    SqlArtifact(
+        'Safari Bookmarks',
+        _library_db('Bookmarks.db'),
+        ('bookmarks',),
+        """SELECT
+        title,
+        url,
+        hidden
+        FROM bookmarks""",
+        fill_blanks),
+    SqlArtifact(
+        'Safari Favicons',
+        _library_db('Favicons.db'),
+        ('icon_info', 'page_url'),
+        """SELECT
+        "timestamp" AS Created,
+        page_url.url AS 'URL',
+        icon_info.url AS 'Icon URL',
+        icon_info.width AS 'Width',
+        icon_info.height AS 'Height'
+        FROM icon_info
+        LEFT JOIN page_url ON icon_info.uuid = page_url.uuid""",
+        convert_times({'Created': 'cocoa'})),
+)
+
+
+def match_databases(artifacts, abs_fps):
+    '''
+    {artifact name: database path} for the first of abs_fps which each artifact matches. Each path is tested once
+    against every artifact, and only files with a SQLite header are considered.
+    '''
+    matched = dict()
+    for abs_fp in abs_fps:
+        wanted = [artifact for artifact in artifacts if artifact.name not in matched and artifact.matches(abs_fp)]
+        if wanted and sqlite_reader.is_sqlite(abs_fp):
+            for artifact in wanted:
+                matched[artifact.name] = abs_fp
+    return matched
+
+
+def _run_artifact(db_path, artifact):
+    # runs in a worker thread on its own read-only connection, made, used and closed in that thread, so the
+    # artifacts of one database are queried in parallel as well
+    database = sqlite_reader.Database(db_path)
+    try:
+        missing = [table for table in artifact.tables if not database.has_table(table)]
+        if missing:
+            logging.error('{} - {}: missing table(s) {}'.format(db_path, artifact.name, ', '.join(missing)))
+            return None
+        try:
+            df = database.read_dataframe(artifact.query)
+        except (sqlite3.Error, ValueError) as err:
+            logging.error('{} - {}: {}'.format(db_path, artifact.name, err))
+            return None
+        return artifact.post_process(df) if artifact.post_process else df
+    finally:
+        database.close()
+
+
+def run_artifacts(artifacts, abs_fps, max_workers=4):
+    '''
+    Matches the artifacts against abs_fps and runs each artifact's query in a worker thread on its own read-only
+    connection (sqlite3 releases the GIL while a query is stepping), so several queries against the same database
+    run at once. Returns {artifact name: DataFrame} for those which ran.
+    '''
+    matched = match_databases(artifacts, abs_fps)
+    to_run = [artifact for artifact in artifacts if artifact.name in matched]
+
+    results = dict()
+    if not to_run:
+        return results
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(to_run))) as executor:
+        futures = [(artifact.name, executor.submit(_run_artifact, matched[artifact.name], artifact))
+                   for artifact in to_run]
+        for name, future in futures:
+            try:
+                df = future.result()
+            except Exception as err:
+                logging.error('{} - {}'.format(name, err))
+                continue
+            if df is not None:
+                results[name] = df
+    return results
@@ -0,0 +1,162 @@
+'''
+MIT License
+
+sqlite_reader
+
+Copyright (c) 2022 Control-F Ltd
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+__version__ = 0.01
+__description__ = 'Control-F - sqlite_reader - Read-only SQLite access'
+__contact__ = 'mike.bangham@controlf.co.uk'
+
+import sqlite3
+import logging
+import pathlib
+
+import pandas as pd
+
+from src import sqlite_wal
+
+# Evidence databases are opened read-only and immutable: SQLite takes no locks, never creates -journal/-wal/-shm
+# files next to the database and can't write to it. As immutable also means SQLite ignores an existing -wal file,
+# a database with one is instead read as of the WAL's last commit through sqlite_wal, which keeps SQLite's -shm
+# file in a temporary workspace rather than next to the database.
+# See: https://www.sqlite.org/uri.html#uriimmutable
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 16 * 1024
+CHUNK_SIZE = 10000
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+
+def is_sqlite(path):
+    # checks the file header, so that non-database files aren't handed to SQLite
+    try:
+        with open(path, 'rb') as f:
+            return f.read(16) == SQLITE_HEADER
+    except OSError:
+        return False
+
+
+def immutable_uri(path):
+    # as_uri percent-encodes characters (e.g. '?' and '#') which would otherwise end the path in the URI
+    return '{}?mode=ro&immutable=1'.format(pathlib.Path(path).resolve().as_uri())
+
+
+def apply_pragmas(conn):
+    conn.execute('PRAGMA query_only = ON')
+    conn.execute('PRAGMA mmap_size = {}'.format(MMAP_SIZE))
+    conn.execute('PRAGMA cache_size = -{}'.format(CACHE_SIZE_KIB))
+    return conn
+
+
+def connect(path):
+    '''Opens a read-only, immutable connection to the database at path with the pragmas used for reading evidence'''
+    return apply_pragmas(sqlite3.connect(immutable_uri(path), uri=True, check_same_thread=True))
+
+
+class Database:
+    '''
+    A read-only connection to one database, with its schema probed once and cached. Queries are streamed to
+    DataFrames in chunks so a large table is never held as Python rows and a DataFrame at the same time.
+    '''
+    def __init__(self, path, use_wal=True):
+        self.path = pathlib.Path(path)
+        self.wal_applied = False
+        if use_wal and sqlite_wal.has_wal(self.path):
+            try:
+                self.conn = apply_pragmas(sqlite_wal.connect(self.path))
+                self.wal_applied = True
+            except (ValueError, sqlite3.DatabaseError) as err:
+                logging.error('{} - WAL not applied: {}'.format(self.path, err))
+        if not self.wal_applied:
+            self.conn = connect(self.path)
+        self._tables = None
+        self._columns = dict()
+
+    @property
+    def tables(self):
+        # names of the tables and views in the database
+        if self._tables is None:
+            self._tables = frozenset(row[0] for row in self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')"))
+        return self._tables
+
+    def has_table(self, table):
+        return table in self.tables
+
+    def columns(self, table):
+        if table not in self._columns:
+            self._columns[table] = tuple(row[1] for row in self.conn.execute(
+                'PRAGMA table_info("{}")'.format(table.replace('"', '""'))))
+        return self._columns[table]
+
+    def has_columns(self, table, *columns):
+        return self.has_table(table) and all(column in self.columns(table) for column in columns)
+
+    def iter_dataframes(self, query, params=None, index_col=None, chunksize=CHUNK_SIZE):
+        yield from pd.read_sql_query(query, self.conn, params=params, index_col=index_col, chunksize=chunksize)
+
+    def read_dataframe(self, query, params=None, index_col=None, chunksize=CHUNK_SIZE):
+        frames = list(self.iter_dataframes(query, params=params, index_col=index_col, chunksize=chunksize))
+        if not frames:
+            # no rows; the column names still come from the query
+            return pd.read_sql_query(query, self.conn, params=params, index_col=index_col)
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=index_col is None)
+
+    def read_table(self, table, index_col=None, chunksize=CHUNK_SIZE):
+        return self.read_dataframe('SELECT * FROM "{}"'.format(table.replace('"', '""')), index_col=index_col,
+                                   chunksize=chunksize)
+
+    def close(self):
+        self.conn.close()
+
+
+class DatabaseCache:
+    '''
+    The Database for each file opened during a package run, so every artifact that queries the same database
+    shares its connection and schema probes. sqlite3 connections belong to the thread that made them, so a cache
+    should be used (and closed) by one thread.
+    '''
+    def __init__(self):
+        self._databases = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, path):
+        key = pathlib.Path(path).resolve()
+        if key not in self._databases:
+            self._databases[key] = Database(key)
+        return self._databases[key]
+
+    def read_dataframe(self, path, query, params=None, index_col=None, chunksize=CHUNK_SIZE):
+        return self.get(path).read_dataframe(query, params=params, index_col=index_col, chunksize=chunksize)
+
+    def close(self):
+        for database in self._databases.values():
+            database.close()
+        self._databases.clear()
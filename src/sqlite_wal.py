@@ -0,0 +1,256 @@
+'''
+MIT License
+
+sqlite_wal
+
+Copyright (c) 2022 Control-F Ltd
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+__version__ = 0.01
+__description__ = 'Control-F - sqlite_wal - SQLite write-ahead log reader'
+__contact__ = 'mike.bangham@controlf.co.uk'
+
+import os
+import sys
+import mmap
+import struct
+import shutil
+import sqlite3
+import pathlib
+import argparse
+import tempfile
+from collections import namedtuple
+from os.path import join as pj
+from os.path import abspath, basename, isfile
+
+# A -wal file is a 32 byte header followed by frames of a 24 byte header and one page. SQLite reads a page from the
+# newest committed frame for it, else from the main database. Neither file is changed here: the WAL is memory mapped
+# and indexed, and SQLite is only ever pointed at a hard link to the database or a copy, in a temporary workspace.
+# See: https://www.sqlite.org/fileformat2.html#the_write_ahead_log
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+WAL_MAGIC_LE = 0x377f0682
+WAL_MAGIC_BE = 0x377f0683
+DB_HEADER_SIZE = 100
+
+# committed: part of a transaction committed in the WAL's current generation (what SQLite would read).
+# Frames which aren't committed - left over from an earlier generation of the WAL (stale salts) or from an
+# unfinished transaction - still hold earlier versions of their pages.
+WalFrame = namedtuple('WalFrame', ['index', 'offset', 'page_number', 'commit_size', 'salt_ok', 'checksum_ok',
+                                   'committed'])
+
+
+def wal_path_for(db_path):
+    return '{}-wal'.format(db_path)
+
+
+def has_wal(db_path):
+    # a WAL with no frames is only a header and changes nothing
+    wal_path = wal_path_for(db_path)
+    return isfile(wal_path) and os.path.getsize(wal_path) > WAL_HEADER_SIZE
+
+
+def wal_checksum(data, s0, s1, big_endian):
+    # the WAL checksum runs over the data as pairs of 32 bit words, continuing from (s0, s1)
+    words = struct.unpack('{}{}I'.format('>' if big_endian else '<', len(data) // 4), data)
+    for i in range(0, len(words), 2):
+        s0 = (s0 + words[i] + s1) & 0xffffffff
+        s1 = (s1 + words[i + 1] + s0) & 0xffffffff
+    return s0, s1
+
+
+class WalFile:
+    '''
+    Indexes the frames of a -wal file by page number and by commit. Page data is read from the memory map only
+    when it's asked for.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'rb')
+        size = os.fstat(self._f.fileno()).st_size
+        if size < WAL_HEADER_SIZE:
+            self._f.close()
+            raise ValueError('{} is too small to be a WAL file'.format(path))
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, self.version, self.page_size, self.checkpoint_seq, self.salt1, self.salt2,
+         checksum1, checksum2) = struct.unpack_from('>8I', self._mm, 0)
+        if magic not in (WAL_MAGIC_LE, WAL_MAGIC_BE):
+            self.close()
+            raise ValueError('{} is not a WAL file (bad magic)'.format(path))
+        self.big_endian = magic == WAL_MAGIC_BE
+        self.header_ok = wal_checksum(self._mm[0:24], 0, 0, self.big_endian) == (checksum1, checksum2)
+
+        self.frames = list()
+        self.pages = dict()  # page number -> [frame index, ...] in file order
+        self.commits = list()  # frame index of each committed commit frame, in order
+        self._index_frames(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _index_frames(self, size):
+        frame_size = WAL_FRAME_HEADER_SIZE + self.page_size
+        s0, s1 = wal_checksum(self._mm[0:24], 0, 0, self.big_endian)
+        chain_ok = self.header_ok
+        pending = list()
+        frame_count = (size - WAL_HEADER_SIZE) // frame_size
+
+        for i in range(frame_count):
+            offset = WAL_HEADER_SIZE + i * frame_size
+            page_number, commit_size, salt1, salt2, checksum1, checksum2 = struct.unpack_from('>6I', self._mm, offset)
+            salt_ok = salt1 == self.salt1 and salt2 == self.salt2
+            checksum_ok = False
+            if chain_ok and salt_ok:
+                # the checksum of each frame continues from the frame before it, so one bad frame ends the chain
+                s0, s1 = wal_checksum(self._mm[offset:offset + 8], s0, s1, self.big_endian)
+                s0, s1 = wal_checksum(self._mm[offset + WAL_FRAME_HEADER_SIZE:offset + frame_size], s0, s1,
+                                      self.big_endian)
+                checksum_ok = (s0, s1) == (checksum1, checksum2)
+            chain_ok = chain_ok and salt_ok and checksum_ok
+
+            self.frames.append(WalFrame(i, offset, page_number, commit_size, salt_ok, checksum_ok, False))
+            self.pages.setdefault(page_number, list()).append(i)
+            if chain_ok:
+                pending.append(i)
+                if commit_size:
+                    for j in pending:
+                        self.frames[j] = self.frames[j]._replace(committed=True)
+                    self.commits.append(i)
+                    pending = list()
+
+    def page_data(self, frame):
+        start = frame.offset + WAL_FRAME_HEADER_SIZE
+        return self._mm[start:start + self.page_size]
+
+    def page_versions(self, page_number):
+        '''Every frame holding page_number, oldest first, whether committed or not'''
+        return [self.frames[i] for i in self.pages.get(page_number, ())]
+
+    def pages_at(self, commit=-1):
+        '''
+        {page number: frame} for the newest version of each page as of a commit, where commit indexes self.commits
+        (so -1 is the last commit SQLite would read, 0 the first in the WAL). Returns (pages, database size in pages).
+        '''
+        if not self.commits:
+            return dict(), None
+        last = self.commits[commit]
+        pages = dict()
+        for frame in self.frames[:last + 1]:
+            if frame.committed:
+                pages[frame.page_number] = frame
+        return pages, self.frames[last].commit_size
+
+    def close(self):
+        self._mm.close()
+        self._f.close()
+
+
+def write_database_image(db_path, wal, out_path, commit=-1):
+    '''
+    Writes the database as of a commit in the WAL (see WalFile.pages_at) to out_path: a copy of the main file with
+    the WAL's frames laid over it, a page at a time. The image is marked as a rollback journal database so SQLite
+    reads it as it is, without looking for a WAL of its own.
+    '''
+    pages, page_count = wal.pages_at(commit)
+    page_size = wal.page_size
+    shutil.copyfile(db_path, out_path)
+    with open(out_path, 'r+b') as f:
+        if page_count is not None:
+            f.truncate(page_count * page_size)  # extends with zeros, or drops pages freed by the commit
+        for page_number, frame in sorted(pages.items()):
+            f.seek((page_number - 1) * page_size)
+            f.write(wal.page_data(frame))
+        if os.fstat(f.fileno()).st_size >= DB_HEADER_SIZE:
+            f.seek(18)
+            f.write(b'\x01\x01')  # file format read/write versions: 2 is WAL, 1 is legacy
+
+
+class WorkspaceConnection(sqlite3.Connection):
+    # a connection to a database in a temporary workspace directory, which is removed when the connection closes
+    workspace = None
+
+    def close(self):
+        super().close()
+        if self.workspace:
+            shutil.rmtree(self.workspace, ignore_errors=True)
+            self.workspace = None
+
+    def __del__(self):
+        # closing first, as Windows can't remove a file which is open
+        self.close()
+
+
+def _link_or_copy(path, link_path):
+    try:
+        os.link(path, link_path)
+    except OSError:  # e.g. across file systems
+        shutil.copyfile(path, link_path)
+
+
+def connect(db_path, wal_path=None, commit=-1):
+    '''
+    A read-only connection to the database at db_path as of a commit in its WAL. For the last commit (what SQLite
+    would read) SQLite reads the evidence itself, through a hard link in a temporary workspace beside a copy of the
+    WAL, so its -shm file is made in the workspace rather than next to the evidence. An earlier commit is read from
+    an image of the database written to the workspace. The workspace is removed when the connection is closed.
+    '''
+    wal_path = wal_path or wal_path_for(db_path)
+    workspace = tempfile.mkdtemp(prefix='shomium_wal_')
+    workspace_db = pj(workspace, basename(db_path))
+    try:
+        with WalFile(wal_path) as wal:
+            latest = commit == -1 or commit == len(wal.commits) - 1
+            if not latest:
+                write_database_image(db_path, wal, workspace_db, commit)
+        if latest:
+            _link_or_copy(db_path, workspace_db)
+            shutil.copyfile(wal_path, wal_path_for(workspace_db))
+            uri = '{}?mode=ro'.format(pathlib.Path(workspace_db).as_uri())
+        else:
+            uri = '{}?mode=ro&immutable=1'.format(pathlib.Path(workspace_db).as_uri())
+        conn = sqlite3.connect(uri, uri=True, factory=WorkspaceConnection)
+    except Exception:
+        shutil.rmtree(workspace, ignore_errors=True)
+        raise
+    conn.workspace = workspace
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__description__)
+    parser.add_argument('-i', required=True, help='A SQLite database with a -wal file beside it')
+    args = parser.parse_args()
+
+    if not (len(args.i) and isfile(abspath(args.i)) and has_wal(abspath(args.i))):
+        print('[!!] Error: Please provide a database with a -wal file for argument -i')
+        sys.exit()
+
+    with WalFile(wal_path_for(abspath(args.i))) as wal_file:
+        committed = sum(1 for f in wal_file.frames if f.committed)
+        print('{} frames ({} committed in {} commits), {} pages'.format(
+            len(wal_file.frames), committed, len(wal_file.commits), len(wal_file.pages)))
+        for number, frame_indexes in sorted(wal_file.pages.items()):
+            print('page {} : {} versions'.format(number, len(frame_indexes)))
@@ -0,0 +1,298 @@
+'''
+MIT License
+
+timeline
+
+Copyright (c) 2022 Control-F Ltd
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+__version__ = 0.01
+__description__ = 'Control-F - timeline - Merged timeline of timestamped artifacts'
+__contact__ = 'mike.bangham@controlf.co.uk'
+
+import os
+import shutil
+import tempfile
+from os.path import join as pj
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype, is_object_dtype, is_string_dtype
+
+# Every datetime64 column of an artifact's DataFrame is an event per row. The events of each DataFrame are sorted
+# and written to disk as a run (only the time, source, row and a short summary of each event are kept, never the
+# DataFrame), then the runs are k-way merged a block at a time into one sorted set of memory mapped columns.
+# The merged times are sorted, so the events in a time range are found by binary search; a sparse copy of every
+# INDEX_STRIDE'th time is held in memory so the search only touches the few pages of the mapped column it lands in.
+MERGE_BLOCK = 65536
+INDEX_STRIDE = 4096
+EXPORT_CHUNK = 100000
+NAT = np.iinfo(np.int64).min
+SUMMARY_COLUMNS = ('URL', 'url', 'Title', 'title', 'Name', 'name', 'host_key', 'Key', 'key', 'Value', 'value',
+                   'File Name', 'filename', 'Path')
+SUMMARY_MAX = 3
+SUMMARY_SEP = ' | '
+COLUMNS = ['Timestamp', 'Package', 'Artifact', 'Event', 'Row', 'Summary']
+
+
+def _as_ns(values):
+    # datetime64 values (timezone aware or not) as int64 nanoseconds since 1970 UTC, NaT as NAT
+    series = pd.Series(values)
+    if getattr(series.dt, 'tz', None) is not None:
+        series = series.dt.tz_convert('UTC').dt.tz_localize(None)
+    return series.to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+
+def _to_ns(when):
+    when = pd.Timestamp(when)
+    if when.tzinfo is not None:
+        when = when.tz_convert('UTC').tz_localize(None)
+    return when.value
+
+
+def summary_columns(df, time_columns):
+    columns = [c for c in SUMMARY_COLUMNS if c in df.columns and c not in time_columns][:SUMMARY_MAX]
+    if not columns:
+        columns = [c for c in df.columns if c not in time_columns and c != 'media' and
+                   (is_object_dtype(df[c]) or is_string_dtype(df[c]))][:SUMMARY_MAX]
+    return columns
+
+
+def _summaries(df, columns):
+    if not columns:
+        return np.full(len(df.index), '', dtype=object)
+    text = df[columns[0]].fillna('').astype(str)
+    for column in columns[1:]:
+        text = text.str.cat(df[column].fillna('').astype(str), sep=SUMMARY_SEP)
+    return text.to_numpy(dtype=object)
+
+
+class _Run:
+    # one sorted run on disk: times, source ids, rows and summaries (a UTF-8 arena with offsets)
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.times = np.load(prefix + '.times.npy', mmap_mode='r')
+        self.sources = np.load(prefix + '.sources.npy', mmap_mode='r')
+        self.rows = np.load(prefix + '.rows.npy', mmap_mode='r')
+        self.offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+        self._arena = None
+
+    def __len__(self):
+        return len(self.times)
+
+    @staticmethod
+    def write(prefix, times, sources, rows, summaries):
+        encoded = [s.encode('utf-8', 'replace') for s in summaries]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        np.save(prefix + '.times.npy', times)
+        np.save(prefix + '.sources.npy', sources)
+        np.save(prefix + '.rows.npy', rows)
+        np.save(prefix + '.offsets.npy', offsets)
+        with open(prefix + '.arena', 'wb') as f:
+            f.write(b''.join(encoded))
+
+    def summary(self, i):
+        if self._arena is None:
+            self._arena = np.memmap(self.prefix + '.arena', dtype=np.uint8, mode='r') if self.offsets[-1] else b''
+        return bytes(self._arena[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+
+class TimelineBuilder:
+    '''
+    Collects the events of timestamped DataFrames (from AndroidThread/IOSThread, across packages) as sorted runs
+    on disk, then merges them with build(). work_dir is made if needed; a temporary directory is used (and removed
+    on close) if it's None.
+    '''
+    def __init__(self, work_dir=None):
+        self._owns_dir = work_dir is None
+        self.work_dir = tempfile.mkdtemp(prefix='shomium_timeline_') if work_dir is None else work_dir
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.sources = list()  # (package, artifact, column) for each source id
+        self.runs = list()
+        self.event_count = 0
+        self._builds = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_dataframe(self, df, package, artifact):
+        '''Adds an event for every timestamp in df's datetime64 columns. Returns the number of events added.'''
+        time_columns = [c for c in df.columns if is_datetime64_any_dtype(df[c])]
+        if not time_columns or df.empty:
+            return 0
+        summaries = _summaries(df, summary_columns(df, time_columns))
+
+        times, sources, rows = list(), list(), list()
+        for column in time_columns:
+            ns = _as_ns(df[column])
+            present = np.flatnonzero(ns != NAT)
+            if not present.size:
+                continue
+            self.sources.append((package, artifact, str(column)))
+            times.append(ns[present])
+            sources.append(np.full(present.size, len(self.sources) - 1, dtype=np.uint32))
+            rows.append(present.astype(np.int64))
+        if not times:
+            return 0
+
+        times, sources, rows = np.concatenate(times), np.concatenate(sources), np.concatenate(rows)
+        order = np.argsort(times, kind='stable')
+        prefix = pj(self.work_dir, 'run_{}'.format(len(self.runs)))
+        _Run.write(prefix, times[order], sources[order], rows[order], summaries[rows[order]])
+        self.runs.append(_Run(prefix))
+        self.event_count += len(order)
+        return len(order)
+
+    def build(self, block=MERGE_BLOCK):
+        '''
+        Merges the runs added so far into a Timeline, holding at most a block of each run in memory at a time.
+        Events at the same time keep the order they were added in.
+        '''
+        out_dir = pj(self.work_dir, 'merged_{}'.format(self._builds))
+        self._builds += 1
+        os.makedirs(out_dir, exist_ok=True)
+        # a snapshot, so DataFrames can still be added while a build runs in another thread
+        runs, sources = list(self.runs), list(self.sources)
+        total = sum(len(run) for run in runs)
+        merged_times = np.lib.format.open_memmap(pj(out_dir, 'times.npy'), mode='w+', dtype=np.int64, shape=(total,))
+        merged_runs = np.lib.format.open_memmap(pj(out_dir, 'runs.npy'), mode='w+', dtype=np.uint32, shape=(total,))
+        merged_positions = np.lib.format.open_memmap(pj(out_dir, 'positions.npy'), mode='w+', dtype=np.int64,
+                                                     shape=(total,))
+
+        cursors = [0] * len(runs)
+        written = 0
+        while written < total:
+            heads = [(r, runs[r].times[cursors[r]:cursors[r] + block]) for r in range(len(runs))
+                     if cursors[r] < len(runs[r])]
+            # everything up to the smallest of the heads' last times can be emitted: no later block of any run
+            # can hold an earlier event. The run which set the cutoff is emptied, so every pass makes progress.
+            cutoff = min(head[-1] for _, head in heads)
+            block_times, block_runs, block_positions = list(), list(), list()
+            for r, head in heads:
+                take = int(np.searchsorted(head, cutoff, side='right'))
+                if take:
+                    block_times.append(head[:take])
+                    block_runs.append(np.full(take, r, dtype=np.uint32))
+                    block_positions.append(np.arange(cursors[r], cursors[r] + take, dtype=np.int64))
+                    cursors[r] += take
+            block_times = np.concatenate(block_times)
+            block_runs = np.concatenate(block_runs)
+            block_positions = np.concatenate(block_positions)
+            order = np.lexsort((block_positions, block_runs, block_times))
+            end = written + len(order)
+            merged_times[written:end] = block_times[order]
+            merged_runs[written:end] = block_runs[order]
+            merged_positions[written:end] = block_positions[order]
+            written = end
+
+        for column in (merged_times, merged_runs, merged_positions):
+            column.flush()
+        del merged_times, merged_runs, merged_positions
+        return Timeline(out_dir, runs, sources)
+
+    def close(self):
+        self.runs = list()
+        if self._owns_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+class Timeline:
+    '''
+    A merged, time sorted event stream. Events are read a window at a time, by time range (window) or by position
+    (frame), as DataFrames with COLUMNS.
+    '''
+    def __init__(self, merged_dir, runs, sources):
+        self.merged_dir = merged_dir
+        self.runs = runs
+        self.sources = sources
+        self.times = np.load(pj(merged_dir, 'times.npy'), mmap_mode='r')
+        self._runs = np.load(pj(merged_dir, 'runs.npy'), mmap_mode='r')
+        self._positions = np.load(pj(merged_dir, 'positions.npy'), mmap_mode='r')
+        self.index = np.array(self.times[::INDEX_STRIDE])
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def start(self):
+        return pd.Timestamp(self.times[0]) if len(self) else None
+
+    @property
+    def end(self):
+        return pd.Timestamp(self.times[-1]) if len(self) else None
+
+    def _search(self, ns, side):
+        # the sparse index narrows the search to one stride of the mapped times
+        block = int(np.searchsorted(self.index, ns, side=side))
+        lo = max(block - 1, 0) * INDEX_STRIDE
+        hi = min(block * INDEX_STRIDE + 1, len(self.times))
+        return lo + int(np.searchsorted(self.times[lo:hi], ns, side=side))
+
+    def position_range(self, start=None, end=None):
+        '''(first, last + 1) positions of the events in [start, end); either bound may be None'''
+        first = 0 if start is None else self._search(_to_ns(start), 'left')
+        last = len(self) if end is None else self._search(_to_ns(end), 'left')
+        return first, max(first, last)
+
+    def window(self, start=None, end=None):
+        return self.frame(*self.position_range(start, end))
+
+    def frame(self, first, last):
+        first, last = max(first, 0), min(last, len(self))
+        runs = np.asarray(self._runs[first:last])
+        positions = np.asarray(self._positions[first:last])
+        sources = np.empty(len(runs), dtype=np.uint32)
+        rows = np.empty(len(runs), dtype=np.int64)
+        summaries = np.empty(len(runs), dtype=object)
+        for r in np.unique(runs):
+            mask = runs == r
+            run = self.runs[r]
+            run_positions = positions[mask]
+            sources[mask] = run.sources[run_positions]
+            rows[mask] = run.rows[run_positions]
+            summaries[mask] = [run.summary(p) for p in run_positions]
+        labels = np.array(self.sources, dtype=object).reshape(-1, 3) if self.sources else np.empty((0, 3), object)
+        return pd.DataFrame({
+            'Timestamp': np.asarray(self.times[first:last]).view('datetime64[ns]'),
+            'Package': labels[sources, 0],
+            'Artifact': labels[sources, 1],
+            'Event': labels[sources, 2],
+            'Row': rows,
+            'Summary': summaries}, columns=COLUMNS)
+
+    def iter_frames(self, start=None, end=None, chunk_size=EXPORT_CHUNK):
+        first, last = self.position_range(start, end)
+        for chunk_start in range(first, last, chunk_size):
+            yield self.frame(chunk_start, min(chunk_start + chunk_size, last))
+
+    def to_csv(self, path, start=None, end=None, chunk_size=EXPORT_CHUNK):
+        '''Writes the events in [start, end) to a CSV file a chunk at a time. Returns the number written.'''
+        count = 0
+        with open(path, 'w', encoding='UTF8', newline='') as f:
+            pd.DataFrame(columns=COLUMNS).to_csv(f, index=False)
+            for df in self.iter_frames(start, end, chunk_size):
+                df.to_csv(f, index=False, header=False)
+                count += len(df.index)
+        return count
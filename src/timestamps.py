@@ -0,0 +1,145 @@
+'''
+MIT License
+
+timestamps
+
+Copyright (c) 2022 Control-F Ltd
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+__version__ = 0.01
+__description__ = 'Control-F - timestamps - Vectorised timestamp conversion'
+__contact__ = 'mike.bangham@controlf.co.uk'
+
+import sys
+import argparse
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# Every format is a count of some unit since an epoch. Whole columns are converted at once to datetime64[ns] with
+# integer arithmetic (floats are split into whole units and a fraction first, so nothing is lost to float rounding
+# of nanosecond counts). Results are UTC, and are left timezone naive so they can be written to XLSX reports.
+# Values outside the datetime64[ns] range (1677 - 2262), NaN/None and non-numeric values become NaT.
+TimestampFormat = namedtuple('TimestampFormat', ['epoch_offset', 'unit_ns'])  # epoch as seconds from 1970-01-01
+
+UNIX_EPOCH_OFFSET = 0
+COCOA_EPOCH_OFFSET = 978307200  # 2001-01-01 (Apple Cocoa/Core Data, Mac absolute time)
+WEBKIT_EPOCH_OFFSET = -11644473600  # 1601-01-01 (WebKit/Chrome, Windows FILETIME)
+HFS_EPOCH_OFFSET = -2082844800  # 1904-01-01 (HFS+)
+
+FORMATS = {
+    'unix': TimestampFormat(UNIX_EPOCH_OFFSET, 10 ** 9),
+    'unix_ms': TimestampFormat(UNIX_EPOCH_OFFSET, 10 ** 6),
+    'unix_us': TimestampFormat(UNIX_EPOCH_OFFSET, 10 ** 3),
+    'cocoa': TimestampFormat(COCOA_EPOCH_OFFSET, 10 ** 9),
+    'webkit': TimestampFormat(WEBKIT_EPOCH_OFFSET, 10 ** 3),  # microseconds
+    'hfs': TimestampFormat(HFS_EPOCH_OFFSET, 10 ** 9),
+}
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+_NS_MIN = np.iinfo(np.int64).min + 1  # the minimum itself is NaT
+_NS_MAX = np.iinfo(np.int64).max
+
+
+def _numeric(values):
+    arr = np.asarray(values)
+    if arr.dtype.kind in 'iufb':
+        return arr.ravel()
+    # object/string columns (e.g. from SQLite, where a column can hold any type)
+    return pd.to_numeric(pd.Series(arr.ravel(), dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+
+
+def to_datetime64(values, fmt, zero_as_nat=True):
+    '''
+    Converts an array-like of timestamps in a format from FORMATS to a datetime64[ns] array (UTC). zero_as_nat
+    treats 0 as unset, as the browsers do for e.g. a session cookie's expiry.
+    '''
+    try:
+        epoch_offset, unit_ns = FORMATS[fmt]
+    except KeyError:
+        raise ValueError('Unknown timestamp format {!r} (expected one of {})'.format(fmt, ', '.join(FORMATS)))
+    # the epoch in the format's units; counted in nanoseconds it wouldn't fit an int64 for 1601
+    offset_units = epoch_offset * (10 ** 9 // unit_ns)
+    arr = _numeric(values)
+    out = np.full(arr.shape, np.datetime64('NaT'), dtype='datetime64[ns]')
+    if not arr.size:
+        return out
+
+    # the range of values which fit datetime64[ns], in the format's units; one unit inside it to absorb rounding
+    low = _NS_MIN // unit_ns - offset_units + 1
+    high = _NS_MAX // unit_ns - offset_units - 1
+    with np.errstate(invalid='ignore'):
+        as_float = arr.astype(np.float64)
+        valid = np.isfinite(as_float) & (as_float >= low) & (as_float <= high)
+    if zero_as_nat:
+        valid &= as_float != 0
+
+    if arr.dtype.kind in 'iub':
+        ns = (arr[valid].astype(np.int64) + offset_units) * unit_ns
+    else:
+        whole = np.floor(as_float[valid])
+        ns = (whole.astype(np.int64) + offset_units) * unit_ns + \
+            np.rint((as_float[valid] - whole) * unit_ns).astype(np.int64)
+    out[valid] = ns.view('datetime64[ns]')
+    return out
+
+
+def to_series(values, fmt, zero_as_nat=True, index=None, name=None):
+    if index is None and isinstance(values, pd.Series):
+        index = values.index
+    return pd.Series(to_datetime64(values, fmt, zero_as_nat=zero_as_nat), index=index, name=name)
+
+
+def convert_columns(df, columns, zero_as_nat=True):
+    '''
+    Converts columns of df in place. columns is {column: format}, or {column: (format, new column name)} to keep
+    the raw values alongside. Columns not in df are skipped. Returns df.
+    '''
+    for column, fmt in columns.items():
+        if column not in df.columns:
+            continue
+        new_column = column
+        if isinstance(fmt, tuple):
+            fmt, new_column = fmt
+        df[new_column] = to_datetime64(df[column].to_numpy(), fmt, zero_as_nat=zero_as_nat)
+    return df
+
+
+def format_datetimes(values, date_format=DATETIME_FORMAT, na_rep=''):
+    '''datetime64 values as strings (e.g. for CSV output), with na_rep for NaT'''
+    index = pd.DatetimeIndex(values)
+    return np.where(index.isna(), na_rep, index.strftime(date_format).to_numpy(dtype=object))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__description__)
+    parser.add_argument('-f', required=True, choices=sorted(FORMATS), help='The timestamp format')
+    parser.add_argument('values', nargs='+', help='One or more timestamps')
+    args = parser.parse_args()
+
+    try:
+        converted = to_datetime64(args.values, args.f, zero_as_nat=False)
+    except ValueError as err:
+        print('[!!] Error: {}'.format(err))
+        sys.exit()
+    for value, dt in zip(args.values, format_datetimes(converted, na_rep='-')):
+        print('{} : {}'.format(value, dt))
@@ -33,7 +33,6 @@ import json
 import filetype
 import shutil
 import numpy as np
-import pandas as pd
 import cv2
 from collections import namedtuple
 import sys
@@ -41,14 +40,13 @@ import os
 from os.path import join as pj
 from os.path import *
 from subprocess import PIPE, Popen
-import sqlite3
 import PIL
 import struct
 from struct import unpack
 from io import BytesIO
 import base64
 
-from src import ktx_2_png
+from src import ktx_2_png, sqlite_reader, derived_cache
 
 start_dir = os.getcwd()
 app_data_dir = os.getenv('APPDATA')
@@ -114,21 +112,18 @@ def get_file_mimetype(header, abs_fp=None):
 
 
 def convert_ktx_to_png(ktx_fp, png_fp):
-    try:
-        ktx = ktx_2_png.KTXReader()  # init the ktx converter
-        ktx_f_bytes = BytesIO(open(ktx_fp, 'rb').read())
-        ktx.convert_to_png(ktx_f_bytes, ktx_png_fp)
-        return True
-    except:
-        return False
+    return ktx_2_png.convert_ktx_file(ktx_fp, png_fp) is None
 
 
 def convert_img_to_png(img_fp, png_fp):
-    # accepts an image file and an output png file
+    # accepts an image file and an output png file. Conversions are kept in the derived file cache
+    if derived_cache.default_cache.fetch(img_fp, png_fp, 'png'):
+        return
     try:
         # majority of files are supported by Pillow
-        i = Image.open(img_fp)
+        i = PIL.Image.open(img_fp)
         i.save(png_fp, format='PNG')
+        derived_cache.default_cache.store(img_fp, png_fp, 'png')
         return
     except:
         pass
@@ -184,6 +179,17 @@ def get_image_type(img_fp):
 
 
 def generate_thumbnail(fp, thmbsize=128):
+    # a base64 thumbnail for the HTML report; kept in the derived file cache for each file and size
+    cacheable = bool(fp) and isfile(fp)
+    thumbnail = derived_cache.default_cache.fetch_bytes(fp, 'thumbnail', size=int(thmbsize)) if cacheable else None
+    if thumbnail is None:
+        thumbnail = _thumbnail_bytes(fp, thmbsize)
+        if cacheable:
+            derived_cache.default_cache.store_bytes(fp, thumbnail, 'thumbnail', size=int(thmbsize))
+    return base64.b64encode(thumbnail).decode('utf8')
+
+
+def _thumbnail_bytes(fp, thmbsize):
     file_type, file_ext = get_image_type(fp)
 
     if file_type and file_ext:
@@ -224,9 +230,7 @@ def generate_thumbnail(fp, thmbsize=128):
 
     buf = BytesIO()
     img.save(buf, format=file_ext.upper())
-    b64_thumb = base64.b64encode(buf.getvalue()).decode('utf8')
-
-    return b64_thumb
+    return buf.getvalue()
 
 
 def button_config(widg, icon_fn, icon_width_height=14, widg_width=20, widg_height=20):
@@ -263,13 +267,14 @@ def unpacker(struct_arg, data, fields=None):
 
 
 def build_dataframe(db, table, index=None, query=None):
-    fc_conn = sqlite3.connect(db)
-    if query:
-        df = pd.read_sql_query(query, fc_conn, index_col=index)
-    else:
-        df = pd.read_sql_query("SELECT * FROM " + table, fc_conn, index_col=index)
-    fc_conn.close()
-    return df
+    # a one-off read-only query; package runs share connections through a sqlite_reader.DatabaseCache instead
+    database = sqlite_reader.Database(db)
+    try:
+        if query:
+            return database.read_dataframe(query, index_col=index)
+        return database.read_table(table, index_col=index)
+    finally:
+        database.close()
 
 
 class CleanTemp(QThread):
@@ -0,0 +1,44 @@
+import struct
+
+import pytest
+
+from src import ccl_leveldb
+
+
+def filter_block(bloom, base_lg=11):
+    # one filter, for the data blocks in the first (2 ** base_lg) bytes of the table
+    return bloom + struct.pack('<II', 0, len(bloom)) + struct.pack('<I', len(bloom)) + bytes([base_lg])
+
+
+def make_bloom(keys, bits_per_key=10):
+    # leveldb's BloomFilterPolicy::CreateFilter
+    k = max(1, min(30, int(bits_per_key * 0.69)))
+    bits = max(64, len(keys) * bits_per_key)
+    n_bytes = (bits + 7) // 8
+    bits = n_bytes * 8
+    array = bytearray(n_bytes)
+    for key in keys:
+        h = ccl_leveldb.bloom_hash(key)
+        delta = ((h >> 17) | (h << 15)) & 0xffffffff
+        for _ in range(k):
+            bit_pos = h % bits
+            array[bit_pos >> 3] |= 1 << (bit_pos & 7)
+            h = (h + delta) & 0xffffffff
+    return bytes(array) + bytes([k])
+
+
+def test_bloom_filter_matches_its_keys():
+    keys = [b'key%d' % i for i in range(100)]
+    block = ccl_leveldb.BloomFilterBlock(filter_block(make_bloom(keys)))
+    assert all(block.key_may_match(0, key) for key in keys)
+    assert sum(block.key_may_match(0, b'missing%d' % i) for i in range(1000)) < 100
+
+
+@pytest.mark.parametrize('bloom, expected', [
+    (b'', False),  # an empty filter matches nothing
+    (b'\x06', False),  # only a probe count: no bits to test
+    (b'\x00' * 8 + b'\x1f', True),  # k > 30 is reserved for other encodings, so may match
+])
+def test_bloom_filter_short_or_reserved(bloom, expected):
+    block = ccl_leveldb.BloomFilterBlock(filter_block(bloom))
+    assert block.key_may_match(0, b'key') is expected
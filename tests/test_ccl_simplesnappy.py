@@ -0,0 +1,198 @@
+import io
+import random
+import struct
+import timeit
+
+import pytest
+
+from src import ccl_simplesnappy
+
+
+def reference_decompress(data):
+    '''The stream decoder ccl_simplesnappy had before _decompress_python; the output to match'''
+    def read_byte():
+        x = data.read(1)
+        return x[0] if x else None
+
+    uncompressed_length = 0
+    shift = 0
+    while True:
+        raw = data.read(1)
+        if not raw:
+            raise ValueError("Couldn't read uncompressed length")
+        uncompressed_length |= (raw[0] & 0x7f) << shift
+        if not raw[0] & 0x80:
+            break
+        shift += 7
+
+    out = io.BytesIO()
+    while True:
+        type_byte = read_byte()
+        if type_byte is None:
+            break
+        tag = type_byte & 0x03
+        if tag == 0:
+            if ((type_byte & 0xFC) >> 2) < 60:
+                length = 1 + ((type_byte & 0xFC) >> 2)
+            elif ((type_byte & 0xFC) >> 2) == 60:
+                length = 1 + read_byte()
+            elif ((type_byte & 0xFC) >> 2) == 61:
+                length = 1 + struct.unpack("<H", data.read(2))[0]
+            elif ((type_byte & 0xFC) >> 2) == 62:
+                length = 1 + struct.unpack("<I", data.read(3) + b"\x00")[0]
+            else:
+                length = 1 + struct.unpack("<I", data.read(4))[0]
+            literal_data = data.read(length)
+            if len(literal_data) < length:
+                raise ValueError("Couldn't read enough literal data")
+            out.write(literal_data)
+        else:
+            if tag == 1:
+                length = ((type_byte & 0x1C) >> 2) + 4
+                offset = ((type_byte & 0xE0) << 3) | read_byte()
+            elif tag == 2:
+                length = 1 + ((type_byte & 0xFC) >> 2)
+                offset = struct.unpack("<H", data.read(2))[0]
+            else:
+                length = 1 + ((type_byte & 0xFC) >> 2)
+                offset = struct.unpack("<I", data.read(4))[0]
+            if offset == 0:
+                raise ValueError("Offset cannot be 0")
+            actual_offset = out.tell() - offset
+            for i in range(length):
+                out.write(out.getbuffer()[actual_offset + i: actual_offset + i + 1].tobytes())
+
+    result = out.getvalue()
+    if uncompressed_length != len(result):
+        raise ValueError("Wrong data length in uncompressed data")
+    return result
+
+
+def varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def literal(data, width=None):
+    # width forces the 1-4 byte length encodings (60-63) even for short literals
+    n = len(data) - 1
+    if width is None:
+        if n < 60:
+            return bytes([n << 2]) + data
+        width = (n.bit_length() + 7) // 8
+    return bytes([(59 + width) << 2]) + n.to_bytes(width, 'little') + data
+
+
+def copy(offset, length, kind):
+    if kind == 1:  # length 4-11, offset < 2048
+        return bytes([((offset >> 8) << 5) | ((length - 4) << 2) | 1, offset & 0xff])
+    if kind == 2:  # length 1-64, offset < 65536
+        return bytes([((length - 1) << 2) | 2]) + offset.to_bytes(2, 'little')
+    return bytes([((length - 1) << 2) | 3]) + offset.to_bytes(4, 'little')
+
+
+def stream(total, elements):
+    return varint(total) + b''.join(elements)
+
+
+def random_stream(rng, target, copy_heavy=False):
+    # copy_heavy is closer to real compressed data: mostly backreferences between short literals
+    elements = list()
+    size = 0
+    while size < target:
+        if size == 0 or rng.random() < (0.1 if copy_heavy else 0.3):
+            if copy_heavy:
+                n = rng.randint(1, 16)
+            else:
+                n = rng.choice([1, rng.randint(1, 60), rng.randint(61, 300), rng.randint(256, 70000)])
+            elements.append(literal(rng.randbytes(n),
+                                    width=rng.choice([None, None, 1, 2, 3, 4]) if n <= 256 else None))
+            size += n
+            continue
+        kind = rng.choice([1, 2, 3])
+        if kind == 1:
+            length = rng.randint(4, 11)
+            offset = rng.randint(1, min(size, 2047))
+        else:
+            length = rng.randint(1, 64)
+            offset = rng.randint(1, min(size, 65535 if kind == 2 else size))
+        if rng.random() < 0.3:
+            offset = rng.randint(1, min(size, length))  # overlaps the bytes being written
+        elements.append(copy(offset, length, kind))
+        size += length
+    return stream(size, elements)
+
+
+def check(raw):
+    expected = reference_decompress(io.BytesIO(raw))
+    assert ccl_simplesnappy._decompress_python(raw) == expected
+    assert ccl_simplesnappy.decompress_buffer(raw) == expected
+    assert ccl_simplesnappy.decompress(io.BytesIO(raw)) == expected
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_random_streams(seed):
+    rng = random.Random(seed)
+    check(random_stream(rng, rng.choice([10, 1000, 100000])))
+
+
+EDGE_CASES = {
+    'empty': stream(0, []),
+    'literal lengths': stream(60 + 61 + 256 + 257 + 70000, [
+        literal(b'a' * 60), literal(b'b' * 61), literal(b'c' * 256), literal(b'd' * 257), literal(b'e' * 70000)]),
+    'literal widths': stream(4 * 5, [literal(b'wxyz', width=w) for w in (None, 1, 2, 3, 4)]),
+    'run of one byte': stream(1 + 64 * 100, [literal(b'z')] + [copy(1, 64, 2)] * 100),
+    'overlapping copies': stream(3 + 11 + 64 + 64, [literal(b'abc'), copy(3, 11, 1), copy(2, 64, 2),
+                                                    copy(5, 64, 3)]),
+    'long copies': stream(70000 + 64 * 50, [literal(bytes(range(256)) * 273 + b'x' * 112)] +
+                          [copy(65536 + i, 64, 3) for i in range(50)]),
+    '4 byte offsets': stream(70000 + 20, [literal(bytes(i % 251 for i in range(70000))), copy(69999, 20, 3)]),
+    '1 byte offset high bits': stream(2000 + 11, [literal(bytes(i % 7 for i in range(2000))), copy(2000, 11, 1)]),
+}
+
+
+@pytest.mark.parametrize('name', sorted(EDGE_CASES))
+def test_edge_cases(name):
+    check(EDGE_CASES[name])
+
+
+@pytest.mark.parametrize('raw', [
+    stream(4, [literal(b'ab'), copy(0, 2, 2)]),  # offset 0
+    stream(10, [literal(b'abc')]),  # shorter than its stated length
+    stream(2, [literal(b'abc')]),  # longer than its stated length
+    stream(10, [literal(b'abc')])[:-1],  # truncated literal
+    stream(8, [literal(b'abcd'), copy(4, 4, 1)])[:-1],  # copy tags cut off in their offset bytes
+    stream(8, [literal(b'abcd'), copy(4, 4, 2)])[:-1],
+    stream(8, [literal(b'abcd'), copy(4, 4, 3)])[:-2],
+])
+def test_bad_streams(raw):
+    # the reference raised TypeError or struct.error for a truncated copy, rather than ValueError
+    with pytest.raises((ValueError, TypeError, struct.error)):
+        reference_decompress(io.BytesIO(raw))
+    with pytest.raises(ValueError):
+        ccl_simplesnappy._decompress_python(raw)
+
+
+def test_backreference_before_start():
+    with pytest.raises(ValueError):
+        ccl_simplesnappy._decompress_python(stream(6, [literal(b'ab'), copy(3, 4, 1)]))
+
+
+def benchmark(raw, runs=3):
+    old = timeit.timeit(lambda: reference_decompress(io.BytesIO(raw)), number=runs) / runs
+    new = timeit.timeit(lambda: ccl_simplesnappy._decompress_python(raw), number=runs) / runs
+    return old, new
+
+
+if __name__ == '__main__':
+    # python -m tests.test_ccl_simplesnappy; timed here rather than in a test, as timings depend on machine load
+    for target, copy_heavy in ((1000000, False), (1000000, True), (4000000, True)):
+        raw = random_stream(random.Random(target), target, copy_heavy=copy_heavy)
+        size = len(reference_decompress(io.BytesIO(raw))) / 1024 / 1024
+        old, new = benchmark(raw)
+        print('{:.1f} MiB{}: reference {:.1f} MiB/s, python {:.1f} MiB/s ({:.0f}x)'.format(
+            size, ' (copy heavy)' if copy_heavy else '', size / old, size / new, old / new))
@@ -0,0 +1,66 @@
+import io
+import struct
+
+import pytest
+
+pytest.importorskip('astc_decomp')
+pytest.importorskip('liblzfse')
+pytest.importorskip('PIL')
+
+from src import ktx_2_png  # noqa: E402
+
+ASTC_4x4 = 0x93B0
+
+
+def astc_levels(width, height, levels):
+    # each level's blocks are filled with the level number, so a slice at the wrong offset is easy to spot
+    data = list()
+    for level in range(levels):
+        w, h = max(1, width >> level), max(1, height >> level)
+        blocks = -(-w // 4) * -(-h // 4)
+        data.append(bytes([level + 1]) * (blocks * 16))
+    return data
+
+
+def lzfse_raw(data):
+    # an LZFSE stream of one uncompressed ('bvx-') block, then the end of stream marker
+    return b'bvx-' + struct.pack('<I', len(data)) + data + b'bvx$'
+
+
+def ktx_file(width, height, levels, compressed):
+    key_value = b''
+    if compressed:
+        key = b'Compression_APPLE\x00LZFSE\x00'
+        key_value = struct.pack('<I', len(key)) + key
+        key_value += b'\x00' * (-len(key_value) % 4)
+    header = b'\xabKTX 11\xbb\r\n\x1a\n' + struct.pack('<I', 0x04030201)
+    header += struct.pack('<12I', 0, 1, 0, ASTC_4x4, 0x1908, width, height, 0, 0, 1, levels, len(key_value))
+    level_data = astc_levels(width, height, levels)
+    if compressed:
+        # the decompressed texture holds its levels back to back
+        payload = b''.join(level_data)
+        body = struct.pack('<I', len(payload)) + b'\x00' * 8 + lzfse_raw(payload)
+    else:
+        body = b''.join(struct.pack('<I', len(data)) + data for data in level_data)
+    return io.BytesIO(header + key_value + body), level_data
+
+
+@pytest.mark.parametrize('compressed', [True, False])
+@pytest.mark.parametrize('width, height, levels', [(64, 32, 7), (30, 18, 5), (1170, 2532, 4)])
+def test_get_mip_level_data(width, height, levels, compressed):
+    f, level_data = ktx_file(width, height, levels, compressed)
+    reader = ktx_2_png.KTXReader()
+    assert reader.validate_header(f)
+    for level, expected in enumerate(level_data):
+        w, h, data = reader.get_mip_level_data(f, level)
+        assert (w, h) == (max(1, width >> level), max(1, height >> level))
+        assert data == expected
+
+
+def test_get_mip_level_data_too_short():
+    f, _ = ktx_file(64, 32, 3, compressed=True)
+    reader = ktx_2_png.KTXReader()
+    assert reader.validate_header(f)
+    reader.numberOfMipmapLevels = 4  # claims a level the data doesn't hold
+    with pytest.raises(ValueError):
+        reader.get_mip_level_data(f, 3)